@@ -71,6 +71,7 @@ import { userRouter } from './routes/UserRouter';
 import { userScriptShadowCopyRouter } from './routes/UserScriptShadowCopyRouter';
 
 import { userService } from './services/UserService';
+import { schedulerLaunchConsumer } from './utils/SchedulerLaunchConsumer';
 
 import { AMQPConnector } from '../shared/AMQPLib';
 import { AuthTokenType } from '../shared/Enums';
@@ -117,6 +118,11 @@ let logger: BaseLogger;
     let amqp: AMQPConnector = new AMQPConnector(appName, '', 1, (activeMessages) => {}, logger);
     amqp.Start();
 
+    // Launches from the job scheduler when its launch transport is "amqp"
+    schedulerLaunchConsumer.start(logger).catch((e) => {
+        logger.LogError('Error starting the scheduler launch consumer: ' + e.message, { Stack: e.stack });
+    });
+
     const expressSessionOptions: any = {
         store: new RedisStore({ client: redisClient }),
         saveUninitialized: false,
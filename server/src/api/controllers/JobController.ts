@@ -3,6 +3,7 @@ import { ResponseWrapper, ResponseCode } from '../utils/Types';
 import { JobSchema, JobModel } from '../domain/Job';
 import { defaultBulkGet } from '../utils/BulkGet';
 import { jobService } from '../services/JobService';
+import { schedulerLeaderService } from '../services/SchedulerLeaderService';
 import { MissingObjectError } from '../utils/Errors';
 import { Error } from 'mongoose';
 import { convertData as convertResponseData } from '../utils/ResponseConverters';
@@ -130,6 +131,9 @@ export class JobController {
             //     'Params': JSON.stringify(req.params, null, 4)
             // });
 
+            if (Object.keys(req.headers).indexOf('schedulerfencingtoken') >= 0)
+                await schedulerLeaderService.checkFencingToken(Number(req.headers.schedulerfencingtoken));
+
             await FreeTierChecks.MaxScriptsCheck(_teamId);
             // await FreeTierChecks.PaidTierRequired(_teamId, 'Please upgrade to the paid tier to run Jobs');
 
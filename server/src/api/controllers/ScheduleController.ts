@@ -27,6 +27,20 @@ export class ScheduleController {
         defaultBulkGet({ _teamId }, req, resp, next, ScheduleSchema, ScheduleModel, scheduleService);
     }
 
+    // A page of the schedules of every team in _id order - the scheduler reconciles its job store against these
+    public async getSchedulesForScheduler(req: Request, resp: Response, next: NextFunction): Promise<void> {
+        const response: ResponseWrapper = resp['body'];
+        try {
+            const afterId = req.query.afterId ? new mongodb.ObjectId(<string>req.query.afterId) : null;
+            const limit = Math.min(Math.max(Number(req.query.limit) || 500, 1), 5000);
+            const schedules: ScheduleSchema[] = await scheduleService.findSchedulesForScheduler(afterId, limit);
+            response.data = schedules.map((schedule) => convertResponseData(ScheduleSchema, schedule));
+            return next();
+        } catch (err) {
+            return next(err);
+        }
+    }
+
     public async getSchedule(req: Request, resp: Response, next: NextFunction): Promise<void> {
         try {
             const _teamId: mongodb.ObjectId = new mongodb.ObjectId(<string>req.headers._teamid);
@@ -118,6 +132,22 @@ export class ScheduleController {
         }
     }
 
+    public async updateManyFromScheduler(req: Request, resp: Response, next: NextFunction): Promise<void> {
+        const _teamId: mongodb.ObjectId = new mongodb.ObjectId(<string>req.headers._teamid);
+        const response: ResponseWrapper = resp['body'];
+        try {
+            response.data = await scheduleService.updateManyFromScheduler(
+                _teamId,
+                convertRequestData(ScheduleSchema, req.body.schedules || []),
+                req.header('correlationId')
+            );
+            response.statusCode = ResponseCode.OK;
+            return next();
+        } catch (err) {
+            return next(err);
+        }
+    }
+
     public async deleteSchedule(req: Request, resp: Response, next: NextFunction): Promise<void> {
         const _teamId: mongodb.ObjectId = new mongodb.ObjectId(<string>req.headers._teamid);
         const response: ResponseWrapper = resp['body'];
@@ -46,6 +46,14 @@ export class ScheduleSchema {
     @prop({ required: false })
     max_instances?: number;
 
+    // Seconds over which launches of this schedule may be spread to avoid bursts of schedules due at the same time
+    @prop({ required: false })
+    fireSpreadSeconds?: number;
+
+    // What to do with fires missed while the scheduler was down - "skip", "once" or "all"
+    @prop({ required: false })
+    catchUpPolicy?: string;
+
     @prop({ required: false })
     RunDate?: string;
 
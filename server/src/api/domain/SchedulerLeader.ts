@@ -0,0 +1,19 @@
+import { modelOptions, prop, getModelForClass, Severity } from '@typegoose/typegoose';
+
+// Leader lease written by the JobScheduler instances (py_utils/leader.py) - the API only reads it
+@modelOptions({ schemaOptions: { collection: 'scheduler_leader' }, options: { allowMixed: Severity.ALLOW } })
+export class SchedulerLeaderSchema {
+    @prop()
+    _id?: string;
+
+    @prop()
+    holder?: string;
+
+    @prop()
+    token?: number;
+
+    @prop()
+    expires_at?: Date;
+}
+
+export const SchedulerLeaderModel = getModelForClass(SchedulerLeaderSchema);
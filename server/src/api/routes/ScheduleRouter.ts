@@ -9,12 +9,24 @@ export class ScheduleRouter {
         this.router = Router();
 
         this.router.get('/', verifyAccessRights(['SCHEDULE_READ', 'GLOBAL']), scheduleController.getManySchedules);
+        // Registered ahead of '/:scheduleId' so 'forscheduler' isn't taken as a schedule id
+        this.router.get(
+            '/forscheduler',
+            verifyAccessRights(['SCHEDULE_UPDATE_BY_SCHEDULER']),
+            scheduleController.getSchedulesForScheduler
+        );
         this.router.get(
             '/:scheduleId',
             verifyAccessRights(['SCHEDULE_READ', 'GLOBAL']),
             scheduleController.getSchedule
         );
         this.router.post('/', verifyAccessRights(['SCHEDULE_WRITE', 'GLOBAL']), scheduleController.createSchedule);
+        // Registered ahead of '/:scheduleId' so 'fromscheduler' isn't taken as a schedule id
+        this.router.put(
+            '/fromscheduler',
+            verifyAccessRights(['SCHEDULE_UPDATE_BY_SCHEDULER']),
+            scheduleController.updateManyFromScheduler
+        );
         this.router.put(
             '/:scheduleId',
             verifyAccessRights(['SCHEDULE_WRITE', 'GLOBAL']),
@@ -247,5 +247,94 @@ describe('Schedule service tests', () => {
         expect(repetitionSchedule).toBeUndefined;
     });
 
+    test('Create schedules and update many from scheduler', async () => {
+        const _teamId: mongodb.ObjectId = new mongodb.ObjectId();
+        const _jobDefId: mongodb.ObjectId = new mongodb.ObjectId();
+        const createdBy = new mongodb.ObjectId();
+        const scheduleTemplate = (name: string): Subset<ScheduleSchema> => {
+            return {
+                _jobDefId,
+                name,
+                createdBy,
+                lastUpdatedBy: createdBy,
+                TriggerType: 'cron',
+                cron: {
+                    Minute: '*/5',
+                },
+                FunctionKwargs: {
+                    _teamId: _teamId.toHexString(),
+                    targetId: _jobDefId.toHexString(),
+                    runtimeVars: {},
+                },
+            };
+        };
+        const schedules: ScheduleSchema[] = await scheduleService.createSchedules(
+            _teamId,
+            [scheduleTemplate('Bulk schedule 1'), scheduleTemplate('Bulk schedule 2')],
+            'test1_correlation_id'
+        );
+        await validateEquality(schedules.length, 2);
+
+        const nextScheduledRunDate = new Date();
+        const missingScheduleId = new mongodb.ObjectId();
+        const results: any[] = await scheduleService.updateManyFromScheduler(
+            _teamId,
+            [
+                { _id: schedules[0]._id, nextScheduledRunDate },
+                { _id: missingScheduleId, nextScheduledRunDate },
+            ],
+            'test1_correlation_id'
+        );
+        await validateEquality(results[0].success, true);
+        await validateEquality(results[1].success, false);
+
+        const updatedSchedule: ScheduleSchema = await scheduleService.findSchedule(_teamId, schedules[0]._id);
+        expect(updatedSchedule.nextScheduledRunDate).toStrictEqual(nextScheduledRunDate);
+    });
+
+    test('Page through schedules for the scheduler', async () => {
+        const _jobDefId: mongodb.ObjectId = new mongodb.ObjectId();
+        const createdBy = new mongodb.ObjectId();
+        const createdIds: string[] = [];
+        for (let _teamId of [new mongodb.ObjectId(), new mongodb.ObjectId()]) {
+            const schedules: ScheduleSchema[] = await scheduleService.createSchedules(
+                _teamId,
+                [1, 2, 3].map((index) => {
+                    return {
+                        _jobDefId,
+                        name: `Paged schedule ${index}`,
+                        createdBy,
+                        lastUpdatedBy: createdBy,
+                        TriggerType: 'cron',
+                        cron: {
+                            Minute: '*/5',
+                        },
+                        FunctionKwargs: {
+                            _teamId: _teamId.toHexString(),
+                            targetId: _jobDefId.toHexString(),
+                            runtimeVars: {},
+                        },
+                    };
+                }),
+                'test1_correlation_id'
+            );
+            createdIds.push(...schedules.map((schedule) => schedule._id.toHexString()));
+        }
+
+        const pagedIds: string[] = [];
+        let afterId: mongodb.ObjectId = null;
+        while (true) {
+            const page: ScheduleSchema[] = await scheduleService.findSchedulesForScheduler(afterId, 4);
+            if (page.length === 0) break;
+            pagedIds.push(...page.map((schedule) => schedule._id.toHexString()));
+            afterId = page[page.length - 1]._id;
+        }
+
+        // Schedules of every team, each once and in _id order
+        await validateEquality(_.uniq(pagedIds).length, pagedIds.length);
+        await validateEquality(_.difference(createdIds, pagedIds).length, 0);
+        expect(pagedIds).toStrictEqual([...pagedIds].sort());
+    });
+
     afterAll(async () => await db.clearDatabase());
 });
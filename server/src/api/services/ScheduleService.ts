@@ -88,7 +88,7 @@ export class ScheduleService {
         correlationId: string
     ): Promise<ScheduleSchema[] | null> {
         const task = data['Task'];
-        let newSchedules: ScheduleSchema[] = [];
+        let newSchedulesData: Subset<ScheduleSchema>[] = [];
         let triggerIndex = 0;
 
         let createScheduleData = function (partialSchedule) {
@@ -133,14 +133,7 @@ export class ScheduleService {
                                 partialSchedule.isActive = taskEnabled;
                                 if ('Enabled' in trigger) partialSchedule.isActive = taskEnabled && trigger['Enabled'];
                                 if (timezone && partialSchedule.cron) partialSchedule.cron.Timezone = timezone;
-                                const newScheduleData = createScheduleData(partialSchedule);
-                                const newSchedule = await scheduleService.createSchedule(
-                                    _teamId,
-                                    newScheduleData,
-                                    correlationId,
-                                    '_id'
-                                );
-                                newSchedules.push(newSchedule);
+                                newSchedulesData.push(createScheduleData(partialSchedule));
                             }
                         }
                     }
@@ -148,7 +141,7 @@ export class ScheduleService {
             }
         }
 
-        return newSchedules;
+        return scheduleService.createSchedules(_teamId, newSchedulesData, correlationId, '_id');
     }
 
     // Some services might need to add additional restrictions to bulk queries
@@ -166,6 +159,16 @@ export class ScheduleService {
         return ScheduleModel.find({ _teamId }).select(responseFields);
     }
 
+    // Pages through the schedules of every team in _id order - continue from the last _id of the previous page
+    public async findSchedulesForScheduler(
+        afterId: mongodb.ObjectId | null,
+        limit: number,
+        responseFields?: string
+    ): Promise<ScheduleSchema[]> {
+        const filter = afterId ? { _id: { $gt: afterId } } : {};
+        return ScheduleModel.find(filter).sort({ _id: 1 }).limit(limit).select(responseFields);
+    }
+
     public async findSchedule(
         _teamId: mongodb.ObjectId,
         scheduleId: mongodb.ObjectId,
@@ -214,6 +217,50 @@ export class ScheduleService {
         }
     }
 
+    // Creates the schedules and sends them to the scheduler in a single UpdateJobs message
+    public async createSchedules(
+        _teamId: mongodb.ObjectId,
+        data: Subset<ScheduleSchema>[],
+        correlationId: string,
+        responseFields?: string
+    ): Promise<ScheduleSchema[]> {
+        const newSchedules: ScheduleSchema[] = [];
+        for (let scheduleData of data) {
+            scheduleData._teamId = _teamId;
+            const scheduleModel = new ScheduleModel(scheduleData);
+            const newSchedule = await scheduleModel.save();
+
+            await rabbitMQPublisher.publish(
+                _teamId,
+                'Schedule',
+                correlationId,
+                PayloadOperation.CREATE,
+                convertData(ScheduleSchema, newSchedule)
+            );
+
+            newSchedules.push(newSchedule);
+        }
+
+        if (newSchedules.length > 0) {
+            await rabbitMQPublisher.publishScheduleUpdates(
+                _teamId,
+                newSchedules.map((newSchedule) =>
+                    Object.assign(convertData(ScheduleSchema, newSchedule), { Action: 'UpdateJob' })
+                )
+            );
+        }
+
+        if (responseFields) {
+            const result: ScheduleSchema[] = [];
+            for (let newSchedule of newSchedules) {
+                result.push(await this.findSchedule(_teamId, newSchedule._id, responseFields));
+            }
+            return result;
+        } else {
+            return newSchedules; // fully populated models
+        }
+    }
+
     public async updateSchedule(
         _teamId: mongodb.ObjectId,
         id: mongodb.ObjectId,
@@ -281,6 +328,26 @@ export class ScheduleService {
         return updatedSchedule; // fully populated model
     }
 
+    // Applies the results of an UpdateJobs batch - each update carries its own schedule _id
+    public async updateManyFromScheduler(
+        _teamId: mongodb.ObjectId,
+        updates: any[],
+        correlationId: string
+    ): Promise<object[]> {
+        const results: object[] = [];
+        for (let update of updates) {
+            const { _id, ...data } = update;
+            try {
+                await this.updateFromScheduler(_teamId, _id, data, correlationId, '_id');
+                results.push({ id: _id, success: true });
+            } catch (err) {
+                results.push({ id: _id, success: false, error: err.message });
+            }
+        }
+
+        return results;
+    }
+
     public async deleteSchedule(
         _teamId: mongodb.ObjectId,
         id: mongodb.ObjectId,
@@ -0,0 +1,21 @@
+import { SchedulerLeaderModel } from '../domain/SchedulerLeader';
+import { ForbiddenError } from '../utils/Errors';
+
+const schedulerLeaseId = 'job_scheduler';
+
+export class SchedulerLeaderService {
+    // Jobs launched by the scheduler carry the fencing token of the leader lease it held at the time. Once
+    //   another scheduler instance takes the lease over the token is incremented, so a launch from the
+    //   replaced leader carries an older token and is refused.
+    public async checkFencingToken(fencingToken: number): Promise<void> {
+        const lease = await SchedulerLeaderModel.findById(schedulerLeaseId).select('token');
+        if (isNaN(fencingToken)) {
+            throw new ForbiddenError('Invalid scheduler fencing token');
+        }
+        if (lease && lease.token > fencingToken) {
+            throw new ForbiddenError(`Stale scheduler fencing token ${fencingToken} - current is ${lease.token}`);
+        }
+    }
+}
+
+export const schedulerLeaderService = new SchedulerLeaderService();
@@ -100,6 +100,13 @@ class RabbitMQPublisher {
         }
         this.amqp.PublishRoute('worker', rmqScheduleUpdatesQueue, schedule);
     }
+
+    public async publishScheduleUpdates(_teamId: mongodb.ObjectId, schedules: any[]) {
+        if (!this.started) {
+            await this.start();
+        }
+        this.amqp.PublishRoute('worker', rmqScheduleUpdatesQueue, { Action: 'UpdateJobs', _teamId, jobs: schedules });
+    }
 }
 
 export const rabbitMQPublisher = new RabbitMQPublisher();
@@ -691,7 +691,7 @@ let ImportSchedules = async (
     schedulesToImport: Array<any>,
     correlationId?: string
 ): Promise<Array<ScheduleSchema>> => {
-    const schedules: Array<ScheduleSchema> = [];
+    const schedulesData: Array<any> = [];
     for (let schedule of schedulesToImport) {
         const newScheduleData: any = {
             _jobDefId,
@@ -714,15 +714,10 @@ let ImportSchedules = async (
         if (schedule.cron) newScheduleData.cron = schedule.cron;
         if (schedule.interval) newScheduleData.interval = schedule.interval;
 
-        const newSchedule: ScheduleSchema = await scheduleService.createSchedule(
-            _teamId,
-            newScheduleData,
-            correlationId
-        );
-        schedules.push(newSchedule);
+        schedulesData.push(newScheduleData);
     }
 
-    return schedules;
+    return scheduleService.createSchedules(_teamId, schedulesData, correlationId);
 };
 
 /**
@@ -0,0 +1,148 @@
+import { AMQPConnector } from '../../shared/AMQPLib';
+import { FreeTierChecks } from '../../shared/FreeTierChecks';
+import { BaseLogger } from '../../shared/SGLogger';
+import { jobService } from '../services/JobService';
+import { scheduleService } from '../services/ScheduleService';
+import { schedulerLeaderService } from '../services/SchedulerLeaderService';
+import { ForbiddenError, FreeTierLimitExceededError, MissingObjectError, ValidationError } from './Errors';
+import * as config from 'config';
+import * as mongodb from 'mongodb';
+
+const appName: string = 'SchedulerLaunchConsumer';
+
+let schedulerLaunchConfig: any = {};
+if (config.has('schedulerLaunch')) schedulerLaunchConfig = config.get('schedulerLaunch');
+
+// Launches published by the job scheduler when its launch transport is "amqp". Each message is what the
+//   scheduler would otherwise POST to /job - { _teamId, _jobDefId, schedulerFencingToken?, data } - and is
+//   handled the same way: a launch for a job definition or team that no longer exists deletes its schedule,
+//   and a launch from a replaced scheduler leader is dropped. A launch that fails for any other reason - MongoDB
+//   or RabbitMQ being unavailable - is requeued and tried again. A redelivered launch whose job was already
+//   created isn't launched again.
+class SchedulerLaunchConsumer {
+    private amqp: AMQPConnector;
+    private logger: BaseLogger;
+    private started: boolean = false;
+
+    public enabled(): boolean {
+        return schedulerLaunchConfig.transport === 'amqp';
+    }
+
+    public async start(logger: BaseLogger) {
+        if (this.started || !this.enabled()) return;
+        this.logger = logger;
+        this.amqp = new AMQPConnector(
+            appName,
+            '',
+            schedulerLaunchConfig.consumerPrefetch || 50,
+            (activeMessages) => {},
+            logger
+        );
+        if (!(await this.amqp.Start())) throw new Error('Error starting AMQP');
+        await this.amqp.ConsumeQueue(
+            schedulerLaunchConfig.queue || 'scheduler_job_launch',
+            false,
+            true,
+            false,
+            false,
+            (params: any, msgKey: string, fields: any, properties: any, cb: any) =>
+                this.onLaunchMessage(params, msgKey, fields, cb),
+            schedulerLaunchConfig.exchange || 'scheduler'
+        );
+        this.started = true;
+    }
+
+    public async stop() {
+        if (this.started) {
+            await this.amqp.Stop();
+            this.started = false;
+        }
+    }
+
+    private async onLaunchMessage(params: any, msgKey: string, fields: any, cb: any) {
+        let ok = true;
+        try {
+            await this.launch(params, !!(fields && fields.redelivered));
+        } catch (e) {
+            ok = !this.retryable(e);
+            this.logger.LogError('Error launching scheduled job: ' + e.message, {
+                _teamId: params._teamId,
+                _jobDefId: params._jobDefId,
+                _scheduleId: params.data && params.data._scheduleId,
+                Requeued: !ok,
+                Stack: e.stack,
+            });
+        }
+        // A failed launch is held for a moment before it's requeued so an outage isn't hit with the same
+        //   launches in a tight loop
+        if (!ok) await new Promise((resolve) => setTimeout(resolve, schedulerLaunchConfig.retryDelayMs || 1000));
+        await cb(ok, msgKey);
+    }
+
+    // Errors that launching again won't get past - anything else is taken to be MongoDB or RabbitMQ being
+    //   unavailable
+    private retryable(err: any): boolean {
+        return !(
+            err instanceof ForbiddenError ||
+            err instanceof MissingObjectError ||
+            err instanceof FreeTierLimitExceededError ||
+            err instanceof ValidationError
+        );
+    }
+
+    public async launch(params: any, redelivered: boolean = false): Promise<string> {
+        if (!mongodb.ObjectId.isValid(params._teamId) || !mongodb.ObjectId.isValid(params._jobDefId) || !params.data)
+            throw new ValidationError('Invalid scheduled job launch message');
+        const _teamId: mongodb.ObjectId = new mongodb.ObjectId(<string>params._teamId);
+        const _jobDefId: mongodb.ObjectId = new mongodb.ObjectId(<string>params._jobDefId);
+        try {
+            if (params.schedulerFencingToken !== undefined)
+                await schedulerLeaderService.checkFencingToken(Number(params.schedulerFencingToken));
+
+            // A launch requeued after a failure may have got as far as creating its job
+            if (redelivered && params.data.dateScheduled) {
+                const launched = await jobService.findAllJobsInternal(
+                    { _teamId, _jobDefId, dateScheduled: new Date(params.data.dateScheduled) },
+                    '_id',
+                    1
+                );
+                if (launched.length > 0) {
+                    this.logger.LogWarning('Scheduled job already launched - skipping redelivered launch', {
+                        _teamId: params._teamId,
+                        _jobDefId: params._jobDefId,
+                        _scheduleId: params.data._scheduleId,
+                        _jobId: launched[0]._id,
+                    });
+                    return 'duplicate';
+                }
+            }
+
+            await FreeTierChecks.MaxScriptsCheck(_teamId);
+
+            await jobService.createJobFromJobDefId(_teamId, _jobDefId, params.data, this.logger, this.amqp);
+            return 'launched';
+        } catch (err) {
+            if (err instanceof ForbiddenError) {
+                this.logger.LogWarning('Scheduled job launch refused: ' + err.message, {
+                    _teamId: params._teamId,
+                    _scheduleId: params.data._scheduleId,
+                    schedulerFencingToken: params.schedulerFencingToken,
+                });
+                return 'refused';
+            }
+            if (err instanceof MissingObjectError) {
+                this.logger.LogInfo('Job does not exist - deleting schedule', {
+                    _teamId: params._teamId,
+                    _jobDefId: params._jobDefId,
+                    _scheduleId: params.data._scheduleId,
+                    Error: err.message,
+                });
+                await scheduleService.deleteSchedule(_teamId, new mongodb.ObjectId(params.data._scheduleId), null);
+                return 'deleted';
+            }
+            throw err;
+        }
+    }
+}
+
+export const schedulerLaunchConsumer = new SchedulerLaunchConsumer();
@@ -1,10 +1,13 @@
 import json
-import requests
 import sendgrid
+import signal
 import socket
 import sys
+import time
 import traceback
 
+from concurrent import futures
+from contextlib import nullcontext
 from datetime import datetime, date, timedelta
 from dotenv import load_dotenv
 from os import environ, path
@@ -12,20 +15,44 @@ from pprint import pprint
 from pytz import utc
 from sendgrid.helpers.mail import *
 from threading import Event, Thread
+from urllib.parse import urlencode
 
-from apscheduler.executors.pool import ProcessPoolExecutor, ThreadPoolExecutor
+from apscheduler.events import (
+    EVENT_JOB_ERROR,
+    EVENT_JOB_MAX_INSTANCES,
+    EVENT_JOB_MISSED,
+    EVENT_SCHEDULER_START,
+)
+from apscheduler.executors.pool import ThreadPoolExecutor
+from apscheduler.jobstores.base import JobLookupError
 from apscheduler.jobstores.mongodb import MongoDBJobStore
 from apscheduler.schedulers.blocking import BlockingScheduler
-from apscheduler.triggers.cron import CronTrigger
-from apscheduler.triggers.date import DateTrigger
-from apscheduler.triggers.interval import IntervalTrigger
-from apscheduler.util import timedelta_seconds
+from apscheduler.util import asbool, undefined
 
+from py_utils.adaptive_limit import AdaptiveLimiter, LimitExpired
+from py_utils.cached_jobstore import CachedJobStore
+from py_utils.catch_up import CatchUp
+from py_utils.coalesce import CoalesceCounting
 from py_utils.credentials import Credentials
+from py_utils.fair_share import FairShareExecutor, Quota
+from py_utils.fire_spreader import FireSpreader, spread_offset
+from py_utils.fire_times import next_fire_times
+from py_utils.http_client import ApiClient, CircuitOpenError, connection_not_made
+from py_utils.lanes import KeyedLanes
+from py_utils.launch_outbox import LaunchOutbox
+from py_utils.leader import LeaderLease
 from py_utils.logger import logger
+from py_utils.membership import ClusterMembership
+from py_utils.metrics import MetricsRegistry, MetricsServer
+from py_utils.reconciler import ScheduleReconciler
 from py_utils.rmq_comm import *
+from py_utils.sampling_profiler import SamplingProfiler
+from py_utils.schedule_spec import ScheduleSpec, decode_message
+from py_utils.trigger_cache import TriggerCache
+from py_utils.schedule_reporter import ScheduleStateReporter
 
 wait_schedule_updates_handler_exception = Event()
+scheduler_started = Event()
 
 env = "default"
 if "NODE_ENV" in environ:
@@ -73,12 +100,28 @@ if env != "default":
         config = getConfigValues("config/{}.json".format(env), config)
 
 rmqScheduleUpdatesQueue = config.get("rmqScheduleUpdatesQueue")
+scheduleUpdateWorkers = config.get("scheduleUpdateWorkers", 0)
 environment = config.get("environment")
 loggingLevel = config.get("loggingLevel")
 useSSL = config.get("useSSL") == "true"
 apiBaseUrl = config.get("API_BASE_URL")
 apiPort = config.get("API_PORT")
 apiVersion = config.get("API_VERSION")
+httpClientConfig = config.get("schedulerHttpClient", {})
+jobStoreConfig = config.get("schedulerJobStore", {})
+reportingConfig = config.get("schedulerReporting", {})
+clusterConfig = config.get("schedulerCluster", {})
+fireSpreadConfig = config.get("schedulerFireSpread", {})
+metricsConfig = config.get("schedulerMetrics", {})
+profilerConfig = config.get("schedulerProfiler", {})
+reconcileConfig = config.get("schedulerReconcile", {})
+launchConfig = config.get("schedulerLaunch", {})
+launchOutboxConfig = config.get("schedulerLaunchOutbox", {})
+catchUpConfig = config.get("schedulerCatchUp", {})
+fairShareConfig = config.get("schedulerFairShare", {})
+lanesConfig = config.get("schedulerLanes", {})
+launchConcurrencyConfig = config.get("schedulerLaunchConcurrency", {})
+clusterMode = clusterConfig.get("mode", "single")
 
 if env == "production":
     load_rabbitmq_secrets(config["rabbitmq-credentials"])
@@ -93,27 +136,445 @@ rmqUsername = environ["rmqUsername"]
 rmqPassword = environ["rmqPassword"]
 rmqVhost = environ["rmqVhost"]
 
-jobstores = {
-    "default": MongoDBJobStore(
-        database=mongoDbName, collection="scheduled_job_1", host=mongoUrl
+# Schedules with the same cron or interval definition share one trigger object
+trigger_cache = TriggerCache(max_size=jobStoreConfig.get("triggerCacheSize", 10000))
+
+mongo_job_store = MongoDBJobStore(
+    database=mongoDbName, collection="scheduled_job_1", host=mongoUrl
+)
+# The job cache and the compact encoding are opt in - switching encoding migrates
+#   the stored jobs in the background
+if jobStoreConfig.get("cache", False):
+    jobstores = {
+        "default": CachedJobStore(
+            mongo_job_store,
+            write_behind=jobStoreConfig.get("writeBehind", False),
+            flush_interval=jobStoreConfig.get("flushIntervalSeconds", 1),
+            intern_trigger=trigger_cache.intern,
+            snapshot_path=jobStoreConfig.get("snapshotPath") or None,
+            snapshot_interval=jobStoreConfig.get("snapshotIntervalSeconds", 300),
+            encoding=jobStoreConfig.get("encoding", "pickle"),
+            migration_batch_size=jobStoreConfig.get("migrationBatchSize", 500),
+            migration_pause=jobStoreConfig.get("migrationPauseSeconds", 0.5),
+            tombstone_ttl=jobStoreConfig.get("tombstoneTtlSeconds", 86400),
+            catch_up_overlap=jobStoreConfig.get("catchUpOverlapSeconds", 60),
+            full_catch_up_interval=jobStoreConfig.get(
+                "fullCatchUpIntervalSeconds", 3600
+            ),
+        )
+    }
+else:
+    # MongoDBJobStore only reads pickled jobs
+    if jobStoreConfig.get("encoding", "pickle") != "pickle":
+        raise Exception("The compact job encoding requires schedulerJobStore.cache")
+    jobstores = {"default": mongo_job_store}
+
+
+def fair_share_quota(values):
+    """A team's launch quota from schedulerFairShare config"""
+    return Quota(
+        weight=values.get("weight", 1),
+        rate=values.get("ratePerSecond", 0),
+        burst=values.get("burst", 1),
+        max_concurrent=values.get("maxConcurrent", 0),
     )
-}
 
-executors = {"default": ThreadPoolExecutor(20), "processpool": ProcessPoolExecutor(5)}
+
+class CountingFairShareExecutor(CoalesceCounting, FairShareExecutor):
+    pass
+
+
+class CountingThreadPoolExecutor(CoalesceCounting, ThreadPoolExecutor):
+    pass
+
+
+executor_threads = 20
+team_quotas = {
+    _teamId: fair_share_quota(values)
+    for _teamId, values in fairShareConfig.get("teams", {}).items()
+}
+if fairShareConfig.get("enabled", False):
+    # Fires are queued per team and the executor threads shared fairly between
+    #   the teams with queued fires, so a team with a lot of schedules due at once
+    #   only delays its own launches. Off unless enabled, which leaves fires to the
+    #   plain thread pool in the order they're due.
+    default_executor = CountingFairShareExecutor(
+        executor_threads,
+        quota=team_quotas.get,
+        default_quota=fair_share_quota(fairShareConfig.get("defaultQuota", {})),
+        on_throttled=lambda _teamId, reason: fair_share_throttled.inc(
+            team=fair_share_team_label(_teamId), reason=reason
+        ),
+        on_start=lambda _teamId, seconds: fair_share_wait.observe(
+            seconds, team=fair_share_team_label(_teamId)
+        ),
+        on_coalesced=lambda count: coalesced_runs.inc(count),
+    )
+else:
+    default_executor = CountingThreadPoolExecutor(
+        executor_threads, on_coalesced=lambda count: coalesced_runs.inc(count)
+    )
+executors = {"default": default_executor}
+
+# Launches are sent on the executor threads, and the calls that follow a launch -
+#   reporting the schedule's run dates, deleting a schedule whose job is gone,
+#   recording a failed launch for retry - on the bookkeeping lanes, so slow
+#   bookkeeping never holds a thread the next due launch needs. Work for a schedule
+#   always runs on the same lane, in order, and is held back for up to
+#   launchPrioritySeconds while launches are waiting for an executor thread.
+bookkeeping_lanes = KeyedLanes(
+    lanesConfig.get("bookkeepingWorkers", 4),
+    "bookkeeping",
+    pause_while=lambda: executor_queue_depth() > 0,
+    max_pause=lanesConfig.get("launchPrioritySeconds", 1),
+)
 
 job_defaults = {"coalesce": True, "max_instances": 1}
 
 rmqCon = None
+handle_schedule_updates_thread = None
+handle_schedule_updates_stop = None
 job_scheduler = BlockingScheduler()
 job_scheduler.configure(
     jobstores=jobstores, executors=executors, job_defaults=job_defaults, timezone=utc
 )
+job_scheduler.add_listener(lambda event: scheduler_started.set(), EVENT_SCHEDULER_START)
+
+# Lateness is measured separately where APScheduler hands the job to the executor
+#   and where the launch is sent, so late jobs can be attributed to the scheduler
+#   (executor backlog, fire spread) or to the API (request latency)
+metrics = MetricsRegistry()
+fire_lateness = metrics.histogram(
+    "sg_scheduler_fire_lateness_seconds",
+    "Seconds between a job's scheduled time and the executor running it",
+)
+launch_lateness = metrics.histogram(
+    "sg_scheduler_launch_lateness_seconds",
+    "Seconds between a job's scheduled time and its launch request being sent",
+)
+api_request_duration = metrics.histogram(
+    "sg_scheduler_api_request_duration_seconds",
+    "Duration of API requests including retries",
+    ["method", "endpoint", "status"],
+)
+misfires = metrics.counter(
+    "sg_scheduler_misfires_total",
+    "Runs skipped because they were later than the misfire grace time",
+)
+max_instances_skips = metrics.counter(
+    "sg_scheduler_max_instances_skips_total",
+    "Runs skipped because the previous run of the job was still going",
+)
+job_errors = metrics.counter(
+    "sg_scheduler_job_errors_total", "Runs that raised an exception"
+)
+coalesced_runs = metrics.counter(
+    "sg_scheduler_coalesced_runs_total",
+    "Overdue runs folded into a single run by coalescing",
+)
+launch_fenced = metrics.counter(
+    "sg_scheduler_launch_fenced_total",
+    "Launches skipped because another sharded scheduler instance may own the schedule",
+    ["reason"],
+)
+executor_busy_threads = metrics.gauge(
+    "sg_scheduler_executor_busy_threads",
+    "Default executor threads running a job",
+)
+metrics.gauge(
+    "sg_scheduler_executor_threads",
+    "Default executor thread pool size",
+    function=lambda: executor_threads,
+)
+metrics.gauge(
+    "sg_scheduler_executor_queue_depth",
+    "Jobs submitted to the default executor waiting for a thread",
+    function=lambda: executor_queue_depth(),
+)
+metrics.gauge(
+    "sg_scheduler_lane_queue_depth",
+    "Work waiting for a thread, by lane - launches or the bookkeeping that follows",
+    ["lane"],
+    function=lambda: {
+        "launch": executor_queue_depth(),
+        "bookkeeping": bookkeeping_lanes.pending(),
+    },
+)
+# Teams with a quota of their own are labelled by id and the rest together, to keep
+#   the number of series down
+fair_share_throttled = metrics.counter(
+    "sg_scheduler_fair_share_throttled_total",
+    "Fires held back in the fair share queue by their team's quota",
+    ["team", "reason"],
+)
+fair_share_wait = metrics.histogram(
+    "sg_scheduler_fair_share_wait_seconds",
+    "Seconds fires waited in the fair share queue for an executor thread",
+    ["team"],
+)
+if isinstance(default_executor, FairShareExecutor):
+    metrics.gauge(
+        "sg_scheduler_fair_share_teams",
+        "Teams with fires queued or running in the default executor",
+        function=default_executor.keys,
+    )
+job_scheduler.add_listener(lambda event: misfires.inc(), EVENT_JOB_MISSED)
+job_scheduler.add_listener(
+    lambda event: max_instances_skips.inc(), EVENT_JOB_MAX_INSTANCES
+)
+job_scheduler.add_listener(lambda event: job_errors.inc(), EVENT_JOB_ERROR)
+consumer_metrics = ConsumerMetrics(metrics)
+reconcile_drift = metrics.counter(
+    "sg_scheduler_reconcile_drift_total",
+    "Schedules reconciliation found out of step with the API",
+    ["kind"],
+)
+reconcile_passes = metrics.counter(
+    "sg_scheduler_reconcile_passes_total", "Complete reconciliation passes"
+)
+reconcile_pass_seconds = metrics.gauge(
+    "sg_scheduler_reconcile_last_pass_seconds",
+    "Duration of the last complete reconciliation pass",
+)
 
-schedule_trigger_type_to_string = {
-    IntervalTrigger: "interval",
-    DateTrigger: "date",
-    CronTrigger: "cron",
-}
+# Every call to the API goes through this client so connections are kept alive
+#   and shared between executor threads instead of opened per request. Launches
+#   under the launch concurrency limit are sent on the limiter's threads, up to
+#   maxLimit of them at once.
+api_pool_size = executor_threads
+if launchConcurrencyConfig.get("enabled", False):
+    api_pool_size = max(api_pool_size, launchConcurrencyConfig.get("maxLimit", 100))
+api_client = ApiClient(
+    pool_maxsize=httpClientConfig.get("poolMaxSize", api_pool_size),
+    connect_timeout=httpClientConfig.get("connectTimeoutSeconds", 5),
+    read_timeout=httpClientConfig.get("readTimeoutSeconds", 30),
+    max_retries=httpClientConfig.get("maxRetries", 3),
+    backoff_base=httpClientConfig.get("backoffBaseSeconds", 0.25),
+    backoff_max=httpClientConfig.get("backoffMaxSeconds", 5),
+    circuit_failure_threshold=httpClientConfig.get("circuitFailureThreshold", 20),
+    circuit_reset_timeout=httpClientConfig.get("circuitResetSeconds", 30),
+)
+
+# With the amqp launch transport launches are published to a durable queue the API
+#   consumes instead of POSTed to the API, so an executor thread is only held until
+#   RabbitMQ confirms the launch rather than for the whole request
+# Launches POSTed to the API are limited to an in-flight limit that grows while the
+#   API answers quickly and is cut when it slows down or errors, so a struggling API
+#   isn't sent more launches than it can handle. Launches are queued for the limit
+#   rather than waited for on the executor threads, and sent on the limiter's own
+#   threads earliest scheduled time first, giving up at their misfire deadline. Off
+#   unless enabled, which leaves launches limited only by the executor threads.
+launch_limiter = None
+launch_limit_expired = metrics.counter(
+    "sg_scheduler_launch_limit_expired_total",
+    "Launches whose misfire deadline passed waiting for the launch concurrency limit",
+)
+if launchConcurrencyConfig.get("enabled", False):
+    launch_limiter = AdaptiveLimiter(
+        initial_limit=launchConcurrencyConfig.get("initialLimit", 20),
+        min_limit=launchConcurrencyConfig.get("minLimit", 2),
+        max_limit=launchConcurrencyConfig.get("maxLimit", 100),
+        latency_target=launchConcurrencyConfig.get("latencyTargetSeconds", 2),
+        decrease_factor=launchConcurrencyConfig.get("decreaseFactor", 0.7),
+        name="launch-limit",
+    )
+    metrics.gauge(
+        "sg_scheduler_launch_concurrency_limit",
+        "Launches allowed in flight to the API at once",
+        function=launch_limiter.limit,
+    )
+    metrics.gauge(
+        "sg_scheduler_launch_in_flight",
+        "Launches in flight to the API",
+        function=launch_limiter.in_flight,
+    )
+    metrics.gauge(
+        "sg_scheduler_launch_limit_waiting",
+        "Launches waiting for the launch concurrency limit",
+        function=launch_limiter.waiting,
+    )
+
+launch_publisher = None
+if launchConfig.get("transport", "rest") == "amqp":
+    launch_publisher = AsyncPublisher(
+        "{0}://{1}:{2}@{3}/{4}".format(
+            "amqps" if useSSL else "amqp", rmqUsername, rmqPassword, rmqUrl, rmqVhost
+        ),
+        {
+            "exch": launchConfig.get("exchange", "scheduler"),
+            "exch_type": "topic",
+            "queue_name": launchConfig.get("queue", "scheduler_job_launch"),
+        },
+    )
+    metrics.gauge(
+        "sg_scheduler_launch_unconfirmed",
+        "Launches published and not yet confirmed by RabbitMQ",
+        function=launch_publisher.unconfirmed,
+    )
+launches = metrics.counter(
+    "sg_scheduler_launches_total", "Job launches sent, by transport", ["transport"]
+)
+# Status of a launch or request that failed in a way that leaves it unknown whether
+#   it went through - a launch isn't sent again, since that could launch the job twice
+LAUNCH_MAYBE_SENT = "maybe_sent"
+launches_maybe_sent = metrics.counter(
+    "sg_scheduler_launches_maybe_sent_total",
+    "Launches that failed after they may have reached the API or RabbitMQ",
+    ["transport"],
+)
+
+# Launches that fail before reaching the API - it's unreachable, its circuit is open
+#   or it's rate limiting - are kept in MongoDB and retried with backoff until their
+#   schedule's misfire grace time has passed, so an API outage delays launches instead
+#   of losing them. A launch the API may have acted on isn't retried since the API
+#   doesn't deduplicate launches.
+launch_outbox = None
+launch_outbox_entries = metrics.counter(
+    "sg_scheduler_launch_outbox_total",
+    "Failed launches recorded in the launch outbox and what their retries came to",
+    ["outcome"],
+)
+if launchOutboxConfig.get("enabled", False):
+    launch_outbox = LaunchOutbox(
+        mongo_job_store.client[mongoDbName]["scheduler_launch_outbox"],
+        lambda entry: retry_launch(entry),
+        enabled=lambda: leader_lease is None or leader_lease.is_leader(),
+        on_outcome=lambda outcome: launch_outbox_entries.inc(outcome=outcome),
+        concurrency=launchOutboxConfig.get("concurrency", 4),
+        max_per_second=launchOutboxConfig.get("maxPerSecond", 20),
+        backoff_base=launchOutboxConfig.get("backoffBaseSeconds", 2),
+        backoff_max=launchOutboxConfig.get("backoffMaxSeconds", 300),
+    )
+    metrics.gauge(
+        "sg_scheduler_launch_outbox_pending",
+        "Failed launches waiting to be retried",
+        function=launch_outbox.pending,
+    )
+
+# In sharded mode each scheduler instance owns the schedules that hash to it on a
+#   ring of the live instances and only keeps those jobs in its job cache
+membership = None
+if clusterMode == "sharded":
+    if not isinstance(jobstores["default"], CachedJobStore):
+        raise Exception("Sharded scheduler mode requires schedulerJobStore.cache")
+    membership = ClusterMembership(
+        mongo_job_store.client[mongoDbName]["scheduler_members"],
+        clusterConfig.get("memberId") or socket.gethostname(),
+        lease_seconds=clusterConfig.get("leaseSeconds", 15),
+        heartbeat_interval=clusterConfig.get("heartbeatSeconds", 5),
+        vnodes=clusterConfig.get("virtualNodes", 64),
+        safety_margin=clusterConfig.get("safetyMarginSeconds", 2),
+        on_change=lambda ring: jobstores["default"].set_ownership(membership.owns),
+    )
+
+# In leader mode every scheduler instance keeps its job cache loaded but only the
+#   instance holding the leader lease runs jobs and consumes schedule updates - the
+#   others are warm standbys that take over when the leader's lease expires
+leader_lease = None
+if clusterMode == "leader":
+    if not isinstance(jobstores["default"], CachedJobStore):
+        raise Exception("Leader scheduler mode requires schedulerJobStore.cache")
+    leader_lease = LeaderLease(
+        mongo_job_store.client[mongoDbName]["scheduler_leader"],
+        clusterConfig.get("memberId") or socket.gethostname(),
+        lease_seconds=clusterConfig.get("leaderLeaseSeconds", 10),
+        renew_interval=clusterConfig.get("leaderRenewSeconds", 2),
+        safety_margin=clusterConfig.get("leaderSafetyMarginSeconds", 2),
+        on_elected=lambda fencing_token: promote_to_leader(),
+        on_demoted=lambda: demote_from_leader(),
+    )
+
+schedule_reporter = None
+if reportingConfig.get("enabled", False):
+    schedule_reporter = ScheduleStateReporter(
+        lambda _teamId, updates: send_schedule_state_batch(_teamId, updates),
+        flush_interval=reportingConfig.get("flushIntervalSeconds", 2),
+        max_batch_size=reportingConfig.get("maxBatchSize", 500),
+        max_queue_size=reportingConfig.get("maxQueueSize", 20000),
+        max_tracked=reportingConfig.get("maxTrackedSchedules", 100000),
+        on_dropped=lambda count: reporter_dropped.inc(count),
+    )
+    reporter_dropped = metrics.counter(
+        "sg_scheduler_reporter_dropped_total",
+        "Schedule state updates dropped because the reporter's buffer was full",
+    )
+    metrics.gauge(
+        "sg_scheduler_reporter_pending",
+        "Schedule state updates waiting to be sent to the API",
+        function=schedule_reporter.pending,
+    )
+
+# Schedules with a fire spread window have their launch held back by a fixed offset
+#   within the window so schedules due at the same instant don't all hit the API at once
+fire_spreader = None
+if fireSpreadConfig.get("enabled", False):
+    fire_spreader = FireSpreader(max_workers=executor_threads)
+    metrics.gauge(
+        "sg_scheduler_fire_spread_pending",
+        "Launches held back by fire spreading",
+        function=fire_spreader.pending,
+    )
+
+# Fires missed while no scheduler was running are launched by the catch up engine at
+#   a controlled rate, by each schedule's catchUpPolicy, when the scheduler starts
+#   or takes over as leader - instead of by APScheduler all at once or not at all.
+#   Off unless enabled, which leaves the overdue jobs to APScheduler.
+catch_up = None
+if catchUpConfig.get("enabled", False):
+    catch_up_fires = metrics.counter(
+        "sg_scheduler_catch_up_fires_total",
+        "Fires missed while no scheduler was running, by what was done with them",
+        ["outcome"],
+    )
+    catch_up = CatchUp(
+        lambda scheduled_time, job_id, kwargs: launch_missed_fire(
+            scheduled_time, job_id, kwargs
+        ),
+        enabled=lambda: leader_lease is None or leader_lease.is_leader(),
+        on_fires=lambda outcome, count: catch_up_fires.inc(count, outcome=outcome),
+        default_policy=catchUpConfig.get("defaultPolicy") or None,
+        lookback=catchUpConfig.get("lookbackSeconds", 3600),
+        max_fires_per_schedule=catchUpConfig.get("maxFiresPerSchedule", 100),
+        max_per_second=catchUpConfig.get("maxPerSecond", 10),
+        max_workers=catchUpConfig.get("workers", 4),
+        progress_interval=catchUpConfig.get("progressIntervalSeconds", 10),
+    )
+    metrics.gauge(
+        "sg_scheduler_catch_up_pending",
+        "Missed fires waiting to be launched by the catch up engine",
+        function=catch_up.pending,
+    )
+
+# Repairs jobs left out of step with the API's schedules by lost schedule update
+#   messages - at startup and every intervalSeconds after that, once enabled
+schedule_reconciler = None
+if reconcileConfig.get("enabled", False):
+    # Team the schedules of every team are requested as
+    reconcileTeamId = reconcileConfig.get("adminTeamId")
+    if not reconcileTeamId:
+        raise ValueError(
+            "schedulerReconcile.adminTeamId must be set to the SaaSGlue admin team id"
+            " when reconciliation is enabled"
+        )
+    schedule_reconciler = ScheduleReconciler(
+        lambda after_id, limit: fetch_schedule_page(after_id, limit),
+        lambda schedules, current: reconcile_schedules(schedules, current),
+        lambda: stored_job_ids(),
+        lambda job_ids: remove_reconciled_jobs(job_ids),
+        owns=lambda schedule_id: owns_schedule(schedule_id),
+        enabled=lambda: leader_lease is None or leader_lease.is_leader(),
+        on_pass=lambda counts, seconds: on_reconcile_pass(counts, seconds),
+        page_size=reconcileConfig.get("pageSize", 500),
+        max_pages_per_second=reconcileConfig.get("maxPagesPerSecond", 2),
+        interval=reconcileConfig.get("intervalSeconds", 3600),
+    )
+
+# Started and stopped on a running scheduler with SIGUSR1 or a StartProfiler /
+#   StopProfiler message on the schedule updates queue
+profiler = SamplingProfiler(
+    interval=profilerConfig.get("intervalSeconds", 0.01),
+    max_duration=profilerConfig.get("maxDurationSeconds", 60),
+)
 
 
 def send_email(from_mail, to_email, subject, body):
@@ -153,6 +614,7 @@ def rest_api_call(url, method, _teamId, headers, data={}):
     global apiVersion
 
     http_response_code = ""
+    url_path = url
     try:
         api_url = apiBaseUrl
         if apiPort != "":
@@ -169,16 +631,18 @@ def rest_api_call(url, method, _teamId, headers, data={}):
 
         json_data = json.dumps(data, default=json_serial)
 
-        if method == "POST":
-            res = requests.post(url=url, headers=headers, data=json_data, verify=False)
-        elif method == "PUT":
-            res = requests.put(url=url, headers=headers, data=json_data, verify=False)
-        elif method == "DELETE":
-            res = requests.delete(
-                url=url, headers=headers, data=json_data, verify=False
-            )
-        else:
+        if method not in ["POST", "PUT", "DELETE"]:
             raise Exception("{} method not supported".format(method))
+        started = time.monotonic()
+        try:
+            res = api_client.request(method, url, headers, json_data)
+        except Exception as ex:
+            observe_api_request(method, url_path, "error", started)
+            if not isinstance(ex, CircuitOpenError) and not connection_not_made(ex):
+                # The request may have reached the API before it failed
+                http_response_code = LAUNCH_MAYBE_SENT
+            raise
+        observe_api_request(method, url_path, res.status_code, started)
         http_response_code = res.status_code
         if str(res.status_code)[0] != "2":
             raise Exception(
@@ -200,52 +664,200 @@ def rest_api_call(url, method, _teamId, headers, data={}):
         return [False, http_response_code]
 
 
-def on_launch_job(scheduled_time, job_id, _teamId, targetId, runtimeVars):
-    runtimeVars["scheduled_time"] = {"value": scheduled_time, "sensitive": False}
-    data = {
-        "dateScheduled": scheduled_time,
-        "runtimeVars": runtimeVars,
-        "_scheduleId": job_id,
-    }
-    logInfo(
-        {
-            "msg": "Launching job",
-            "_teamId": _teamId,
-            "_jobDefId": targetId,
-            "date": datetime.now(),
-            "scheduled_time": scheduled_time,
-            "_scheduleId": job_id,
-            "data": data,
-        }
+def rest_api_get(url, _teamId, params={}):
+    """GET from the API and return the data of the response. Unlike rest_api_call
+    failures are raised rather than logged, since the caller can't go on without
+    the data."""
+    api_url = apiBaseUrl
+    if apiPort != "":
+        api_url += ":{}".format(apiPort)
+    query = urlencode({k: v for k, v in params.items() if v is not None})
+    full_url = "{}/api/{}/{}".format(api_url, apiVersion, url)
+    if query:
+        full_url += "?" + query
+    headers = {"Cookie": token, "_teamId": _teamId}
+
+    started = time.monotonic()
+    try:
+        res = api_client.request("GET", full_url, headers)
+    except Exception:
+        observe_api_request("GET", url, "error", started)
+        raise
+    observe_api_request("GET", url, res.status_code, started)
+    if str(res.status_code)[0] != "2":
+        raise Exception(
+            "Call to {} returned {} - {}".format(full_url, res.status_code, res.text)
+        )
+    return res.json()["data"]
+
+
+def observe_api_request(method, url_path, status, started):
+    # Label by the first path segment only - schedule and job ids would give every
+    #   request its own series
+    api_request_duration.observe(
+        time.monotonic() - started,
+        method=method,
+        endpoint=url_path.split("/")[0],
+        status=status,
+    )
+
+
+def fair_share_team_label(_teamId):
+    return _teamId if _teamId in team_quotas else "other"
+
+
+def executor_queue_depth():
+    if isinstance(executors["default"], FairShareExecutor):
+        return executors["default"].queued()
+    pool = getattr(executors["default"], "_pool", None)
+    if pool is None:
+        return 0
+    return pool._work_queue.qsize()
+
+
+def send_schedule_state_batch(_teamId, updates):
+    res = rest_api_call(
+        "schedule/fromscheduler", "PUT", _teamId, {}, {"schedules": updates}
+    )
+    return res[0]
+
+
+def report_schedule_state(job_id, _teamId, state):
+    """Send schedule fields (run dates) back to the API - buffered and sent in
+    batches when the reporter is enabled, otherwise sent immediately"""
+    if schedule_reporter:
+        schedule_reporter.report(job_id, _teamId, state)
+    else:
+        url = "schedule/fromscheduler/{}".format(job_id)
+        rest_api_call(url, "PUT", _teamId, {}, state)
+
+
+def on_launch_job(
+    scheduled_time,
+    job_id,
+    _teamId,
+    targetId,
+    runtimeVars,
+    fireSpreadSeconds=0,
+    catchUpPolicy=None,
+):
+    fire_lateness.observe(time.time() - scheduled_time.timestamp())
+    executor_busy_threads.inc()
+    try:
+        launch_or_defer_job(
+            scheduled_time, job_id, _teamId, targetId, runtimeVars, fireSpreadSeconds
+        )
+    finally:
+        executor_busy_threads.dec()
+
+
+def launch_missed_fire(scheduled_time, job_id, kwargs):
+    # The job's kwargs are shared by all of its missed fires, and launch_job adds
+    #   the scheduled time to the runtime vars
+    launch_job(
+        scheduled_time,
+        job_id,
+        kwargs["_teamId"],
+        kwargs["targetId"],
+        dict(kwargs["runtimeVars"]),
+    )
+
+
+def catch_up_missed_fires():
+    """Hand the fires missed by jobs that are overdue to the catch up engine and
+    move the jobs' next run times past now - called before the scheduler is
+    resumed so APScheduler doesn't run the missed fires itself"""
+    now = datetime.now(utc)
+    try:
+        jobs = jobstores["default"].get_due_jobs(now)
+        fires, next_run_times = catch_up.plan(jobs, now)
+        with job_store_batch():
+            for job_id, next_run_time in next_run_times.items():
+                try:
+                    if next_run_time is None:
+                        job_scheduler.remove_job(job_id)
+                    else:
+                        job_scheduler.modify_job(job_id, next_run_time=next_run_time)
+                except JobLookupError:
+                    pass
+    except Exception as ex:
+        # The scheduler runs the overdue jobs itself as before
+        logError({"msg": str(ex), "Method": "catch_up_missed_fires"})
+        return
+    catch_up.release(fires)
+
+
+def launch_or_defer_job(
+    scheduled_time, job_id, _teamId, targetId, runtimeVars, fireSpreadSeconds
+):
+    deadline = launch_deadline(job_id, scheduled_time)
+    if fireSpreadSeconds and fire_spreader:
+        # Only the launch moves within the window - the job is still launched with
+        #   its nominal scheduled time
+        release_at = scheduled_time.timestamp() + spread_offset(
+            job_id, fireSpreadSeconds
+        )
+        if fire_spreader.defer(
+            release_at,
+            launch_job,
+            scheduled_time,
+            job_id,
+            _teamId,
+            targetId,
+            runtimeVars,
+            deadline,
+        ):
+            return
+    launch_job(scheduled_time, job_id, _teamId, targetId, runtimeVars, deadline)
+
+
+def launch_job(scheduled_time, job_id, _teamId, targetId, runtimeVars, deadline=None):
+    launch_lateness.observe(time.time() - scheduled_time.timestamp())
+    res = send_launch(scheduled_time, job_id, _teamId, targetId, runtimeVars, deadline)
+    if res is None:
+        return
+    args = (scheduled_time, job_id, _teamId, targetId, runtimeVars)
+    if isinstance(res, futures.Future):
+        # Queued for the launch concurrency limit - the bookkeeping follows once
+        #   it's been sent or given up on
+        res.add_done_callback(
+            lambda sent: queue_after_launch(launch_result(sent), *args)
+        )
+    else:
+        queue_after_launch(res, *args)
+
+
+def queue_after_launch(res, scheduled_time, job_id, _teamId, targetId, runtimeVars):
+    bookkeeping_lanes.submit(
+        job_id,
+        after_launch,
+        res,
+        scheduled_time,
+        job_id,
+        _teamId,
+        targetId,
+        runtimeVars,
     )
-    res = rest_api_call("job", "POST", _teamId, {"_jobDefId": targetId}, data)
 
+
+def after_launch(res, scheduled_time, job_id, _teamId, targetId, runtimeVars):
+    """Bookkeeping that follows a launch, run on the schedule's bookkeeping lane"""
     updateSchedule = True
     if not res[0]:
-        if res[1] == 404:
-            updateSchedule = False
-            # job_scheduler.remove_job(job_id)
-            logInfo(
-                {
-                    "msg": "Job does not exist - deleting schedule",
-                    "_teamId": _teamId,
-                    "_jobDefId": targetId,
-                    "date": datetime.now(),
-                    "_scheduleId": job_id,
-                }
+        if retryable_launch_failure(res[1]):
+            record_failed_launch(
+                scheduled_time, job_id, _teamId, targetId, runtimeVars, res[1]
             )
-            res = rest_api_call("schedule/{}".format(job_id), "DELETE", _teamId, {}, {})
+        else:
+            updateSchedule = not launch_refused(res, job_id, _teamId, targetId)
 
     if updateSchedule:
         job = job_scheduler.get_job(job_id)
 
         if job:
-            url = "schedule/fromscheduler/{}".format(job_id)
-            rest_api_call(
-                url,
-                "PUT",
+            report_schedule_state(
+                job_id,
                 _teamId,
-                {},
                 {
                     "lastScheduledRunDate": scheduled_time,
                     "nextScheduledRunDate": job.next_run_time,
@@ -254,7 +866,6 @@ def on_launch_job(scheduled_time, job_id, _teamId, targetId, runtimeVars):
             logInfo(
                 {
                     "msg": "Updating job info 1",
-                    "url": url,
                     "job_id": job_id,
                     "lastScheduledRunDate": scheduled_time,
                     "nextScheduledRunDate": job.next_run_time,
@@ -275,381 +886,650 @@ def on_launch_job(scheduled_time, job_id, _teamId, targetId, runtimeVars):
             res = rest_api_call("schedule/{}".format(job_id), "DELETE", _teamId, {}, {})
 
 
-def parse_job_interval(job):
-    weeks = job["weeks"] if "weeks" in job else 0
-    days = job["days"] if "days" in job else 0
-    hours = job["hours"] if "hours" in job else 0
-    minutes = job["minutes"] if "minutes" in job else 0
-    seconds = job["seconds"] if "seconds" in job else 0
-    interval = timedelta_seconds(
-        timedelta(weeks=weeks, days=days, hours=hours, minutes=minutes, seconds=seconds)
+def send_launch(scheduled_time, job_id, _teamId, targetId, runtimeVars, deadline=None):
+    """POST a launch to the API, or publish it with the amqp launch transport.
+    Returns [ok, status] like rest_api_call, a Future of it for a POST queued for
+    the launch concurrency limit, or None if this instance isn't the scheduler
+    leader. A POST that's still waiting for the limit at deadline isn't sent."""
+    headers = {"_jobDefId": targetId}
+    if leader_lease:
+        # The API refuses launches carrying a fencing token older than the current
+        #   lease's, so a leader that was replaced without noticing can't launch
+        fencing_token = leader_lease.fencing_token()
+        if fencing_token is None:
+            logWarning(
+                {
+                    "msg": "Not the scheduler leader - skipping launch",
+                    "_teamId": _teamId,
+                    "_scheduleId": job_id,
+                    "scheduled_time": scheduled_time,
+                }
+            )
+            return None
+        headers["schedulerFencingToken"] = str(fencing_token)
+    if membership:
+        # While ownership of the schedule moves between instances, the instance
+        #   taking it over waits for the previous owner to let go of it
+        wait = clusterConfig.get("handoffWaitSeconds", 10)
+        if deadline is not None:
+            wait = min(wait, deadline.timestamp() - time.time())
+        fenced = membership.wait_unfenced(job_id, max(wait, 0))
+        if fenced:
+            launch_fenced.inc(reason=fenced)
+            logWarning(
+                {
+                    "msg": "Schedule fenced by the cluster ring - skipping launch",
+                    "reason": fenced,
+                    "_teamId": _teamId,
+                    "_scheduleId": job_id,
+                    "scheduled_time": scheduled_time,
+                }
+            )
+            return None
+
+    runtimeVars["scheduled_time"] = {"value": scheduled_time, "sensitive": False}
+    data = {
+        "dateScheduled": scheduled_time,
+        "runtimeVars": runtimeVars,
+        "_scheduleId": job_id,
+    }
+    logInfo(
+        {
+            "msg": "Launching job",
+            "_teamId": _teamId,
+            "_jobDefId": targetId,
+            "date": datetime.now(),
+            "scheduled_time": scheduled_time,
+            "_scheduleId": job_id,
+            "data": data,
+        }
+    )
+    if launch_publisher:
+        return publish_launch(_teamId, headers, data)
+    launches.inc(transport="rest")
+    return post_launch(scheduled_time, deadline, _teamId, headers, data)
+
+
+def post_launch(scheduled_time, deadline, _teamId, headers, data):
+    """POST a launch to the API - returns [ok, status] like rest_api_call. With the
+    launch concurrency limit the launch is queued for the limit instead and a
+    Future of [ok, status] returned, so no executor thread waits for a slot."""
+    if not launch_limiter:
+        return send_post_launch(_teamId, headers, data)
+    sent = launch_limiter.submit(
+        scheduled_time.timestamp(),
+        deadline.timestamp() if deadline else None,
+        send_post_launch,
+        _teamId,
+        headers,
+        data,
+        ok=launch_went_through,
+    )
+    sent.add_done_callback(
+        lambda sent: launch_limit_missed(sent, scheduled_time, _teamId, data)
+    )
+    return sent
+
+
+def send_post_launch(_teamId, headers, data):
+    res = rest_api_call("job", "POST", _teamId, headers, data)
+    launch_maybe_sent(res, data, "rest")
+    return res
+
+
+def launch_went_through(res):
+    # A request the API answered with a client error still went through quickly
+    return res[0] or (isinstance(res[1], int) and res[1] < 500 and res[1] != 429)
+
+
+def launch_limit_missed(sent, scheduled_time, _teamId, data):
+    if not isinstance(sent.exception(), LimitExpired):
+        return
+    launch_limit_expired.inc()
+    logWarning(
+        {
+            "msg": "Misfire deadline passed waiting for the launch concurrency limit",
+            "_teamId": _teamId,
+            "_scheduleId": data["_scheduleId"],
+            "scheduled_time": scheduled_time,
+            "limit": launch_limiter.limit(),
+        }
     )
-    return interval
 
 
-def interval_schedule_changed(existing_job, job):
-    interval = parse_job_interval(job)
-    if existing_job.trigger.interval_length != interval:
-        return True
-    if (
-        existing_job.trigger.start_date != job["start_date"]
-        if "start_date" in job
-        else ""
+def launch_result(res):
+    """[ok, status] of a launch - waits for one queued for the launch concurrency
+    limit, which gives [False, None] if it was given up on before it was sent"""
+    if not isinstance(res, futures.Future):
+        return res
+    try:
+        return res.result()
+    except LimitExpired:
+        return [False, None]
+    except Exception as ex:
+        # Not known to have been sent or not, so not retried
+        logError({"msg": str(ex), "Method": "launch_result"})
+        return [False, LAUNCH_MAYBE_SENT]
+
+
+def retryable_launch_failure(status):
+    """Whether a failed launch may go through if sent again - it never reached the
+    API (the API couldn't be reached or its circuit was open) or the API turned it
+    away with a 429. A launch the API may have acted on - it timed out, dropped
+    the connection or had a server error - isn't retryable."""
+    return status in ("", None) or status == 429
+
+
+def launch_maybe_sent(res, data, transport):
+    """Count and log a launch POST that failed after the API may have acted on it,
+    and return whether it did"""
+    status = res[1]
+    if res[0] or not (
+        status == LAUNCH_MAYBE_SENT or (isinstance(status, int) and status >= 500)
     ):
+        return False
+    launches_maybe_sent.inc(transport=transport)
+    logError(
+        {
+            "msg": "Launch failed after it may have reached the API - not retrying it",
+            "Method": "launch_maybe_sent",
+            "_scheduleId": data["_scheduleId"],
+            "status": status,
+        }
+    )
+    return True
+
+
+def launch_refused(res, job_id, _teamId, targetId):
+    """Handle a launch the API refused - the schedule's job no longer exists, or
+    this instance is no longer the scheduler leader. Returns False for any other
+    failure."""
+    if res[1] == 403 and leader_lease:
+        logWarning(
+            {
+                "msg": "Launch refused - no longer the scheduler leader",
+                "_teamId": _teamId,
+                "_scheduleId": job_id,
+            }
+        )
         return True
-    if existing_job.trigger.end_date != job["end_date"] if "end_date" in job else "":
-        return True
-    if existing_job.trigger.tzinfo != job["tzinfo"] if "tzinfo" in job else "":
-        return True
-    if existing_job.trigger.jitter != job["jitter"] if "jitter" in job else "":
+    if res[1] == 404:
+        # job_scheduler.remove_job(job_id)
+        logInfo(
+            {
+                "msg": "Job does not exist - deleting schedule",
+                "_teamId": _teamId,
+                "_jobDefId": targetId,
+                "date": datetime.now(),
+                "_scheduleId": job_id,
+            }
+        )
+        rest_api_call("schedule/{}".format(job_id), "DELETE", _teamId, {}, {})
         return True
     return False
 
 
-def cron_schedule_changed(existing_job, job):
-    for i in range(len(existing_job.trigger.FIELD_NAMES)):
-        current_value = existing_job.trigger.fields[i]
-        field_name = existing_job.trigger.FIELD_NAMES[i]
-        schedule_value = None
-        if field_name in job:
-            schedule_value = job[field_name]
-        if not current_value.is_default and schedule_value != None:
-            if str(current_value) != str(schedule_value):
-                return True
-        elif not current_value.is_default or schedule_value != None:
-            return True
-    return False
+def record_failed_launch(
+    scheduled_time, job_id, _teamId, targetId, runtimeVars, status
+):
+    """Put a launch that failed in the launch outbox to be retried until the
+    schedule's misfire grace time has passed"""
+    if not launch_outbox:
+        return
+    try:
+        recorded = launch_outbox.add(
+            job_id,
+            scheduled_time,
+            launch_deadline(job_id, scheduled_time),
+            {"_teamId": _teamId, "targetId": targetId, "runtimeVars": runtimeVars},
+            error="Launch failed with status {}".format(status or "none"),
+        )
+    except Exception as ex:
+        logError(
+            {
+                "msg": "Unable to record failed launch - it won't be retried",
+                "Method": "record_failed_launch",
+                "_scheduleId": job_id,
+                "scheduled_time": scheduled_time,
+                "error": str(ex),
+            }
+        )
+        return
+    launch_outbox_entries.inc(outcome="recorded" if recorded else "expired")
+
+
+def launch_deadline(job_id, scheduled_time):
+    """Time after which a launch is given up on - once the schedule's misfire grace
+    time has passed"""
+    job = job_scheduler.get_job(job_id)
+    grace_seconds = job.misfire_grace_time if job else None
+    if grace_seconds is None:
+        grace_seconds = launchOutboxConfig.get("defaultDeadlineSeconds", 3600)
+    return scheduled_time + timedelta(seconds=grace_seconds)
+
+
+def retry_launch(entry):
+    """Send a launch from the launch outbox again, with its nominal scheduled time"""
+    args = entry["args"]
+    res = launch_result(
+        send_launch(
+            entry["scheduled_time"],
+            entry["schedule_id"],
+            args["_teamId"],
+            args["targetId"],
+            args["runtimeVars"],
+            entry["deadline"],
+        )
+    )
+    if res is None or (not res[0] and retryable_launch_failure(res[1])):
+        return "retry"
+    if not res[0]:
+        launch_refused(res, entry["schedule_id"], args["_teamId"], args["targetId"])
+        return "dropped"
+    return "launched"
+
+
+def publish_launch(_teamId, headers, data):
+    """Send a launch through the launch queue - returns [ok, status] like
+    rest_api_call, with LAUNCH_MAYBE_SENT as the status of a launch RabbitMQ didn't
+    confirm. A launch RabbitMQ didn't take is POSTed to the API instead. The
+    API deletes the schedule of a launch for a missing job itself, so no 404 comes
+    back this way."""
+    message = {"_teamId": _teamId, "_jobDefId": headers["_jobDefId"], "data": data}
+    if "schedulerFencingToken" in headers:
+        message["schedulerFencingToken"] = headers["schedulerFencingToken"]
+    try:
+        launch_publisher.publish(json.dumps(message, default=json_serial)).result(
+            timeout=launchConfig.get("confirmTimeoutSeconds", 10)
+        )
+        launches.inc(transport="amqp")
+        return [True, 202]
+    except PublishError as ex:
+        if ex.sent is False:
+            logWarning(
+                {
+                    "msg": "Launch not published - posting it to the API",
+                    "Method": "publish_launch",
+                    "_scheduleId": data["_scheduleId"],
+                    "error": str(ex),
+                }
+            )
+            launches.inc(transport="rest")
+            res = rest_api_call("job", "POST", _teamId, headers, data)
+            launch_maybe_sent(res, data, "rest")
+            return res
+        error = str(ex)
+    except futures.TimeoutError:
+        error = "Timed out waiting for RabbitMQ to confirm the launch"
+    # The launch may still have been queued - posting it as well could launch the
+    #   job twice
+    launches_maybe_sent.inc(transport="amqp")
+    logError(
+        {
+            "msg": "Launch not confirmed - it may or may not run",
+            "Method": "publish_launch",
+            "_scheduleId": data["_scheduleId"],
+            "error": error,
+        }
+    )
+    return [False, LAUNCH_MAYBE_SENT]
+
+
+def fire_spread_window(spec):
+    """Width of the window in seconds over which a schedule's launches are spread -
+    0 unless fire spreading is enabled. Launches are never held back past the
+    schedule's misfire grace time."""
+    if not fire_spreader:
+        return 0
+    window = fireSpreadConfig.get("defaultWindowSeconds", 0)
+    if spec.fire_spread_seconds is not None:
+        window = spec.fire_spread_seconds
+    window = min(float(window), fireSpreadConfig.get("maxWindowSeconds", 60))
+    if spec.misfire_grace_time is not None:
+        window = min(window, float(spec.misfire_grace_time))
+    return max(window, 0)
+
+
+def schedule_spec_and_trigger(msg):
+    """Decode an UpdateJob schedule and build its trigger"""
+    spec = ScheduleSpec.from_message(msg)
+
+    fire_spread_seconds = fire_spread_window(spec)
+    if fire_spread_seconds:
+        spec.function_kwargs["fireSpreadSeconds"] = fire_spread_seconds
+    else:
+        spec.function_kwargs.pop("fireSpreadSeconds", None)
+    if spec.catch_up_policy:
+        spec.function_kwargs["catchUpPolicy"] = spec.catch_up_policy
+    else:
+        spec.function_kwargs.pop("catchUpPolicy", None)
+
+    return spec, spec.build_trigger(trigger_cache)
+
+
+def apply_schedule_spec(spec, trigger, first_run_time=undefined):
+    """Add or update the internal job for a decoded schedule. first_run_time is the
+    trigger's next fire time when it's already known - the job's next run time if it
+    is added or rescheduled. Otherwise the trigger computes it."""
+    global job_scheduler
 
+    job = job_scheduler.get_job(spec.id)
+    if not job:
+        job_kwargs = spec.job_kwargs()
+        if not spec.use_next_run_time:
+            job_kwargs["next_run_time"] = first_run_time
+        job_scheduler.add_job(
+            on_launch_job, trigger, name=spec.name, id=spec.id, **job_kwargs
+        )
+        return
 
-def date_schedule_changed(existing_job, job):
-    if existing_job.trigger.run_date != job["run_date"] if "run_date" in job else "":
-        return True
-    return False
+    if not spec.use_next_run_time and (
+        (not job.next_run_time and spec.is_active)
+        or spec.trigger_changed(job.trigger, trigger)
+    ):
+        if first_run_time is undefined:
+            job_scheduler.reschedule_job(spec.id, trigger=trigger)
+        else:
+            job_scheduler.modify_job(
+                spec.id, trigger=trigger, next_run_time=first_run_time
+            )
+    if (
+        not spec.use_next_run_time
+        or job.misfire_grace_time != spec.misfire_grace_time
+        or job.next_run_time != spec.next_run_time
+    ):
+        job_scheduler.modify_job(spec.id, **spec.job_kwargs())
+
+
+def apply_schedule_update(msg):
+    """Add or update the internal job for a schedule from an UpdateJob message"""
+    spec, trigger = schedule_spec_and_trigger(msg)
+    apply_schedule_spec(spec, trigger)
+
+
+def job_store_batch():
+    """Collect job store writes made inside the block into one bulk write"""
+    job_store = jobstores["default"]
+    if isinstance(job_store, CachedJobStore):
+        return job_store.batch()
+    return nullcontext()
+
+
+def schedule_error(schedule, ex):
+    """Log a schedule from an UpdateJobs message that couldn't be applied, pause its
+    job and return its result for the API"""
+    logError(
+        {
+            "msg": str(ex),
+            "Method": "apply_schedule_updates",
+            "schedule": schedule,
+        }
+    )
+    try:
+        if "id" in schedule and job_scheduler.get_job(schedule["id"]):
+            job_scheduler.pause_job(schedule["id"])
+    except Exception as pause_ex:
+        logError(
+            {
+                "msg": "Unable to pause job: {}".format(pause_ex),
+                "Method": "schedule_error",
+                "_scheduleId": schedule.get("id"),
+            }
+        )
+    return {
+        "id": schedule.get("id"),
+        "scheduleError": str(ex),
+        "isActive": False,
+        "nextScheduledRunDate": None,
+    }
 
 
-def schedule_changed(existing_job, job):
+def apply_schedule_updates(msg):
+    """Apply an UpdateJobs message - a batch of UpdateJob schedules for one team - and
+    report the result for every schedule in a single call back to the API.
+
+    The first run times of the whole batch are computed together by next_fire_times
+    rather than by each trigger as its job is added or rescheduled."""
+    global job_scheduler
+
+    results = [None] * len(msg["jobs"])
+    updates = []
+    for index, schedule in enumerate(msg["jobs"]):
+        try:
+            updates.append((index, schedule) + schedule_spec_and_trigger(schedule))
+        except Exception as ex:
+            results[index] = schedule_error(schedule, ex)
+
+    fire_times = next_fire_times(
+        [trigger for _, _, _, trigger in updates], datetime.now(utc)
+    )
+    try:
+        with schedule_update_guard(
+            [schedule.get("id") for schedule in msg["jobs"]]
+        ), job_store_batch():
+            for (index, schedule, spec, trigger), times in zip(updates, fire_times):
+                try:
+                    apply_schedule_spec(spec, trigger, times[0] if times else None)
+                    results[index] = {"id": spec.id}
+                except Exception as ex:
+                    results[index] = schedule_error(schedule, ex)
+    except Exception as ex:
+        # The batch's writes didn't reach the job store and its jobs are back to
+        #   their stored state - every schedule in it is reported as failed
+        for index, schedule, _, _ in updates:
+            if results[index] is None or "scheduleError" not in results[index]:
+                results[index] = schedule_error(schedule, ex)
+
+    for result in results:
+        if "scheduleError" not in result:
+            job = job_scheduler.get_job(result["id"])
+            result["nextScheduledRunDate"] = job.next_run_time if job else None
+
+    rest_api_call(
+        "schedule/fromscheduler", "PUT", msg["_teamId"], {}, {"schedules": results}
+    )
+    logInfo(
+        {
+            "msg": "Updating job info for batch",
+            "_teamId": msg["_teamId"],
+            "count": len(results),
+        }
+    )
+
+
+def fetch_schedule_page(after_id, limit):
+    return rest_api_get(
+        "schedule/forscheduler",
+        reconcileTeamId,
+        {"afterId": after_id, "limit": limit},
+    )
+
+
+def schedule_drift(spec, trigger, job, first_run_time, now):
+    """How a schedule's job differs from the schedule - added if it's missing,
+    changed if anything it was built from is different, otherwise unchanged"""
+    if job is None:
+        # APScheduler removes a job once its trigger has no more fire times, so
+        #   a finished schedule has no job
+        if first_run_time is None or (
+            spec.trigger_type == "date" and first_run_time <= now
+        ):
+            return "unchanged"
+        return "added"
     if (
-        schedule_trigger_type_to_string[type(existing_job.trigger)]
-        != job["TriggerType"]
+        spec.trigger_changed(job.trigger, trigger)
+        or job.misfire_grace_time != spec.misfire_grace_time
+        or job.coalesce != asbool(spec.coalesce)
+        or job.max_instances != spec.max_instances
+        or job.kwargs != spec.function_kwargs
     ):
-        return True
+        return "changed"
+    if spec.is_active:
+        if job.next_run_time is None and first_run_time is not None:
+            return "changed"
+    elif job.next_run_time is not None:
+        return "changed"
+    return "unchanged"
+
+
+def schedule_update_guard(schedule_ids):
+    """Context to apply an update message to schedules in, so reconciliation
+    doesn't overwrite the update with a version of the schedules fetched before
+    it"""
+    if schedule_reconciler:
+        return schedule_reconciler.updating(schedule_ids)
+    return nullcontext()
+
+
+def reconcile_schedules(schedules, current):
+    """Compare schedules from the API with their jobs and apply the ones that
+    differ, with the first run times of the batch computed together. A schedule
+    updated by a message since it was fetched is skipped. Returns the outcome for
+    each schedule id."""
+    outcomes = {}
+    updates = []
+    for schedule in schedules:
+        try:
+            updates.append((schedule,) + schedule_spec_and_trigger(schedule))
+        except Exception as ex:
+            outcomes[schedule["id"]] = "error"
+            report_reconcile_error(schedule, ex)
+
+    now = datetime.now(utc)
+    fire_times = next_fire_times([trigger for _, _, trigger in updates], now)
+    with job_store_batch():
+        for (schedule, spec, trigger), times in zip(updates, fire_times):
+            first_run_time = times[0] if times else None
+            try:
+                with current(spec.id) as is_current:
+                    if not is_current:
+                        outcomes[spec.id] = "skipped"
+                        continue
+                    job = job_scheduler.get_job(spec.id)
+                    outcome = schedule_drift(spec, trigger, job, first_run_time, now)
+                    if outcome != "unchanged":
+                        apply_schedule_spec(spec, trigger, first_run_time)
+                        job = job_scheduler.get_job(spec.id)
+                outcomes[spec.id] = outcome
+                if outcome != "unchanged":
+                    report_schedule_state(
+                        spec.id,
+                        schedule["_teamId"],
+                        {"nextScheduledRunDate": job.next_run_time if job else None},
+                    )
+            except Exception as ex:
+                outcomes[spec.id] = "error"
+                report_reconcile_error(schedule, ex)
+    return outcomes
+
+
+def report_reconcile_error(schedule, ex):
+    result = schedule_error(schedule, ex)
+    report_schedule_state(result.pop("id"), schedule["_teamId"], result)
+
+
+def stored_job_ids():
+    """Ids of the jobs in the job store - from the job cache without restoring
+    the jobs it hasn't needed yet"""
+    job_store = jobstores["default"]
+    if isinstance(job_store, CachedJobStore):
+        return job_store.job_ids()
+    return [job.id for job in job_scheduler.get_jobs()]
+
+
+def remove_reconciled_jobs(job_ids):
+    """Remove the jobs of schedules that were deleted in the API"""
+    with job_store_batch():
+        for job_id in job_ids:
+            try:
+                job_scheduler.remove_job(job_id)
+            except JobLookupError:
+                pass
+    logWarning(
+        {
+            "msg": "Removed jobs of deleted schedules",
+            "Method": "remove_reconciled_jobs",
+            "job_ids": job_ids,
+        }
+    )
 
-    if not existing_job.next_run_time and job["isActive"]:
-        return True
 
-    if schedule_trigger_type_to_string[type(existing_job.trigger)] == "cron":
-        if cron_schedule_changed(existing_job, job):
-            return True
-    elif schedule_trigger_type_to_string[type(existing_job.trigger)] == "interval":
-        if interval_schedule_changed(existing_job, job):
-            return True
-    elif schedule_trigger_type_to_string[type(existing_job.trigger)] == "date":
-        if date_schedule_changed(existing_job, job):
-            return True
+def on_reconcile_pass(counts, seconds):
+    reconcile_passes.inc()
+    reconcile_pass_seconds.set(seconds)
+    for kind in ("added", "changed", "removed", "error"):
+        if counts[kind]:
+            reconcile_drift.inc(counts[kind], kind=kind)
+    log = logWarning if counts["added"] or counts["changed"] else logInfo
+    log(
+        {
+            "msg": "Reconciled schedules with the API",
+            "Method": "on_reconcile_pass",
+            "counts": counts,
+            "seconds": round(seconds, 3),
+        }
+    )
+
 
-    return False
+def owns_schedule(schedule_id):
+    return membership is None or membership.owns(schedule_id)
 
 
 def on_message(delivery_tag, body, async_consumer):
     global job_scheduler
 
+    msg = {}
     try:
-        msg = json.loads(body)
+        msg = decode_message(body)
 
         # job_scheduler.print_jobs()
 
-        if msg["Action"] == "UpdateJob":
-            misfire_grace_time = None
-            if "misfire_grace_time" in msg and msg["misfire_grace_time"] != "":
-                misfire_grace_time = msg["misfire_grace_time"]
-
-            coalesce = None
-            if "coalesce" in msg and msg["coalesce"] != "":
-                coalesce = msg["coalesce"]
-
-            max_instances = 10
-            if "max_instances" in msg and msg["max_instances"] != "":
-                max_instances = msg["max_instances"]
-
-            useNextRunTime = False
-            next_run_time = None
-            if "next_run_time" in msg and msg["next_run_time"] != "":
-                useNextRunTime = True
-                if "next_run_time" == "None":
-                    next_run_time = None
-                else:
-                    next_run_time = msg["next_run_time"]
-
-            isActive = True
-            if "isActive" in msg:
-                isActive = msg["isActive"]
-            if not isActive:
-                useNextRunTime = True
-                next_run_time = None
-
-            run_date = None
-            year = None
-            month = None
-            day = None
-            week = None
-            day_of_week = None
-            hour = None
-            minute = None
-            second = None
-            weeks = 0
-            days = 0
-            hours = 0
-            minutes = 0
-            seconds = 0
-            start_date = None
-            end_date = None
-            jitter = None
-            timezone = utc
-
-            if msg["TriggerType"] == "date":
-                if "RunDate" in msg:
-                    run_date = msg["RunDate"]
-            elif msg["TriggerType"] == "cron":
-                if "Year" in msg["cron"] and msg["cron"]["Year"] != "":
-                    year = msg["cron"]["Year"]
-                if "Month" in msg["cron"] and msg["cron"]["Month"] != "":
-                    month = msg["cron"]["Month"]
-                if "Day" in msg["cron"] and msg["cron"]["Day"] != "":
-                    day = msg["cron"]["Day"]
-                if "Week" in msg["cron"] and msg["cron"]["Week"] != "":
-                    week = msg["cron"]["Week"]
-                if "Day_Of_Week" in msg["cron"] and msg["cron"]["Day_Of_Week"] != "":
-                    day_of_week = msg["cron"]["Day_Of_Week"]
-                if "Hour" in msg["cron"] and msg["cron"]["Hour"] != "":
-                    hour = msg["cron"]["Hour"]
-                if "Minute" in msg["cron"] and msg["cron"]["Minute"] != "":
-                    minute = msg["cron"]["Minute"]
-                if "Second" in msg["cron"] and msg["cron"]["Second"] != "":
-                    second = msg["cron"]["Second"]
-                if "Start_Date" in msg["cron"] and msg["cron"]["Start_Date"]:
-                    start_date = msg["cron"]["Start_Date"]
-                if "End_Date" in msg["cron"] and msg["cron"]["End_Date"]:
-                    end_date = msg["cron"]["End_Date"]
-                if "Jitter" in msg["cron"] and msg["cron"]["Jitter"] != "":
-                    jitter = int(msg["cron"]["Jitter"])
-                if "Timezone" in msg["cron"] and msg["cron"]["Timezone"] != "":
-                    timezone = msg["cron"]["Timezone"]
-            elif msg["TriggerType"] == "interval":
-                if "Weeks" in msg["interval"] and msg["interval"]["Weeks"] != "":
-                    weeks = int(msg["interval"]["Weeks"])
-                if "Days" in msg["interval"] and msg["interval"]["Days"] != "":
-                    days = int(msg["interval"]["Days"])
-                if "Hours" in msg["interval"] and msg["interval"]["Hours"] != "":
-                    hours = int(msg["interval"]["Hours"])
-                if "Minutes" in msg["interval"] and msg["interval"]["Minutes"] != "":
-                    minutes = int(msg["interval"]["Minutes"])
-                if "Seconds" in msg["interval"] and msg["interval"]["Seconds"] != "":
-                    seconds = int(msg["interval"]["Seconds"])
-                if "Start_Date" in msg["interval"] and msg["interval"]["Start_Date"]:
-                    start_date = msg["interval"]["Start_Date"]
-                if "End_Date" in msg["interval"] and msg["interval"]["End_Date"]:
-                    end_date = msg["interval"]["End_Date"]
-                if "Jitter" in msg["interval"] and msg["interval"]["Jitter"] != "":
-                    jitter = int(msg["interval"]["Jitter"])
-
-            if (
-                "runtimeVars" not in msg["FunctionKwargs"]
-                or msg["FunctionKwargs"]["runtimeVars"] == ""
-            ):
-                msg["FunctionKwargs"]["runtimeVars"] = {}
-
-            job = job_scheduler.get_job(msg["id"])
-            if job:
-                changeTypes = []
-                if schedule_changed(job, msg):
-                    changeTypes.append("schedule")
-                if (
-                    job.misfire_grace_time != misfire_grace_time
-                    or (not useNextRunTime and hasattr(job, "next_run_time"))
-                    or job.next_run_time != next_run_time
-                ):
-                    changeTypes.append("job")
-                if not useNextRunTime and "schedule" in changeTypes:
-                    # print('schedule change')
-                    if msg["TriggerType"] == "cron":
-                        job_scheduler.reschedule_job(
-                            msg["id"],
-                            trigger="cron",
-                            year=year,
-                            month=month,
-                            day=day,
-                            week=week,
-                            day_of_week=day_of_week,
-                            hour=hour,
-                            minute=minute,
-                            second=second,
-                            start_date=start_date,
-                            end_date=end_date,
-                            timezone=timezone,
-                            jitter=jitter,
-                        )
-                    elif msg["TriggerType"] == "interval":
-                        job_scheduler.reschedule_job(
-                            msg["id"],
-                            trigger="interval",
-                            weeks=weeks,
-                            days=days,
-                            hours=hours,
-                            minutes=minutes,
-                            seconds=seconds,
-                            start_date=start_date,
-                            end_date=end_date,
-                            jitter=jitter,
-                        )
-                    elif msg["TriggerType"] == "date":
-                        job_scheduler.reschedule_job(
-                            msg["id"], trigger="date", run_date=run_date
-                        )
-                if "job" in changeTypes:
-                    # print('job change')
-                    if useNextRunTime:
-                        job_scheduler.modify_job(
-                            msg["id"],
-                            misfire_grace_time=misfire_grace_time,
-                            coalesce=coalesce,
-                            next_run_time=next_run_time,
-                            max_instances=max_instances,
-                            kwargs=msg["FunctionKwargs"],
-                        )
-                    else:
-                        job_scheduler.modify_job(
-                            msg["id"],
-                            misfire_grace_time=misfire_grace_time,
-                            coalesce=coalesce,
-                            max_instances=max_instances,
-                            kwargs=msg["FunctionKwargs"],
-                        )
-            else:
-                if msg["TriggerType"] == "cron":
-                    if useNextRunTime:
-                        job_scheduler.add_job(
-                            on_launch_job,
-                            "cron",
-                            name=msg["name"],
-                            id=msg["id"],
-                            misfire_grace_time=misfire_grace_time,
-                            coalesce=coalesce,
-                            next_run_time=next_run_time,
-                            max_instances=max_instances,
-                            year=year,
-                            month=month,
-                            day=day,
-                            week=week,
-                            day_of_week=day_of_week,
-                            hour=hour,
-                            minute=minute,
-                            second=second,
-                            start_date=start_date,
-                            end_date=end_date,
-                            timezone=timezone,
-                            jitter=jitter,
-                            kwargs=msg["FunctionKwargs"],
-                        )
-                    else:
-                        job_scheduler.add_job(
-                            on_launch_job,
-                            "cron",
-                            name=msg["name"],
-                            id=msg["id"],
-                            misfire_grace_time=misfire_grace_time,
-                            coalesce=coalesce,
-                            max_instances=max_instances,
-                            year=year,
-                            month=month,
-                            day=day,
-                            week=week,
-                            day_of_week=day_of_week,
-                            hour=hour,
-                            minute=minute,
-                            second=second,
-                            start_date=start_date,
-                            end_date=end_date,
-                            timezone=timezone,
-                            jitter=jitter,
-                            kwargs=msg["FunctionKwargs"],
-                        )
-
-                elif msg["TriggerType"] == "interval":
-                    if useNextRunTime:
-                        job_scheduler.add_job(
-                            on_launch_job,
-                            "interval",
-                            name=msg["name"],
-                            id=msg["id"],
-                            misfire_grace_time=misfire_grace_time,
-                            coalesce=coalesce,
-                            next_run_time=next_run_time,
-                            max_instances=max_instances,
-                            weeks=weeks,
-                            days=days,
-                            hours=hours,
-                            minutes=minutes,
-                            seconds=seconds,
-                            start_date=start_date,
-                            end_date=end_date,
-                            jitter=jitter,
-                            kwargs=msg["FunctionKwargs"],
-                        )
-                    else:
-                        job_scheduler.add_job(
-                            on_launch_job,
-                            "interval",
-                            name=msg["name"],
-                            id=msg["id"],
-                            misfire_grace_time=misfire_grace_time,
-                            coalesce=coalesce,
-                            max_instances=max_instances,
-                            weeks=weeks,
-                            days=days,
-                            hours=hours,
-                            minutes=minutes,
-                            seconds=seconds,
-                            start_date=start_date,
-                            end_date=end_date,
-                            jitter=jitter,
-                            kwargs=msg["FunctionKwargs"],
-                        )
-
-                elif msg["TriggerType"] == "date":
-                    job_scheduler.add_job(
-                        on_launch_job,
-                        "date",
-                        name=msg["name"],
-                        id=msg["id"],
-                        misfire_grace_time=misfire_grace_time,
-                        coalesce=coalesce,
-                        max_instances=max_instances,
-                        run_date=run_date,
-                        kwargs=msg["FunctionKwargs"],
-                    )
-        elif msg["Action"] == "PauseJob":
-            job_scheduler.pause_job(msg["id"])
-        elif msg["Action"] == "ResumeJob":
-            job_scheduler.resume_job(msg["id"])
-        elif msg["Action"] == "RemoveJob":
-            job = job_scheduler.get_job(msg["id"])
-            if job:
-                job_scheduler.remove_job(job.id)
+        if msg["Action"] == "StartProfiler":
+            profiler.start(msg.get("durationSeconds"))
+            async_consumer.acknowledge_message(delivery_tag)
+            return
+
+        if msg["Action"] == "StopProfiler":
+            profiler.stop()
+            async_consumer.acknowledge_message(delivery_tag)
+            return
+
+        if msg["Action"] == "UpdateJobs":
+            msg["jobs"] = [s for s in msg["jobs"] if owns_schedule(s.get("id"))]
+            if msg["jobs"]:
+                apply_schedule_updates(msg)
+            async_consumer.acknowledge_message(delivery_tag)
+            return
+
+        if not owns_schedule(msg["id"]):
+            async_consumer.acknowledge_message(delivery_tag)
+            return
+
+        if schedule_reporter:
+            # The schedule may have been changed through the API, so whatever was
+            #   last reported for it can't be assumed to still be current
+            schedule_reporter.forget(msg["id"])
+
+        with schedule_update_guard([msg["id"]]):
+            if msg["Action"] == "UpdateJob":
+                apply_schedule_update(msg)
+            elif msg["Action"] == "PauseJob":
+                job_scheduler.pause_job(msg["id"])
+            elif msg["Action"] == "ResumeJob":
+                job_scheduler.resume_job(msg["id"])
+            elif msg["Action"] == "RemoveJob":
+                job = job_scheduler.get_job(msg["id"])
+                if job:
+                    job_scheduler.remove_job(job.id)
 
         job = job_scheduler.get_job(msg["id"])
         if job:
-            url = "schedule/fromscheduler/{}".format(job.id)
-            rest_api_call(
-                url,
-                "PUT",
-                msg["_teamId"],
-                {},
-                {"nextScheduledRunDate": job.next_run_time},
+            report_schedule_state(
+                job.id, msg["_teamId"], {"nextScheduledRunDate": job.next_run_time}
             )
             logInfo(
                 {
                     "msg": "Updating job info 2",
-                    "url": url,
                     "job_id": job.id,
                     "nextScheduledRunDate": job.next_run_time,
                 }
@@ -659,7 +1539,7 @@ def on_message(delivery_tag, body, async_consumer):
         # job_scheduler.print_jobs()
     except Exception as ex:
         async_consumer.acknowledge_message(delivery_tag)
-        if "_teamId" in msg:
+        if "_teamId" in msg and "id" in msg:
             url = "schedule/fromscheduler/{}".format(msg["id"])
             rest_api_call(
                 url,
@@ -673,11 +1553,26 @@ def on_message(delivery_tag, body, async_consumer):
                 },
             )
         logError({"msg": str(ex), "Method": "on_message", "body": body})
-        job_scheduler.pause_job(msg["id"])
+        if "id" in msg:
+            job_scheduler.pause_job(msg["id"])
     # finally:
     #     async_consumer.start_consuming()
 
 
+def schedule_message_key(body):
+    """Ordering key for schedule update messages - updates for the same schedule
+    are handled in the order they were delivered. An UpdateJobs message is keyed
+    by every schedule in it, so it's handled in order with the updates for each of
+    them."""
+    try:
+        msg = decode_message(body)
+        if msg.get("Action") == "UpdateJobs":
+            return [schedule.get("id") for schedule in msg.get("jobs", [])]
+        return msg.get("id")
+    except Exception:
+        return None
+
+
 def schedule_updates_handler(args1, stop_event):
     global rmqCon
     global rmqUrl
@@ -685,37 +1580,108 @@ def schedule_updates_handler(args1, stop_event):
     global rmqPassword
     global rmqVhost
     global rmqScheduleUpdatesQueue
+    global scheduleUpdateWorkers
     global wait_schedule_updates_handler_exception
     global useSSL
 
     urlRoot = "amqp"
     if useSSL:
         urlRoot += "s"
-    rmqCon = AsyncConsumer(
-        "{0}://{1}:{2}@{3}/{4}".format(
-            urlRoot, rmqUsername, rmqPassword, rmqUrl, rmqVhost
-        ),
-        {
-            "exch": "worker",
-            "exch_type": "topic",
-            "durable": True,
-            "queue_name": rmqScheduleUpdatesQueue,
-            "exclusive": False,
-            "auto_delete": False,
-            "routing_key": rmqScheduleUpdatesQueue,
-            "prefetch_count": 10,
-            "auto_ack": False,
-            "on_message": on_message,
-        },
-    )
 
-    rmqCon.run()
+    queue_name = rmqScheduleUpdatesQueue
+    queue_arguments = None
+    if membership:
+        # Every instance gets its own copy of the updates and keeps the ones for the
+        #   schedules it owns - queues of instances that are gone expire. Each
+        #   update is decoded by every instance, but none is lost while ownership
+        #   moves, which binding each instance to the schedules it owns would risk
+        queue_name = "{}.{}".format(rmqScheduleUpdatesQueue, membership.member_id)
+        queue_arguments = {"x-expires": clusterConfig.get("queueExpiresMs", 3600000)}
+
+    reconnect_delay = 0
+    while not stop_event.is_set():
+        rmqCon = AsyncConsumer(
+            "{0}://{1}:{2}@{3}/{4}".format(
+                urlRoot, rmqUsername, rmqPassword, rmqUrl, rmqVhost
+            ),
+            {
+                "exch": "worker",
+                "exch_type": "topic",
+                "durable": True,
+                "queue_name": queue_name,
+                "queue_arguments": queue_arguments,
+                "exclusive": False,
+                "auto_delete": False,
+                "routing_key": rmqScheduleUpdatesQueue,
+                "prefetch_count": 10,
+                "auto_ack": False,
+                "on_message": on_message,
+                "dispatch_workers": scheduleUpdateWorkers,
+                "dispatch_key": schedule_message_key,
+                "metrics": consumer_metrics,
+            },
+        )
+        # stop_schedule_updates_handler sets stop_event before stopping rmqCon, so
+        #   if it stopped the previous consumer this one is not run
+        if stop_event.is_set():
+            break
+
+        rmqCon.run()
+        if not rmqCon.should_reconnect:
+            break
+        if rmqCon.was_consuming:
+            reconnect_delay = 0
+        reconnect_delay = min(reconnect_delay + 1, 30)
+        logWarning(
+            {
+                "msg": "Schedule updates connection lost - reconnecting",
+                "Method": "schedule_updates_handler",
+                "delay": reconnect_delay,
+            }
+        )
+        stop_event.wait(reconnect_delay)
+
+
+def start_schedule_updates_handler():
+    global handle_schedule_updates_thread
+    global handle_schedule_updates_stop
+
+    handle_schedule_updates_stop = Event()
+    handle_schedule_updates_thread = Thread(
+        target=schedule_updates_handler, args=(1, handle_schedule_updates_stop)
+    )
+    handle_schedule_updates_thread.start()
 
 
 def stop_schedule_updates_handler():
     global rmqCon
+    global handle_schedule_updates_thread
+
+    if handle_schedule_updates_stop:
+        handle_schedule_updates_stop.set()
     if rmqCon:
-        rmqCon.stop()
+        rmqCon.stop_threadsafe()
+    if handle_schedule_updates_thread:
+        handle_schedule_updates_thread.join()
+        handle_schedule_updates_thread = None
+    rmqCon = None
+
+
+def promote_to_leader():
+    """Take over as the active scheduler - catch the job cache up with the changes
+    made by the previous leader, start running jobs and consume schedule updates"""
+    logInfo({"msg": "Promoted to scheduler leader", "Method": "promote_to_leader"})
+    jobstores["default"].refresh()
+    if catch_up:
+        catch_up_missed_fires()
+    job_scheduler.resume()
+    start_schedule_updates_handler()
+
+
+def demote_from_leader():
+    logInfo({"msg": "Demoted to standby scheduler", "Method": "demote_from_leader"})
+    job_scheduler.pause()
+    stop_schedule_updates_handler()
 
 
 def run_scheduler_async(args1, stop_event):
@@ -725,7 +1691,10 @@ def run_scheduler_async(args1, stop_event):
     global job_scheduler
 
     try:
-        job_scheduler.start()
+        # A standby starts paused with its job cache loaded and is resumed if it
+        #   becomes the leader - a single scheduler starts paused until its missed
+        #   fires have been handed to the catch up engine
+        job_scheduler.start(paused=leader_lease is not None or catch_up is not None)
     except Exception as e:
         logError({"Msg": str(e), "Method": "run_scheduler_async"})
 
@@ -734,20 +1703,57 @@ def main():
     global wait_schedule_updates_handler_exception
     global job_scheduler
 
+    # The toggle takes locks the interrupted main thread may be holding, so it runs
+    #   on its own thread rather than in the signal handler
+    signal.signal(
+        signal.SIGUSR1,
+        lambda signum, frame: Thread(target=profiler.toggle, daemon=True).start(),
+    )
+
+    # The endpoint is only reachable from the same host unless schedulerMetrics.host
+    #   is set to an address a scraper can reach, e.g. 0.0.0.0 in a container
+    metrics_server = None
+    if metricsConfig.get("enabled", True):
+        metrics_server = MetricsServer(
+            metrics,
+            host=metricsConfig.get("host", "127.0.0.1"),
+            port=metricsConfig.get("port", 9102),
+        )
+        metrics_server.start()
+
+    if membership:
+        membership.start()
+        jobstores["default"].set_ownership(membership.owns)
+
+    if launch_publisher:
+        launch_publisher.start()
+
     run_scheduler_async_thread_stop = Event()
     run_scheduler_async_thread = Thread(
         target=run_scheduler_async, args=(1, run_scheduler_async_thread_stop)
     )
     run_scheduler_async_thread.start()
 
-    handle_schedule_updates_thread_stop = Event()
-    handle_schedule_updates_thread = Thread(
-        target=schedule_updates_handler, args=(1, handle_schedule_updates_thread_stop)
-    )
-
     try:
         logInfo({"msg": "Starting JobScheduler"})
-        handle_schedule_updates_thread.start()
+        if leader_lease:
+            scheduler_started.wait()
+            leader_lease.start()
+        else:
+            if catch_up:
+                scheduler_started.wait()
+                catch_up_missed_fires()
+                job_scheduler.resume()
+            start_schedule_updates_handler()
+        if schedule_reconciler:
+            scheduler_started.wait()
+            schedule_reconciler.start()
+        if launch_outbox:
+            launch_outbox.start()
+        stats_log_interval = httpClientConfig.get("statsLogIntervalSeconds", 60)
+        last_stats_log = datetime.now()
+        standby_refresh_interval = clusterConfig.get("standbyRefreshSeconds", 30)
+        last_standby_refresh = datetime.now()
         while True:
             schedule_updates_exception_occurred = (
                 wait_schedule_updates_handler_exception.wait(5)
@@ -755,14 +1761,47 @@ def main():
             if schedule_updates_exception_occurred:
                 logError({"msg": "Exception occurred in on_message event"})
                 wait_schedule_updates_handler_exception.clear()
+            if (datetime.now() - last_stats_log).total_seconds() >= stats_log_interval:
+                logInfo({"msg": "API client stats", "stats": api_client.stats()})
+                last_stats_log = datetime.now()
+            if (
+                leader_lease
+                and not leader_lease.is_leader()
+                and (datetime.now() - last_standby_refresh).total_seconds()
+                >= standby_refresh_interval
+            ):
+                # Keep the standby's cache close to the leader's so a takeover only
+                #   has to load the last few changes
+                jobstores["default"].refresh()
+                last_standby_refresh = datetime.now()
     except KeyboardInterrupt:
         logInfo({"msg": "process interrupted - exiting", "Method": "main"})
+        if leader_lease:
+            leader_lease.stop()
         stop_schedule_updates_handler()
-        handle_schedule_updates_thread_stop.set()
-        handle_schedule_updates_thread.join()
+        if schedule_reconciler:
+            schedule_reconciler.stop()
+        if launch_outbox:
+            launch_outbox.stop()
+        if catch_up:
+            catch_up.stop()
         run_scheduler_async_thread_stop.set()
         job_scheduler.shutdown()
         run_scheduler_async_thread.join()
+        if fire_spreader:
+            fire_spreader.stop()
+        if launch_limiter:
+            launch_limiter.stop(timeout=30)
+        bookkeeping_lanes.stop(timeout=30)
+        if launch_publisher:
+            launch_publisher.stop()
+        if schedule_reporter:
+            schedule_reporter.stop()
+        if membership:
+            membership.stop()
+        api_client.close()
+        if metrics_server:
+            metrics_server.stop()
         sys.exit(0)
     except Exception as ex:
         logError({"msg": str(ex), "Method": "main"})
@@ -0,0 +1,267 @@
+import json
+import os
+import threading
+
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import pytest
+import requests
+
+from pytz import utc
+from requests.packages.urllib3.exceptions import MaxRetryError, NewConnectionError
+
+pytest.importorskip("sendgrid")
+pytest.importorskip("dotenv")
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", ".."))
+
+
+@pytest.fixture(scope="module")
+def scheduler():
+    # JobScheduler reads config/default.json from the working directory and its
+    #   connection settings from the environment when it's imported - nothing
+    #   connects until the scheduler is started
+    for key, value in (
+        ("mongoUrl", "mongodb://localhost:27017"),
+        ("mongoDbName", "test"),
+        ("schedulerToken", "token"),
+        ("rmqUrl", "localhost"),
+        ("rmqUsername", "guest"),
+        ("rmqPassword", "guest"),
+        ("rmqVhost", "test"),
+    ):
+        os.environ.setdefault(key, value)
+    cwd = os.getcwd()
+    os.chdir(REPO_ROOT)
+    try:
+        import JobScheduler
+    finally:
+        os.chdir(cwd)
+    return JobScheduler
+
+
+class FakeMembership(object):
+    def __init__(self, fenced=None):
+        self._fenced = fenced
+        self.waits = []
+
+    def wait_unfenced(self, key, timeout):
+        self.waits.append((key, timeout))
+        return self._fenced
+
+
+@pytest.fixture
+def launches(scheduler, monkeypatch):
+    posted = []
+
+    def rest_api_call(url, method, _teamId, headers, data={}):
+        posted.append(data)
+        return [True, 201]
+
+    monkeypatch.setattr(scheduler, "rest_api_call", rest_api_call)
+    monkeypatch.setattr(scheduler, "leader_lease", None)
+    monkeypatch.setattr(scheduler, "launch_limiter", None)
+    monkeypatch.setattr(scheduler, "launch_publisher", None)
+    return posted
+
+
+def test_sharded_launch_waits_for_handoff_until_its_deadline(
+    scheduler, launches, monkeypatch
+):
+    membership = FakeMembership()
+    monkeypatch.setattr(scheduler, "membership", membership)
+    now = datetime.now(utc)
+
+    res = scheduler.send_launch(
+        now, "schedule", "team", "jobdef", {}, now + timedelta(seconds=3)
+    )
+
+    assert res == [True, 201]
+    assert len(launches) == 1
+    key, timeout = membership.waits[0]
+    assert key == "schedule"
+    assert 0 < timeout <= 3
+
+
+def test_sharded_launch_past_its_deadline_does_not_wait(
+    scheduler, launches, monkeypatch
+):
+    membership = FakeMembership()
+    monkeypatch.setattr(scheduler, "membership", membership)
+    now = datetime.now(utc)
+
+    scheduler.send_launch(
+        now, "schedule", "team", "jobdef", {}, now - timedelta(seconds=1)
+    )
+
+    assert membership.waits == [("schedule", 0)]
+
+
+def test_fenced_sharded_launch_is_skipped(scheduler, launches, monkeypatch):
+    monkeypatch.setattr(scheduler, "membership", FakeMembership(fenced="handoff"))
+    now = datetime.now(utc)
+
+    res = scheduler.send_launch(
+        now, "schedule", "team", "jobdef", {}, now + timedelta(seconds=3)
+    )
+
+    assert res is None
+    assert launches == []
+
+
+def test_update_jobs_messages_are_keyed_by_every_schedule(scheduler):
+    body = b'{"Action": "UpdateJobs", "_teamId": "team", "jobs": [{"id": "a"}, {"id": "b"}]}'
+
+    assert scheduler.schedule_message_key(body) == ["a", "b"]
+    assert scheduler.schedule_message_key(b'{"Action": "UpdateJob", "id": "a"}') == "a"
+
+
+class FakeConsumer(object):
+    def __init__(self):
+        self.acked = []
+
+    def acknowledge_message(self, delivery_tag):
+        self.acked.append(delivery_tag)
+
+
+class FakeJobScheduler(object):
+    def get_job(self, job_id):
+        return None
+
+
+def test_update_jobs_reply_and_ack_survive_a_failed_job_store_flush(
+    scheduler, monkeypatch
+):
+    calls = []
+
+    @contextmanager
+    def failing_batch():
+        yield
+        raise RuntimeError("MongoDB unavailable")
+
+    monkeypatch.setattr(scheduler, "job_scheduler", FakeJobScheduler())
+    monkeypatch.setattr(scheduler, "job_store_batch", failing_batch)
+    monkeypatch.setattr(scheduler, "apply_schedule_spec", lambda *args: None)
+    monkeypatch.setattr(scheduler, "membership", None)
+    monkeypatch.setattr(scheduler, "schedule_reconciler", None)
+    monkeypatch.setattr(
+        scheduler, "rest_api_call", lambda *args: calls.append(args) or [True, 200]
+    )
+    schedule = {
+        "id": "schedule",
+        "_teamId": "team",
+        "name": "schedule",
+        "TriggerType": "cron",
+        "isActive": True,
+        "cron": {"Minute": "*/5", "Timezone": "UTC"},
+        "FunctionKwargs": {"_teamId": "team", "targetId": "jobdef", "runtimeVars": {}},
+    }
+    body = json.dumps({"Action": "UpdateJobs", "_teamId": "team", "jobs": [schedule]})
+    consumer = FakeConsumer()
+
+    scheduler.on_message(1, body.encode("utf-8"), consumer)
+
+    assert consumer.acked == [1]
+    url, method, _teamId, headers, data = calls[0]
+    assert url == "schedule/fromscheduler"
+    assert data["schedules"][0]["scheduleError"] == "MongoDB unavailable"
+
+
+def test_limited_launch_does_not_hold_the_executor_thread(
+    scheduler, launches, monkeypatch
+):
+    limiter = scheduler.AdaptiveLimiter(initial_limit=1)
+    release = threading.Event()
+    after = []
+    monkeypatch.setattr(scheduler, "launch_limiter", limiter)
+    monkeypatch.setattr(scheduler, "membership", None)
+    monkeypatch.setattr(
+        scheduler, "queue_after_launch", lambda res, *args: after.append(res)
+    )
+    now = datetime.now(utc)
+    limiter.submit(0, None, release.wait, 5)
+
+    scheduler.launch_job(
+        now, "schedule", "team", "jobdef", {}, now + timedelta(seconds=5)
+    )
+
+    assert launches == []
+    assert after == []
+    release.set()
+    limiter.stop(timeout=5)
+    assert after == [[True, 201]]
+
+
+def test_limited_launch_past_its_deadline_is_not_sent(scheduler, launches, monkeypatch):
+    limiter = scheduler.AdaptiveLimiter(initial_limit=1)
+    release = threading.Event()
+    monkeypatch.setattr(scheduler, "launch_limiter", limiter)
+    monkeypatch.setattr(scheduler, "membership", None)
+    now = datetime.now(utc)
+    limiter.submit(0, None, release.wait, 5)
+
+    res = scheduler.send_launch(
+        now, "schedule", "team", "jobdef", {}, now + timedelta(seconds=0.1)
+    )
+
+    assert scheduler.launch_result(res) == [False, None]
+    release.set()
+    limiter.stop(timeout=5)
+    assert launches == []
+
+
+class FakeApiClient(object):
+    def __init__(self, outcome):
+        self._outcome = outcome
+
+    def request(self, method, url, headers, data):
+        if isinstance(self._outcome, Exception):
+            raise self._outcome
+        return FakeResponse(self._outcome)
+
+
+class FakeResponse(object):
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.text = ""
+
+
+@pytest.mark.parametrize(
+    "outcome, retried",
+    [
+        (requests.exceptions.ConnectTimeout("Connect timed out"), True),
+        (
+            requests.exceptions.ConnectionError(
+                MaxRetryError(None, "job", NewConnectionError(None, "refused"))
+            ),
+            True,
+        ),
+        (429, True),
+        (requests.exceptions.ReadTimeout("Read timed out"), False),
+        (requests.exceptions.ConnectionError("Connection reset by peer"), False),
+        (503, False),
+    ],
+)
+def test_only_launches_that_never_reached_the_api_are_retried(
+    scheduler, monkeypatch, outcome, retried
+):
+    monkeypatch.setattr(scheduler, "api_client", FakeApiClient(outcome))
+    monkeypatch.setattr(scheduler, "leader_lease", None)
+    monkeypatch.setattr(scheduler, "membership", None)
+    monkeypatch.setattr(scheduler, "launch_limiter", None)
+    monkeypatch.setattr(scheduler, "launch_publisher", None)
+    now = datetime.now(utc)
+    entry = {
+        "schedule_id": "schedule",
+        "scheduled_time": now,
+        "deadline": now + timedelta(minutes=5),
+        "args": {"_teamId": "team", "targetId": "jobdef", "runtimeVars": {}},
+    }
+
+    res = scheduler.rest_api_call("job", "POST", "team", {}, {"_scheduleId": "a"})
+
+    assert res[0] is False
+    assert scheduler.retryable_launch_failure(res[1]) is retried
+    assert scheduler.launch_maybe_sent(res, {"_scheduleId": "a"}, "rest") is not retried
+    assert scheduler.retry_launch(entry) == ("retry" if retried else "dropped")
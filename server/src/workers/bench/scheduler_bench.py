@@ -0,0 +1,546 @@
+"""Benchmark for JobScheduler.py with a synthetic schedule population.
+
+Generates cron, interval and date schedules, feeds them to on_message as
+UpdateJob messages through a stand-in for AsyncConsumer, then lets the
+scheduler launch the ones that fall due against a local stub of the API.
+Nothing outside the process is needed unless --store mongo is used.
+
+Reports, as JSON:
+
+- update throughput (schedule update messages handled per second)
+- fire latency percentiles (launch request arrival at the API minus
+  the scheduled time), and peak launches per second
+- resident memory per schedule (with mongomock this includes the
+  in-process copy of the stored documents)
+- job store startup load time, the time to restore every job after it,
+  and the stored document size per job (cached job stores only)
+
+mongomock scans the collection on every write, so past a few tens of
+thousands of schedules use --store mongo against a local mongod, or
+--store memory (no startup load time).
+
+Run from anywhere, with the scheduler's requirements installed (plus
+mongomock for the default store):
+
+    python server/src/workers/bench/scheduler_bench.py --schedules 100000 \
+        --mix cron=0.6,interval=0.3,date=0.1 --clustered 0.8 --output bench.json
+
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import sys
+import threading
+import time
+
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WORKERS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(WORKERS_DIR)))
+
+BENCH_TEAM_ID = "bench-team"
+BENCH_JOB_DEF_ID = "bench-jobdef"
+
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(","):
+        trigger_type, weight = part.split("=")
+        mix[trigger_type.strip()] = float(weight)
+    unknown = set(mix) - {"cron", "interval", "date"}
+    if unknown:
+        raise argparse.ArgumentTypeError(
+            "Unknown trigger types: {}".format(", ".join(sorted(unknown)))
+        )
+    return mix
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--schedules", type=int, default=10000)
+    parser.add_argument(
+        "--mix",
+        type=parse_mix,
+        default=parse_mix("cron=0.6,interval=0.3,date=0.1"),
+        help="Relative weights of trigger types",
+    )
+    parser.add_argument(
+        "--due-fraction",
+        type=float,
+        default=0.1,
+        help="Fraction of schedules that fall due while the benchmark runs",
+    )
+    parser.add_argument(
+        "--clustered",
+        type=float,
+        default=0.8,
+        help="Fraction of due schedules that fire at the same second (like :00)",
+    )
+    parser.add_argument(
+        "--fire-window",
+        type=float,
+        default=30,
+        help="Seconds over which the unclustered due schedules fire",
+    )
+    parser.add_argument(
+        "--fire-lead",
+        type=float,
+        default=10,
+        help="Seconds between the end of loading and the first fire",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=1,
+        help="Schedules per update message - above 1 sends UpdateJobs batches",
+    )
+    parser.add_argument(
+        "--update-workers",
+        type=int,
+        default=None,
+        help="Dispatch workers (defaults to scheduleUpdateWorkers from config)",
+    )
+    parser.add_argument(
+        "--store",
+        choices=["memory", "mongomock", "mongo"],
+        default=None,
+        help="Job store - defaults to mongomock if installed, otherwise memory",
+    )
+    parser.add_argument("--mongo-url", default="mongodb://localhost:27017")
+    parser.add_argument(
+        "--encoding",
+        choices=["pickle", "compact"],
+        default="pickle",
+        help="How the cached job store writes jobs to MongoDB",
+    )
+    parser.add_argument(
+        "--api-latency-ms",
+        type=float,
+        default=0,
+        help="Time the stub API takes to answer each request",
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Write results here instead of stdout")
+    return parser.parse_args(argv)
+
+
+def import_job_scheduler():
+    """Import JobScheduler.py with placeholder settings - nothing it connects to
+    at import time is used by the benchmark."""
+    for key, value in (
+        ("mongoUrl", "mongodb://localhost:27017"),
+        ("mongoDbName", "scheduler_bench"),
+        ("schedulerToken", "bench"),
+        ("rmqUrl", "localhost"),
+        ("rmqUsername", "bench"),
+        ("rmqPassword", "bench"),
+        ("rmqVhost", "bench"),
+    ):
+        os.environ.setdefault(key, value)
+    os.chdir(REPO_ROOT)
+    sys.path.insert(0, WORKERS_DIR)
+    import JobScheduler
+
+    return JobScheduler
+
+
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        # ru_maxrss is the peak, in KB on Linux and bytes on macOS
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class StubApi(object):
+    """Minimal stand-in for the SaaSGlue API that accepts every request and
+    records when each job launch arrived."""
+
+    def __init__(self, latency_seconds=0):
+        self.latency_seconds = latency_seconds
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.launches = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _handle(self):
+                arrived = time.time()
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                route = "{} {}".format(self.command, self.path.split("/")[3])
+                with stub.lock:
+                    stub.requests[route] = stub.requests.get(route, 0) + 1
+                    if route == "POST job":
+                        stub.launches.append(
+                            (arrived, json.loads(body)["dateScheduled"])
+                        )
+                if stub.latency_seconds:
+                    time.sleep(stub.latency_seconds)
+                response = b'{"data": {}}'
+                self.send_response(201 if self.command == "POST" else 200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(response)))
+                self.end_headers()
+                self.wfile.write(response)
+
+            do_POST = do_PUT = do_DELETE = _handle
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, name="stub-api", daemon=True
+        )
+
+    def start(self):
+        self.thread.start()
+
+    def launch_count(self):
+        with self.lock:
+            return len(self.launches)
+
+    def stop(self):
+        self.server.shutdown()
+
+
+class BenchConsumer(object):
+    """Stands in for AsyncConsumer - on_message only acknowledges through it."""
+
+    def __init__(self, expected):
+        self._expected = expected
+        self._lock = threading.Lock()
+        self._handled = 0
+        self.done = threading.Event()
+
+    def acknowledge_message(self, delivery_tag):
+        with self._lock:
+            self._handled += 1
+            if self._handled >= self._expected:
+                self.done.set()
+
+    def reject_message(self, delivery_tag, requeue):
+        self.acknowledge_message(delivery_tag)
+
+
+def make_job_store(J, store, encoding):
+    from apscheduler.jobstores.memory import MemoryJobStore
+    from apscheduler.jobstores.mongodb import MongoDBJobStore
+    from py_utils.cached_jobstore import CachedJobStore
+
+    if store == "memory":
+        return MemoryJobStore(), None
+    if store == "mongomock":
+        import mongomock
+
+        client = mongomock.MongoClient()
+    else:
+        from pymongo import MongoClient
+
+        client = MongoClient(J.mongoUrl)
+    client.drop_database("scheduler_bench")
+
+    def new_store():
+        return CachedJobStore(
+            MongoDBJobStore(
+                database="scheduler_bench", collection="scheduled_job", client=client
+            ),
+            encoding=encoding,
+        )
+
+    return new_store(), new_store
+
+
+def make_schedule(index, trigger_type, fire_time):
+    schedule = {
+        "Action": "UpdateJob",
+        "id": "bench-{}".format(index),
+        "_teamId": BENCH_TEAM_ID,
+        "name": "Bench schedule {}".format(index),
+        "isActive": True,
+        "TriggerType": trigger_type,
+        "misfire_grace_time": 3600,
+        "FunctionKwargs": {
+            "_teamId": BENCH_TEAM_ID,
+            "targetId": BENCH_JOB_DEF_ID,
+            "runtimeVars": {},
+        },
+    }
+    if trigger_type == "cron":
+        schedule["cron"] = {
+            "Month": str(fire_time.month),
+            "Day": str(fire_time.day),
+            "Hour": str(fire_time.hour),
+            "Minute": str(fire_time.minute),
+            "Second": str(fire_time.second),
+            "Timezone": "UTC",
+        }
+    elif trigger_type == "interval":
+        schedule["interval"] = {
+            "Days": 1,
+            "Start_Date": fire_time.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+    else:
+        schedule["RunDate"] = fire_time.strftime("%Y-%m-%d %H:%M:%S")
+    return schedule
+
+
+def plan_population(args):
+    """Return (index, trigger_type, due, offset_seconds) for every schedule in
+    the synthetic population - due schedules fire during the run, offset
+    seconds after the first fire."""
+    rng = random.Random(args.seed)
+    trigger_types = list(args.mix)
+    weights = [args.mix[t] for t in trigger_types]
+    plan = []
+    for index in range(args.schedules):
+        trigger_type = rng.choices(trigger_types, weights)[0]
+        due = rng.random() < args.due_fraction
+        offset_seconds = 0
+        if rng.random() >= args.clustered:
+            offset_seconds = int(rng.random() * args.fire_window)
+        plan.append((index, trigger_type, due, offset_seconds))
+    return plan
+
+
+def update_messages(args, schedules):
+    if args.batch_size <= 1:
+        return [json.dumps(schedule) for schedule in schedules]
+    return [
+        json.dumps(
+            {
+                "Action": "UpdateJobs",
+                "_teamId": BENCH_TEAM_ID,
+                "jobs": schedules[i : i + args.batch_size],
+            }
+        )
+        for i in range(0, len(schedules), args.batch_size)
+    ]
+
+
+def deliver(J, messages, update_workers):
+    """Hand the messages to on_message the way AsyncConsumer does and wait until
+    every one has been acknowledged."""
+    from py_utils.lanes import KeyedLanes
+
+    consumer = BenchConsumer(len(messages))
+    lanes = KeyedLanes(update_workers, "bench") if update_workers > 0 else None
+    for delivery_tag, body in enumerate(messages, 1):
+        if lanes:
+            lanes.submit(
+                J.schedule_message_key(body), J.on_message, delivery_tag, body, consumer
+            )
+        else:
+            J.on_message(delivery_tag, body, consumer)
+    if messages:
+        consumer.done.wait()
+    if lanes:
+        lanes.stop()
+
+
+def run(args):
+    J = import_job_scheduler()
+
+    from apscheduler.executors.pool import ThreadPoolExecutor
+    from apscheduler.schedulers.background import BackgroundScheduler
+    from pytz import utc
+
+    store_name = args.store
+    if store_name is None:
+        try:
+            import mongomock  # noqa: F401
+
+            store_name = "mongomock"
+        except ImportError:
+            store_name = "memory"
+
+    api = StubApi(args.api_latency_ms / 1000.0)
+    api.start()
+    J.apiBaseUrl = "http://127.0.0.1"
+    J.apiPort = str(api.port)
+    J.apiVersion = "v0"
+
+    job_store, new_job_store = make_job_store(J, store_name, args.encoding)
+    J.jobstores["default"] = job_store
+    J.job_scheduler = BackgroundScheduler(
+        jobstores={"default": job_store},
+        executors={"default": ThreadPoolExecutor(J.executor_threads)},
+        job_defaults=J.job_defaults,
+        timezone=utc,
+    )
+    # Updates are applied to a paused scheduler the same way they are while a
+    #   restarted scheduler works through its update queue
+    J.job_scheduler.start(paused=True)
+
+    update_workers = args.update_workers
+    if update_workers is None:
+        update_workers = J.scheduleUpdateWorkers
+
+    # The schedules that don't fall due during the run are loaded first, set to
+    #   fire a day from now. The due ones are sent afterwards, timed from when the
+    #   load finished.
+    generate_start = time.monotonic()
+    plan = plan_population(args)
+    later = datetime.utcnow().replace(microsecond=0) + timedelta(days=1)
+    messages = update_messages(
+        args,
+        [
+            make_schedule(index, trigger_type, later + timedelta(seconds=offset))
+            for index, trigger_type, due, offset in plan
+            if not due
+        ],
+    )
+    generate_seconds = time.monotonic() - generate_start
+
+    rss_before = rss_bytes()
+    update_start = time.monotonic()
+    deliver(J, messages, update_workers)
+    update_seconds = time.monotonic() - update_start
+    del messages
+
+    fire_at = datetime.utcnow().replace(microsecond=0) + timedelta(
+        seconds=args.fire_lead
+    )
+    due_schedules = [
+        make_schedule(index, trigger_type, fire_at + timedelta(seconds=offset))
+        for index, trigger_type, due, offset in plan
+        if due
+    ]
+    due_start = time.monotonic()
+    deliver(J, update_messages(args, due_schedules), update_workers)
+    update_seconds += time.monotonic() - due_start
+    rss_after = rss_bytes()
+    if datetime.utcnow() > fire_at:
+        print(
+            "Loading the due schedules overran --fire-lead - fire latencies "
+            "include the overrun",
+            file=sys.stderr,
+        )
+
+    launches_before = api.launch_count()
+    J.job_scheduler.resume()
+    due_count = len(due_schedules)
+    deadline = time.monotonic() + args.fire_lead + args.fire_window + 60
+    while (
+        api.launch_count() - launches_before < due_count and time.monotonic() < deadline
+    ):
+        time.sleep(0.2)
+    J.job_scheduler.shutdown(wait=True)
+    if J.schedule_reporter:
+        J.schedule_reporter.stop()
+    api.stop()
+
+    # Time how long a restarted scheduler takes to load the stored jobs, and then
+    #   to restore every job it loaded lazily
+    load_seconds = restore_seconds = document_bytes = None
+    if new_job_store:
+        import bson
+
+        probe = new_job_store()
+        probe_scheduler = BackgroundScheduler(
+            jobstores={"default": probe}, timezone=utc
+        )
+        load_start = time.monotonic()
+        probe_scheduler.start(paused=True)
+        load_seconds = time.monotonic() - load_start
+        restore_start = time.monotonic()
+        probe.get_all_jobs()
+        restore_seconds = time.monotonic() - restore_start
+        probe_scheduler.shutdown(wait=False)
+        sizes = [len(bson.encode(d)) for d in probe._store.collection.find()]
+        document_bytes = sum(sizes) / max(len(sizes), 1)
+
+    with api.lock:
+        launches = api.launches[launches_before:]
+        requests = dict(api.requests)
+    latencies = sorted(
+        (arrived - datetime.fromisoformat(scheduled).timestamp()) * 1000
+        for arrived, scheduled in launches
+    )
+    per_second = {}
+    for arrived, _ in launches:
+        per_second[int(arrived)] = per_second.get(int(arrived), 0) + 1
+
+    return {
+        "benchmark": "job_scheduler",
+        "timestamp": datetime.utcnow().isoformat() + "Z",
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "parameters": {
+            "schedules": args.schedules,
+            "mix": args.mix,
+            "due_fraction": args.due_fraction,
+            "clustered": args.clustered,
+            "fire_window_seconds": args.fire_window,
+            "batch_size": args.batch_size,
+            "update_workers": update_workers,
+            "store": store_name,
+            "encoding": args.encoding,
+            "api_latency_ms": args.api_latency_ms,
+            "seed": args.seed,
+        },
+        "results": {
+            "generate_seconds": round(generate_seconds, 3),
+            "update_seconds": round(update_seconds, 3),
+            "updates_per_second": round(args.schedules / update_seconds, 1),
+            "memory_bytes_per_schedule": round(
+                (rss_after - rss_before) / max(args.schedules, 1), 1
+            ),
+            "startup_load_seconds": (
+                round(load_seconds, 3) if load_seconds is not None else None
+            ),
+            "startup_restore_seconds": (
+                round(restore_seconds, 3) if restore_seconds is not None else None
+            ),
+            "document_bytes_per_job": (
+                round(document_bytes, 1) if document_bytes is not None else None
+            ),
+            "expected_launches": due_count,
+            "launches": len(launches),
+            "fire_latency_ms": {
+                "p50": percentile(latencies, 0.5),
+                "p90": percentile(latencies, 0.9),
+                "p99": percentile(latencies, 0.99),
+                "max": latencies[-1] if latencies else None,
+            },
+            "peak_launches_per_second": max(per_second.values(), default=0),
+            "api_requests": requests,
+        },
+    }
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = run(args)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+import heapq
+import itertools
+import threading
+import time
+
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from py_utils.logger import logger
+
+
+class LimitExpired(Exception):
+    """A call was given up on before a slot was free - its deadline passed or
+    the limiter stopped"""
+
+
+class AdaptiveLimiter(object):
+    """Limits how many requests are in flight at once, with a limit that
+    adapts to how the server is coping - additive increase, multiplicative
+    decrease (AIMD).
+
+    Every request that completes within latency_target without an error
+    while the limit was in use raises the limit by increase / limit, so by
+    about increase per limit's worth of requests. A request that errors or
+    takes longer than latency_target cuts the limit by decrease_factor, at
+    most once per latency_target so the requests already in flight when the
+    server started struggling don't cut it again and again.
+
+    Requests are queued rather than waited for - the caller gets a Future
+    and its thread is free straight away. Queued requests are sent on the
+    limiter's own threads in priority order (the lowest first, e.g. the
+    earliest scheduled time) as slots free up, and give up if their deadline
+    passes before one is free.
+
+    """
+
+    def __init__(
+        self,
+        initial_limit=20,
+        min_limit=1,
+        max_limit=100,
+        latency_target=2.0,
+        increase=1.0,
+        decrease_factor=0.7,
+        name="limiter",
+    ):
+        """
+        :param int initial_limit: Requests allowed in flight at first
+        :param int min_limit: The limit is never cut below this
+        :param int max_limit: The limit is never raised above this
+        :param float latency_target: Seconds - a slower request counts as a
+            sign the server is overloaded
+        :param float increase: Added to the limit per limit's worth of good
+            requests
+        :param float decrease_factor: The limit is multiplied by this when
+            the server is overloaded
+        :param str name: Prefix for the thread names
+
+        """
+        self._min_limit = min_limit
+        self._max_limit = max_limit
+        self._limit = float(min(max(initial_limit, min_limit), max_limit))
+        self._latency_target = latency_target
+        self._increase = increase
+        self._decrease_factor = decrease_factor
+        self._in_flight = 0
+        self._saturated = False
+        self._last_decrease = 0.0
+        # Waiting requests by priority, and by deadline to give up on them - a
+        #   request sent or given up on is marked and left in the other heap
+        #   until it reaches the top
+        self._waiting = []
+        self._deadlines = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._stopping = False
+        self._stop_at = None
+        # Threads are only started for requests that have a slot, so there are
+        #   never more than the limit's worth of them busy
+        self._pool = ThreadPoolExecutor(max_limit, thread_name_prefix=name)
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def limit(self):
+        with self._condition:
+            return int(self._limit)
+
+    def in_flight(self):
+        with self._condition:
+            return self._in_flight
+
+    def waiting(self):
+        with self._condition:
+            return sum(1 for waiter in self._waiting if not waiter[3])
+
+    def submit(self, priority, deadline, fn, *args, ok=None):
+        """Queue fn(*args) to be sent once a slot is free.
+
+        :param float priority: Requests with a lower priority get a slot first
+        :param float deadline: time.time() timestamp after which the request
+            gives up waiting, or None to wait for as long as it takes
+        :param callable fn: The request
+        :param callable ok: Called with fn's result - False if the request
+            failed in a way that suggests the server is overloaded. A request
+            that raises always counts as failed.
+        :return: A Future of fn's result, failed with LimitExpired if the
+            deadline passed before a slot was free
+        :rtype: concurrent.futures.Future
+
+        """
+        future = Future()
+        with self._condition:
+            if self._stopping:
+                future.set_exception(LimitExpired("Limiter stopped"))
+                return future
+            waiter = [priority, next(self._sequence), deadline, False, future]
+            waiter.append((fn, args, ok))
+            heapq.heappush(self._waiting, waiter)
+            if deadline is not None:
+                heapq.heappush(self._deadlines, (deadline, waiter[1], waiter))
+            self._condition.notify_all()
+        return future
+
+    def release(self, latency, ok):
+        """Give back a slot and adjust the limit.
+
+        :param float latency: Seconds the request took
+        :param bool ok: False if the request failed in a way that suggests
+            the server is overloaded
+
+        """
+        with self._condition:
+            self._in_flight -= 1
+            limit = self._limit
+            if not ok or latency > self._latency_target:
+                now = time.monotonic()
+                if now - self._last_decrease >= self._latency_target:
+                    self._last_decrease = now
+                    self._limit = max(
+                        float(self._min_limit), self._limit * self._decrease_factor
+                    )
+            elif self._saturated:
+                self._limit = min(
+                    float(self._max_limit), self._limit + self._increase / self._limit
+                )
+            if int(self._limit) != int(limit):
+                logger.info(
+                    "Launch concurrency limit %s -> %s", int(limit), int(self._limit)
+                )
+            if self._in_flight < int(self._limit) * 0.5:
+                # A limit that isn't being used isn't raised
+                self._saturated = False
+            self._condition.notify_all()
+
+    def stop(self, timeout=None):
+        """Keep sending the queued requests within the limit until they're all
+        sent, then wait for the ones in flight.
+
+        :param float timeout: Seconds after which the requests still queued
+            are given up on
+
+        """
+        with self._condition:
+            self._stopping = True
+            if timeout is not None:
+                self._stop_at = time.time() + timeout
+            self._condition.notify_all()
+        self._thread.join()
+        self._pool.shutdown(wait=True)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                expired = self._expire()
+                ready = []
+                while self._waiting and self._in_flight < int(self._limit):
+                    waiter = heapq.heappop(self._waiting)
+                    if waiter[3]:
+                        continue
+                    waiter[3] = True
+                    if waiter[4].set_running_or_notify_cancel():
+                        self._take()
+                        ready.append(waiter)
+                done = self._stopping and not any(
+                    not waiter[3] for waiter in self._waiting
+                )
+                if not (expired or ready or done):
+                    self._condition.wait(self._next_expiry())
+            for waiter in expired:
+                waiter[4].set_exception(LimitExpired("Deadline passed"))
+            for waiter in ready:
+                self._pool.submit(self._send, waiter[4], *waiter[5])
+            if done:
+                return
+
+    def _send(self, future, fn, args, ok):
+        started = time.monotonic()
+        try:
+            result = fn(*args)
+        except BaseException as ex:
+            self.release(time.monotonic() - started, False)
+            future.set_exception(ex)
+            return
+        self.release(time.monotonic() - started, ok(result) if ok else True)
+        future.set_result(result)
+
+    def _expire(self):
+        # Called with the condition held - the futures are failed once it's let go
+        #   of, as their callbacks run straight away
+        now = time.time()
+        due = []
+        if self._stopping and self._stop_at is not None and now >= self._stop_at:
+            due = list(self._waiting)
+        while self._deadlines and self._deadlines[0][0] <= now:
+            due.append(heapq.heappop(self._deadlines)[2])
+        expired = []
+        for waiter in due:
+            if not waiter[3]:
+                waiter[3] = True
+                expired.append(waiter)
+        while self._waiting and self._waiting[0][3]:
+            heapq.heappop(self._waiting)
+        while self._deadlines and self._deadlines[0][2][3]:
+            heapq.heappop(self._deadlines)
+        return expired
+
+    def _next_expiry(self):
+        # Called with the condition held - seconds until a waiting request has to
+        #   be given up on
+        expiries = []
+        if self._deadlines:
+            expiries.append(self._deadlines[0][0])
+        if self._stopping and self._stop_at is not None and self._waiting:
+            expiries.append(self._stop_at)
+        if not expiries:
+            return None
+        return max(min(expiries) - time.time(), 0)
+
+    def _take(self):
+        # Called with the condition held
+        self._in_flight += 1
+        if self._in_flight >= int(self._limit):
+            self._saturated = True
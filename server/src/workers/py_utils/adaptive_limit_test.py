@@ -0,0 +1,112 @@
+import threading
+import time
+
+import pytest
+
+from py_utils.adaptive_limit import AdaptiveLimiter, LimitExpired
+
+
+@pytest.fixture
+def limiters():
+    created = []
+
+    def make(**kwargs):
+        limiter = AdaptiveLimiter(**kwargs)
+        created.append(limiter)
+        return limiter
+
+    yield make
+    for limiter in created:
+        limiter.stop(timeout=0)
+
+
+def wait_for(condition):
+    deadline = time.monotonic() + 5
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_submit_queues_instead_of_waiting_for_a_slot(limiters):
+    limiter = limiters(initial_limit=1)
+    release = threading.Event()
+    sent = []
+
+    first = limiter.submit(0, None, release.wait, 5)
+    wait_for(lambda: limiter.in_flight() == 1)
+    started = time.monotonic()
+    second = limiter.submit(1, None, sent.append, "second")
+    assert time.monotonic() - started < 0.5
+
+    assert not second.done()
+    assert limiter.waiting() == 1
+    release.set()
+    second.result(5)
+    assert first.result(5) is True
+    assert sent == ["second"]
+
+
+def test_queued_requests_are_sent_lowest_priority_first(limiters):
+    limiter = limiters(initial_limit=1)
+    release = threading.Event()
+    sent = []
+
+    limiter.submit(0, None, release.wait, 5)
+    queued = [
+        limiter.submit(priority, None, sent.append, priority) for priority in (3, 1, 2)
+    ]
+    release.set()
+    for future in queued:
+        future.result(5)
+
+    assert sent == [1, 2, 3]
+
+
+def test_request_gives_up_at_its_deadline(limiters):
+    limiter = limiters(initial_limit=1)
+    release = threading.Event()
+    sent = []
+
+    limiter.submit(0, None, release.wait, 5)
+    expired = limiter.submit(1, time.time() + 0.1, sent.append, "late")
+    with pytest.raises(LimitExpired):
+        expired.result(5)
+    assert limiter.waiting() == 0
+
+    release.set()
+    limiter.submit(2, None, sent.append, "next").result(5)
+    assert sent == ["next"]
+
+
+def test_limit_grows_while_requests_go_through(limiters):
+    limiter = limiters(initial_limit=2, max_limit=4, latency_target=1)
+    release = threading.Event()
+
+    # The limit is only raised while it's in use
+    in_use = [limiter.submit(0, None, release.wait, 5) for _ in range(2)]
+    queued = [limiter.submit(1, None, lambda: True) for _ in range(10)]
+    release.set()
+    for future in in_use + queued:
+        future.result(5)
+
+    assert limiter.limit() == 4
+
+
+def test_limit_is_cut_once_per_latency_target_when_requests_fail(limiters):
+    limiter = limiters(initial_limit=10, latency_target=60, decrease_factor=0.5)
+
+    for _ in range(3):
+        limiter.submit(0, None, lambda: False, ok=bool).result(5)
+    assert limiter.limit() == 5
+    assert limiter.in_flight() == 0
+
+
+def test_raising_request_counts_as_failed(limiters):
+    limiter = limiters(initial_limit=10, decrease_factor=0.5)
+
+    def fail():
+        raise RuntimeError("connection reset")
+
+    with pytest.raises(RuntimeError):
+        limiter.submit(0, None, fail).result(5)
+    assert limiter.limit() == 5
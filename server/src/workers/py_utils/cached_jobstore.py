@@ -0,0 +1,955 @@
+import pickle
+import threading
+import time
+
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from apscheduler.job import Job
+from apscheduler.jobstores.base import BaseJobStore, ConflictingIdError, JobLookupError
+from apscheduler.util import datetime_to_utc_timestamp, utc_timestamp_to_datetime
+from bson.binary import Binary
+from bson.objectid import ObjectId
+from pymongo import DeleteOne, UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+from py_utils.due_index import DueIndex
+from py_utils.job_codec import SCHEMA_VERSION, decode_job_state, encode_job
+from py_utils.job_snapshot import JobSnapshot, SnapshotError, write_snapshot
+from py_utils.logger import logger
+
+ENCODINGS = ("pickle", "compact")
+
+# Document fields holding the job in each encoding - a write in one encoding
+#   unsets the fields of the other
+_ENCODING_FIELDS = {"pickle": ("job_state",), "compact": ("schema", "job")}
+
+
+class _LazyJob(object):
+    """A cached job that hasn't been restored yet - restored the first time
+    it's needed. next_run_time is a UTC timestamp."""
+
+    __slots__ = ("id", "next_run_time")
+
+    def __init__(self, job_id, next_run_time):
+        self.id = job_id
+        self.next_run_time = next_run_time
+
+
+class _SnapshotJob(_LazyJob):
+    """A job still in the snapshot it was loaded from."""
+
+    __slots__ = ("snapshot", "offset", "length")
+
+    def __init__(self, job_id, next_run_time, snapshot, offset, length):
+        super(_SnapshotJob, self).__init__(job_id, next_run_time)
+        self.snapshot = snapshot
+        self.offset = offset
+        self.length = length
+
+    def job_state(self):
+        return self.snapshot.job_state(self.offset, self.length)
+
+
+class _DocumentJob(_LazyJob):
+    """A job loaded from a compact document, kept as the encoded fields."""
+
+    __slots__ = ("encoded",)
+
+    def __init__(self, job_id, next_run_time, encoded):
+        super(_DocumentJob, self).__init__(job_id, next_run_time)
+        self.encoded = encoded
+
+
+def _next_run_timestamp(job):
+    if isinstance(job, _LazyJob):
+        return job.next_run_time
+    return datetime_to_utc_timestamp(job.next_run_time)
+
+
+class CachedJobStore(BaseJobStore):
+    """Keeps every job decoded in memory in front of a MongoDBJobStore.
+
+    Lookups, the due job scan and the next wakeup calculation are served
+    from memory. Scheduled jobs are kept in a DueIndex by next run time, so
+    rescheduling or removing a job is O(log n) and a scheduler wakeup only
+    touches the jobs that are due. Changes are written to MongoDB either immediately
+    (write-through) or, with write_behind, collected and flushed in bulk every
+    flush_interval seconds. Pending writes for the same job are collapsed so
+    only the latest state is written. With write_behind, changes made within
+    the last flush_interval seconds are lost if the process dies.
+
+    The cache is loaded from MongoDB when the scheduler starts, so the
+    collection must only be written by this process while it is running.
+
+    When running sharded, set_ownership restricts the cache to the jobs this
+    process owns. Jobs owned by other processes stay in MongoDB untouched.
+
+    Every write stamps the job document with a new revision, an ObjectId,
+    and every removal leaves a tombstone with one in a "<collection>_tombstones"
+    collection, kept for tombstone_ttl seconds. A standby that does not write
+    to the collection itself calls refresh to catch up with the changes made
+    by the active scheduler. refresh only reads the documents and tombstones
+    with a revision newer than its previous catch up, less catch_up_overlap
+    seconds for writes that were in flight or stamped by a writer whose
+    clock is behind - clocks must be kept in sync to well within that - and
+    reloads the jobs whose revision differs from the cached one. The first
+    catch up, and one every full_catch_up_interval seconds, compares the
+    revision of every document instead, which also picks up removals made
+    without a tombstone.
+
+    With snapshot_path set the cache is also written to a local snapshot file
+    every snapshot_interval seconds and on shutdown. At startup the cache is
+    loaded from the snapshot instead of MongoDB and then caught up the same
+    way a standby refreshes, so only jobs changed since the snapshot are read
+    from MongoDB. Jobs from the snapshot are restored as they are first
+    needed and the rest in the background, so the scheduler can start firing
+    before every job has been unpickled. A missing, corrupt or outdated
+    snapshot is ignored and the cache loaded from MongoDB.
+
+    With the compact encoding jobs are stored as structured fields - the
+    trigger definition, arguments and options with a schema version - instead
+    of a pickled job state. Compact documents are smaller, can be queried and
+    are cheap to load: the cache keeps the loaded fields and only builds a Job
+    the first time it's needed. Jobs that can't be encoded (a trigger or
+    arguments with no plain representation) are still pickled. Documents
+    written in the other encoding are rewritten in the background a batch at
+    a time, without changing their revision, so a store can be migrated - or
+    moved back to pickle - while the scheduler runs.
+
+    """
+
+    def __init__(
+        self,
+        store,
+        write_behind=False,
+        flush_interval=1.0,
+        max_pending=5000,
+        intern_trigger=None,
+        snapshot_path=None,
+        snapshot_interval=300,
+        encoding="pickle",
+        migration_batch_size=500,
+        migration_pause=0.5,
+        tombstone_ttl=86400,
+        catch_up_overlap=60,
+        full_catch_up_interval=3600,
+    ):
+        """
+        :param MongoDBJobStore store: The persistent job store
+        :param bool write_behind: Flush writes periodically instead of
+            writing each change through to MongoDB
+        :param float flush_interval: Seconds between write-behind flushes
+        :param int max_pending: Pending writes that force an immediate flush
+        :param callable intern_trigger: Called with the trigger of every job
+            restored from MongoDB, returns the trigger the job should use -
+            lets restored jobs share identical triggers
+        :param str snapshot_path: Local file the cache is snapshotted to
+        :param float snapshot_interval: Seconds between snapshots
+        :param str encoding: How jobs are written to MongoDB - one of
+            ENCODINGS
+        :param int migration_batch_size: Documents rewritten per batch when
+            migrating to encoding
+        :param float migration_pause: Seconds between migration batches
+        :param float tombstone_ttl: Seconds tombstones of removed jobs are
+            kept - a catch up after a longer gap compares every revision
+        :param float catch_up_overlap: Seconds of changes before the previous
+            catch up that are read again
+        :param float full_catch_up_interval: Seconds between catch ups that
+            compare every revision
+
+        """
+        if encoding not in ENCODINGS:
+            raise ValueError("Unknown job store encoding {}".format(encoding))
+        super(CachedJobStore, self).__init__()
+        self._store = store
+        self._jobs = {}
+        self._due = DueIndex()
+        self._write_behind = write_behind
+        self._flush_interval = flush_interval
+        self._max_pending = max_pending
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        # Depth of the batch blocks each thread is in
+        self._batches = threading.local()
+        # Whether pending writes were kept by a failed flush
+        self._held = False
+        self._lock = threading.RLock()
+        self._owns = None
+        self._intern_trigger = intern_trigger
+        self._revisions = {}
+        self._tombstones = store.collection.database[
+            store.collection.name + "_tombstones"
+        ]
+        self._tombstone_ttl = tombstone_ttl
+        self._catch_up_overlap = timedelta(seconds=catch_up_overlap)
+        self._full_catch_up_interval = full_catch_up_interval
+        self._caught_up_to = None
+        self._last_full_catch_up = 0.0
+        self._flush_lock = threading.Lock()
+        self._stop_flushing = threading.Event()
+        self._flush_thread = None
+        self._snapshot_path = snapshot_path
+        self._snapshot_interval = snapshot_interval
+        self._snapshot = None
+        self._snapshot_lock = threading.Lock()
+        self._stop_snapshots = threading.Event()
+        self._snapshot_thread = None
+        self._restore_thread = None
+        self._encoding = encoding
+        self._migration_batch_size = migration_batch_size
+        self._migration_pause = migration_pause
+        self._stop_migration = threading.Event()
+        self._migration_thread = None
+
+    def start(self, scheduler, alias):
+        super(CachedJobStore, self).start(scheduler, alias)
+        self._store.start(scheduler, alias)
+        self._store.collection.create_index("revision")
+        self._tombstones.create_index("revision")
+        self._tombstones.create_index(
+            "deleted_at", expireAfterSeconds=int(self._tombstone_ttl)
+        )
+        self.load()
+        if self._write_behind:
+            self._stop_flushing.clear()
+            self._flush_thread = threading.Thread(
+                target=self._flush_periodically, name="jobstore-flush", daemon=True
+            )
+            self._flush_thread.start()
+        if self._snapshot_path:
+            self._stop_snapshots.clear()
+            self._snapshot_thread = threading.Thread(
+                target=self._snapshot_periodically,
+                name="jobstore-snapshot",
+                daemon=True,
+            )
+            self._snapshot_thread.start()
+        self._stop_migration.clear()
+        self._migration_thread = threading.Thread(
+            target=self._run_migration, name="jobstore-migration", daemon=True
+        )
+        self._migration_thread.start()
+
+    def load(self):
+        """Replace the cache contents with the jobs stored in MongoDB, or with
+        the snapshot caught up with MongoDB if there is a usable one."""
+        if self._snapshot_path and self._load_snapshot():
+            return
+        start = time.monotonic()
+        with self._lock:
+            self._clear_cache()
+            self._caught_up_to = datetime.utcnow()
+            self._last_full_catch_up = start
+            if self._owns is None:
+                jobs = self._load_jobs()
+            else:
+                jobs = self._load_jobs(self._owned_job_ids())
+            for job in jobs:
+                self._cache_job(job)
+            count = len(self._jobs)
+        logger.info(
+            "Loaded %d jobs into the job cache in %.2f seconds",
+            count,
+            time.monotonic() - start,
+        )
+
+    def _load_snapshot(self):
+        start = time.monotonic()
+        try:
+            snapshot = JobSnapshot(self._snapshot_path)
+        except SnapshotError as ex:
+            logger.info("Not loading the job cache from a snapshot - %s", ex)
+            return False
+
+        with self._lock:
+            self._clear_cache()
+            self._snapshot = snapshot
+            for job_id, revision, next_run_time, offset, length in snapshot:
+                if self._owns is not None and not self._owns(job_id):
+                    continue
+                self._cache_job(
+                    _SnapshotJob(job_id, next_run_time, snapshot, offset, length)
+                )
+                self._revisions[job_id] = revision
+            loaded = len(self._jobs)
+        removed, changed = self._catch_up()
+        logger.info(
+            "Loaded %d jobs into the job cache from a snapshot written %d seconds "
+            "ago in %.2f seconds - removed %d jobs, reloaded %d",
+            loaded,
+            time.time() - snapshot.created,
+            time.monotonic() - start,
+            removed,
+            changed,
+        )
+
+        self._restore_thread = threading.Thread(
+            target=self._restore_snapshot_jobs, name="jobstore-restore", daemon=True
+        )
+        self._restore_thread.start()
+        return True
+
+    def set_ownership(self, owns):
+        """Restrict the cache to jobs for which owns(job_id) returns True.
+        Newly owned jobs are loaded from MongoDB and jobs no longer owned are
+        dropped from memory (but not from MongoDB).
+
+        :param callable owns: Ownership test, or None to own every job
+
+        """
+        with self._lock:
+            self._owns = owns
+        if self._scheduler is not None:
+            self.rebalance()
+
+    def rebalance(self):
+        start = time.monotonic()
+        self.flush()
+        with self._lock:
+            owned = set(self._owned_job_ids())
+            cached = set(self._jobs)
+            for job_id in cached - owned:
+                self._uncache_job(job_id)
+            for job in self._load_jobs(owned - cached):
+                self._cache_job(job)
+        logger.info(
+            "Rebalanced job cache in %.2f seconds - dropped %d jobs, loaded %d, own %d",
+            time.monotonic() - start,
+            len(cached - owned),
+            len(owned - cached),
+            len(owned),
+        )
+        self._scheduler.wakeup()
+
+    def refresh(self):
+        """Bring the cache up to date with changes made to MongoDB by another
+        process. Only jobs that were added, removed or rewritten since they were
+        loaded are touched."""
+        start = time.monotonic()
+        removed, changed = self._catch_up()
+        if removed or changed:
+            logger.info(
+                "Refreshed job cache in %.2f seconds - removed %d jobs, reloaded %d",
+                time.monotonic() - start,
+                removed,
+                changed,
+            )
+        if self._scheduler is not None:
+            self._scheduler.wakeup()
+
+    def _catch_up(self):
+        """Drop the cached jobs removed from MongoDB and reload the ones whose
+        revision changed. Returns how many were removed and reloaded."""
+        started = datetime.utcnow()
+        since = self._caught_up_to
+        if (
+            since is None
+            or started - since
+            >= timedelta(seconds=self._tombstone_ttl) - self._catch_up_overlap
+            or time.monotonic() - self._last_full_catch_up
+            >= self._full_catch_up_interval
+        ):
+            self._last_full_catch_up = time.monotonic()
+            query = {}
+            deleted = None
+        else:
+            query = {
+                "revision": {
+                    "$gt": ObjectId.from_datetime(since - self._catch_up_overlap)
+                }
+            }
+            deleted = [
+                document["_id"] for document in self._tombstones.find(query, ["_id"])
+            ]
+        stored = {
+            document["_id"]: document.get("revision")
+            for document in self._store.collection.find(query, ["_id", "revision"])
+            if self._owns is None or self._owns(document["_id"])
+        }
+        with self._lock:
+            cached = set(self._jobs)
+            if deleted is None:
+                removed = cached - stored.keys()
+            else:
+                removed = cached.intersection(deleted) - stored.keys()
+            changed = [
+                job_id
+                for job_id, revision in stored.items()
+                if job_id not in cached or revision != self._revisions.get(job_id)
+            ]
+            for job_id in removed:
+                self._uncache_job(job_id)
+            for job in self._load_jobs(changed):
+                self._cache_job(job)
+            self._caught_up_to = started
+        return len(removed), len(changed)
+
+    def _write_tombstones(self, job_ids):
+        """Record the removal of jobs for the incremental catch up of other
+        processes - a tombstone that fails to be written is only noticed by
+        their next full catch up."""
+        now = datetime.utcnow()
+        requests = [
+            UpdateOne(
+                {"_id": job_id},
+                {"$set": {"revision": ObjectId(), "deleted_at": now}},
+                upsert=True,
+            )
+            for job_id in job_ids
+        ]
+        if not requests:
+            return
+        try:
+            self._tombstones.bulk_write(requests, ordered=False)
+        except Exception:
+            logger.exception("Failed to write tombstones of removed jobs")
+
+    def _owned_job_ids(self):
+        return [
+            document["_id"]
+            for document in self._store.collection.find({}, ["_id"])
+            if self._owns is None or self._owns(document["_id"])
+        ]
+
+    def _load_jobs(self, job_ids=None, chunk_size=1000):
+        """Restore the given jobs, or every job if job_ids is None, from
+        MongoDB and record their revisions. Compact documents are returned as
+        _DocumentJob placeholders."""
+        if job_ids is None:
+            queries = [{}]
+        else:
+            job_ids = list(job_ids)
+            queries = [
+                {"_id": {"$in": job_ids[i : i + chunk_size]}}
+                for i in range(0, len(job_ids), chunk_size)
+            ]
+        jobs = []
+        for query in queries:
+            for document in self._store.collection.find(
+                query,
+                ["_id", "next_run_time", "job_state", "schema", "job", "revision"],
+            ):
+                try:
+                    if "job_state" in document:
+                        job = self._restore_job(document["job_state"])
+                    elif document.get("schema") == SCHEMA_VERSION:
+                        job = _DocumentJob(
+                            document["_id"], document["next_run_time"], document["job"]
+                        )
+                    else:
+                        raise ValueError(
+                            "Unsupported job schema {}".format(document.get("schema"))
+                        )
+                    jobs.append(job)
+                except Exception:
+                    logger.exception("Unable to restore job %s", document["_id"])
+                    continue
+                self._revisions[document["_id"]] = document.get("revision")
+        return jobs
+
+    def _restore_job(self, job_state):
+        """A job from its pickled state"""
+        return self._job_from_state(pickle.loads(job_state))
+
+    def _decode_job(self, job_id, encoded):
+        """A job from the fields of a compact document"""
+        return self._job_from_state(decode_job_state(job_id, encoded))
+
+    def _job_from_state(self, state):
+        job = Job.__new__(Job)
+        job.__setstate__(state)
+        job._scheduler = self._scheduler
+        job._jobstore_alias = self._alias
+        if self._intern_trigger:
+            job.trigger = self._intern_trigger(job.trigger)
+        return job
+
+    def _restored(self, job_id):
+        """The cached job, restoring it first if it's still a placeholder.
+        Called holding the lock."""
+        job = self._jobs.get(job_id)
+        if not isinstance(job, _LazyJob):
+            return job
+        if isinstance(job, _DocumentJob):
+            try:
+                job = self._decode_job(job_id, job.encoded)
+            except Exception:
+                logger.exception("Unable to restore job %s", job_id)
+                self._uncache_job(job_id)
+                return None
+        else:
+            try:
+                job = self._restore_job(job.job_state())
+            except Exception:
+                logger.exception("Unable to restore job %s from the snapshot", job_id)
+                self._uncache_job(job_id)
+                for reloaded in self._load_jobs([job_id]):
+                    self._cache_job(reloaded)
+                return self._restored(job_id)
+        self._jobs[job_id] = job
+        return job
+
+    def job_ids(self):
+        """Ids of the cached jobs, without restoring any"""
+        with self._lock:
+            return list(self._jobs)
+
+    def _restore_snapshot_jobs(self, chunk_size=500):
+        """Restore the jobs still in the snapshot a chunk at a time, then let
+        go of the snapshot."""
+        start = time.monotonic()
+        with self._lock:
+            snapshot = self._snapshot
+            job_ids = [
+                job_id
+                for job_id, job in self._jobs.items()
+                if isinstance(job, _SnapshotJob)
+            ]
+        for i in range(0, len(job_ids), chunk_size):
+            with self._lock:
+                if self._snapshot is not snapshot:
+                    break
+                for job_id in job_ids[i : i + chunk_size]:
+                    job = self._jobs.get(job_id)
+                    if isinstance(job, _SnapshotJob) and job.snapshot is snapshot:
+                        self._restored(job_id)
+        with self._lock:
+            if self._snapshot is snapshot:
+                self._snapshot = None
+        snapshot.close()
+        logger.info(
+            "Restored the jobs loaded from the snapshot in %.2f seconds",
+            time.monotonic() - start,
+        )
+
+    def write_snapshot(self):
+        """Write the cached jobs to the snapshot file. Jobs are copied a chunk
+        at a time so the cache is never locked for long - a job changed while
+        the snapshot is written is recorded with either its old or new
+        revision, and the catch up after loading the snapshot rereads it from
+        MongoDB if that isn't the latest."""
+        start = time.monotonic()
+        with self._snapshot_lock:
+            with self._lock:
+                job_ids = list(self._jobs)
+            entries = []
+            for i in range(0, len(job_ids), 1000):
+                with self._lock:
+                    for job_id in job_ids[i : i + 1000]:
+                        job = self._jobs.get(job_id)
+                        if isinstance(job, _DocumentJob):
+                            job = self._restored(job_id)
+                        if job is None:
+                            continue
+                        if isinstance(job, _SnapshotJob):
+                            job_state = job.job_state()
+                        else:
+                            job_state = pickle.dumps(
+                                job.__getstate__(), self._store.pickle_protocol
+                            )
+                        entries.append(
+                            (
+                                job_id,
+                                self._revisions.get(job_id),
+                                _next_run_timestamp(job),
+                                job_state,
+                            )
+                        )
+            size = write_snapshot(self._snapshot_path, entries)
+        logger.info(
+            "Wrote a snapshot of %d jobs (%d bytes) in %.2f seconds",
+            len(entries),
+            size,
+            time.monotonic() - start,
+        )
+
+    def _snapshot_periodically(self):
+        while not self._stop_snapshots.wait(self._snapshot_interval):
+            try:
+                self.write_snapshot()
+            except Exception:
+                logger.exception("Failed to write the job store snapshot")
+
+    def _run_migration(self):
+        try:
+            self.migrate()
+        except Exception:
+            logger.exception(
+                "Failed to migrate job documents to the %s encoding", self._encoding
+            )
+
+    def migrate(self):
+        """Rewrite the documents stored in the other encoding in this
+        store's encoding, a batch at a time. Each document is only replaced if
+        its revision hasn't changed since it was read - a job rewritten in the
+        meantime is already in this store's encoding - and keeps its revision,
+        so caches holding the job don't reload it."""
+        start = time.monotonic()
+        other = "compact" if self._encoding == "pickle" else "pickle"
+        query = {_ENCODING_FIELDS[other][-1]: {"$exists": True}}
+        counts = dict.fromkeys(("migrated", "kept", "changed", "failed"), 0)
+        after_id = None
+        while not self._stop_migration.is_set():
+            if after_id is not None:
+                query["_id"] = {"$gt": after_id}
+            documents = list(
+                self._store.collection.find(
+                    query, ["job_state", "schema", "job", "revision"]
+                )
+                .sort("_id", 1)
+                .limit(self._migration_batch_size)
+            )
+            if not documents:
+                break
+            after_id = documents[-1]["_id"]
+            requests = []
+            for document in documents:
+                if self._owns is not None and not self._owns(document["_id"]):
+                    continue
+                try:
+                    request = self._migration_request(document)
+                except Exception:
+                    logger.exception("Unable to migrate job %s", document["_id"])
+                    counts["failed"] += 1
+                    continue
+                if request is None:
+                    counts["kept"] += 1
+                else:
+                    requests.append(request)
+            if requests:
+                result = self._store.collection.bulk_write(requests, ordered=False)
+                counts["migrated"] += result.modified_count
+                counts["changed"] += len(requests) - result.matched_count
+            self._stop_migration.wait(self._migration_pause)
+        if any(counts.values()):
+            logger.info(
+                "Migrated job documents to the %s encoding in %.2f seconds - "
+                "migrated %d, kept %d that can't be encoded, skipped %d changed "
+                "meanwhile, failed %d",
+                self._encoding,
+                time.monotonic() - start,
+                counts["migrated"],
+                counts["kept"],
+                counts["changed"],
+                counts["failed"],
+            )
+
+    def _migration_request(self, document):
+        """The conditional rewrite of a document in this store's encoding, or
+        None if the job can't be written in it."""
+        if "job_state" in document:
+            state = pickle.loads(document["job_state"])
+        else:
+            state = decode_job_state(document["_id"], document["job"])
+        job = Job.__new__(Job)
+        job.__setstate__(state)
+        fields = self._encode(job)
+        if fields is None:
+            return None
+        return UpdateOne(
+            {"_id": document["_id"], "revision": document.get("revision")},
+            self._update(fields),
+        )
+
+    def shutdown(self):
+        if self._migration_thread:
+            self._stop_migration.set()
+            self._migration_thread.join()
+            self._migration_thread = None
+        if self._flush_thread:
+            self._stop_flushing.set()
+            self._flush_thread.join()
+            self._flush_thread = None
+        if self._snapshot_thread:
+            self._stop_snapshots.set()
+            self._snapshot_thread.join()
+            self._snapshot_thread = None
+        self.flush()
+        if self._snapshot_path:
+            try:
+                self.write_snapshot()
+            except Exception:
+                logger.exception("Failed to write the job store snapshot")
+        self._store.shutdown()
+
+    def _cache_job(self, job):
+        self._jobs[job.id] = job
+        next_run_time = _next_run_timestamp(job)
+        if next_run_time is None:
+            self._due.remove(job.id)
+        else:
+            self._due.push(job.id, next_run_time)
+
+    def _uncache_job(self, job_id):
+        self._jobs.pop(job_id, None)
+        self._due.remove(job_id)
+        self._revisions.pop(job_id, None)
+
+    def _clear_cache(self):
+        # Jobs still in a previous snapshot are dropped with it - the restore
+        #   thread closes it
+        self._snapshot = None
+        self._jobs = {}
+        self._due.clear()
+        self._revisions = {}
+        self._caught_up_to = None
+
+    def lookup_job(self, job_id):
+        with self._lock:
+            return self._restored(job_id)
+
+    def get_due_jobs(self, now):
+        now_timestamp = datetime_to_utc_timestamp(now)
+        with self._lock:
+            jobs = [
+                self._restored(job_id) for _, job_id in self._due.due(now_timestamp)
+            ]
+            jobs = [job for job in jobs if job is not None]
+        return jobs
+
+    def get_next_run_time(self):
+        with self._lock:
+            earliest = self._due.peek()
+            return utc_timestamp_to_datetime(earliest[0]) if earliest else None
+
+    def get_all_jobs(self):
+        with self._lock:
+            jobs = [self._restored(job_id) for job_id in list(self._jobs)]
+            jobs = [job for job in jobs if job is not None]
+        # Same order as the other job stores - by next run time with paused jobs
+        #   last
+        return sorted(
+            jobs,
+            key=lambda job: (
+                job.next_run_time is None,
+                datetime_to_utc_timestamp(job.next_run_time) or 0,
+                job.id,
+            ),
+        )
+
+    def add_job(self, job):
+        with self._lock:
+            if job.id in self._jobs:
+                raise ConflictingIdError(job.id)
+            document = self._document(job)
+
+            def insert():
+                try:
+                    self._store.collection.insert_one(dict(document, _id=job.id))
+                except DuplicateKeyError:
+                    raise ConflictingIdError(job.id)
+
+            self._write(job.id, document, insert)
+            self._cache_job(job)
+            self._revisions[job.id] = document["revision"]
+
+    def update_job(self, job):
+        with self._lock:
+            if job.id not in self._jobs:
+                raise JobLookupError(job.id)
+            document = self._document(job)
+
+            def update():
+                result = self._store.collection.update_one(
+                    {"_id": job.id}, self._update(document)
+                )
+                if result.matched_count == 0:
+                    raise JobLookupError(job.id)
+
+            self._write(job.id, document, update)
+            self._cache_job(job)
+            self._revisions[job.id] = document["revision"]
+
+    def remove_job(self, job_id):
+        with self._lock:
+            if job_id not in self._jobs:
+                raise JobLookupError(job_id)
+
+            def remove():
+                self._store.remove_job(job_id)
+                self._write_tombstones([job_id])
+
+            self._write(job_id, None, remove)
+            self._uncache_job(job_id)
+
+    def remove_all_jobs(self):
+        with self._lock:
+            with self._pending_lock:
+                self._pending = {}
+            if self._owns is None:
+                self._store.remove_all_jobs()
+            else:
+                for job_id in self._jobs:
+                    self._store.remove_job(job_id)
+            self._write_tombstones(list(self._jobs))
+            self._clear_cache()
+
+    @contextmanager
+    def batch(self):
+        """Defer writes made by this thread inside the block and write them to
+        MongoDB in a single bulk write when the outermost block exits. Without
+        write_behind a failed bulk write is raised from the block, with the
+        jobs it was for reverted to their state in MongoDB."""
+        self._batches.depth = getattr(self._batches, "depth", 0) + 1
+        try:
+            yield
+        finally:
+            self._batches.depth -= 1
+        if self._batches.depth == 0:
+            self.flush()
+
+    def _defer_writes(self):
+        return self._write_behind or getattr(self._batches, "depth", 0) > 0
+
+    def _write(self, job_id, document, write_through):
+        """Write the new state of job_id - None if it was removed - by calling
+        write_through, or queue it to be flushed if writes are deferred. Called
+        holding the lock."""
+        if self._defer_writes():
+            self._queue_write(job_id, document)
+            return
+        with self._flush_lock:
+            with self._pending_lock:
+                queued = self._held or job_id in self._pending
+            if not queued:
+                write_through()
+                return
+        # The job has a write queued by another thread's batch, or writes were
+        #   kept by a failed flush - the new state is queued after them and
+        #   flushed now so a queued write can't overwrite it
+        self._queue_write(job_id, document)
+        self.flush()
+
+    def _document(self, job):
+        document = self._encode(job) or self._pickle(job)
+        document["next_run_time"] = datetime_to_utc_timestamp(job.next_run_time)
+        document["revision"] = ObjectId()
+        return document
+
+    def _encode(self, job):
+        """The fields holding job in this store's encoding, or None if it can't
+        be written in it."""
+        if self._encoding == "pickle":
+            return self._pickle(job)
+        encoded = encode_job(job)
+        if encoded is None:
+            return None
+        return {"schema": SCHEMA_VERSION, "job": encoded}
+
+    def _pickle(self, job):
+        return {
+            "job_state": Binary(
+                pickle.dumps(job.__getstate__(), self._store.pickle_protocol)
+            )
+        }
+
+    @staticmethod
+    def _update(document):
+        """Update setting the fields of document and removing those of the
+        other encoding."""
+        unset = {
+            field: ""
+            for fields in _ENCODING_FIELDS.values()
+            for field in fields
+            if field not in document
+        }
+        return {"$set": document, "$unset": unset}
+
+    def _queue_write(self, job_id, document):
+        """Record the latest state for job_id - None means the job was
+        removed."""
+        with self._pending_lock:
+            self._pending[job_id] = document
+            flush_now = len(self._pending) >= self._max_pending
+        if flush_now:
+            self.flush()
+
+    def _flush_periodically(self):
+        while not self._stop_flushing.wait(self._flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Failed to flush job store writes")
+
+    def flush(self):
+        """Write all pending changes to MongoDB with a single bulk write.
+
+        With write_behind, changes that fail to be written are kept for the
+        next flush. Otherwise the jobs they were for are reverted to their state
+        in MongoDB - or kept for the next flush if they can't be read either -
+        and the error raised.
+
+        """
+        error = None
+        with self._flush_lock:
+            with self._pending_lock:
+                pending = self._pending
+                self._pending = {}
+            if not pending:
+                return
+
+            requests = []
+            for job_id, document in pending.items():
+                if document is None:
+                    requests.append(DeleteOne({"_id": job_id}))
+                else:
+                    requests.append(
+                        UpdateOne({"_id": job_id}, self._update(document), upsert=True)
+                    )
+            try:
+                self._store.collection.bulk_write(requests, ordered=False)
+            except Exception as ex:
+                if self._write_behind:
+                    self._requeue(pending)
+                    raise
+                error = ex
+            else:
+                self._held = False
+                self._write_tombstones(
+                    [job_id for job_id, document in pending.items() if document is None]
+                )
+        if error is not None:
+            self._revert(pending)
+            raise error
+
+    def _requeue(self, pending):
+        # Put back anything that was not superseded while writing
+        with self._pending_lock:
+            for job_id, document in pending.items():
+                self._pending.setdefault(job_id, document)
+
+    def _revert(self, pending):
+        """Put the jobs whose pending writes failed back to their state in
+        MongoDB"""
+        job_ids = list(pending)
+        with self._lock:
+            try:
+                jobs = {job.id: job for job in self._load_jobs(job_ids)}
+            except Exception:
+                logger.exception(
+                    "Unable to revert %d jobs that failed to be written - keeping "
+                    "their writes for the next flush",
+                    len(job_ids),
+                )
+                self._requeue(pending)
+                self._held = True
+                return
+            for job_id in job_ids:
+                with self._pending_lock:
+                    if job_id in self._pending:
+                        # Changed again since the failed write
+                        continue
+                if job_id in jobs:
+                    self._cache_job(jobs[job_id])
+                else:
+                    self._uncache_job(job_id)
+        if self._scheduler is not None:
+            self._scheduler.wakeup()
+        logger.error(
+            "Failed to write %d jobs to MongoDB - reverted them to their stored state",
+            len(job_ids),
+        )
+
+    def __repr__(self):
+        return "<%s (store=%r)>" % (self.__class__.__name__, self._store)
@@ -0,0 +1,72 @@
+import threading
+
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+
+from apscheduler.jobstores.mongodb import MongoDBJobStore
+from apscheduler.schedulers.background import BackgroundScheduler
+from pytz import utc
+
+from py_utils.cached_jobstore import CachedJobStore
+
+
+def launch():
+    pass
+
+
+@pytest.fixture
+def scheduler():
+    client = mongomock.MongoClient()
+    store = CachedJobStore(
+        MongoDBJobStore(database="db", collection="jobs", client=client)
+    )
+    scheduler = BackgroundScheduler(jobstores={"default": store}, timezone=utc)
+    scheduler.start(paused=True)
+    yield scheduler
+    scheduler.shutdown(wait=False)
+
+
+def stored(scheduler, job_id):
+    return scheduler._jobstores["default"]._store.collection.find_one({"_id": job_id})
+
+
+def test_batch_only_defers_the_writes_of_its_own_thread(scheduler):
+    store = scheduler._jobstores["default"]
+    scheduler.add_job(launch, "interval", minutes=5, id="a")
+
+    with store.batch():
+        scheduler.pause_job("a")
+        other = threading.Thread(
+            target=scheduler.add_job,
+            args=(launch, "interval"),
+            kwargs={"minutes": 5, "id": "b"},
+        )
+        other.start()
+        other.join()
+        assert stored(scheduler, "b") is not None
+        assert stored(scheduler, "a")["next_run_time"] is not None
+
+    assert stored(scheduler, "a")["next_run_time"] is None
+
+
+def test_failed_batch_flush_reverts_its_jobs_and_raises(scheduler, monkeypatch):
+    store = scheduler._jobstores["default"]
+    scheduler.add_job(launch, "interval", minutes=5, id="a")
+
+    def bulk_write(requests, ordered=True):
+        raise RuntimeError("MongoDB unavailable")
+
+    monkeypatch.setattr(store._store.collection, "bulk_write", bulk_write)
+    with pytest.raises(RuntimeError):
+        with store.batch():
+            scheduler.pause_job("a")
+            scheduler.add_job(launch, "interval", minutes=5, id="b")
+
+    assert store.lookup_job("a").next_run_time is not None
+    assert store.lookup_job("b") is None
+    assert store._pending == {}
+
+    monkeypatch.undo()
+    scheduler.pause_job("a")
+    assert stored(scheduler, "a")["next_run_time"] is None
@@ -0,0 +1,235 @@
+import collections
+import heapq
+import itertools
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from py_utils.logger import logger
+
+ONE_MICROSECOND = timedelta(microseconds=1)
+
+# What to do with the fires a schedule missed while no scheduler was running -
+#   skip them, launch the latest one or launch every one
+POLICIES = ("skip", "once", "all")
+
+
+def missed_fire_times(trigger, next_run_time, now, earliest, limit=None):
+    """The fire times of a trigger from a job's next run time up to now,
+    leaving out those before earliest.
+
+    :param BaseTrigger trigger: The job's trigger
+    :param datetime next_run_time: The job's first missed fire time
+    :param datetime now: Timezone aware current time
+    :param datetime earliest: Fire times before this are left out, and not
+        counted
+    :param int limit: Keep only the latest limit fire times
+    :return: The fire times kept, oldest first, how many more there were and
+        the trigger's first fire time after now
+    :rtype: (list[datetime], int, datetime)
+
+    """
+    times = collections.deque(maxlen=limit)
+    left_out = 0
+    run_time = next_run_time
+    if run_time < earliest:
+        # Start from the first fire time after earliest instead of stepping
+        #   through the whole outage
+        run_time = trigger.get_next_fire_time(None, earliest)
+    while run_time is not None and run_time <= now:
+        if run_time >= earliest:
+            if limit is not None and len(times) == limit:
+                left_out += 1
+            times.append(run_time)
+        run_time = trigger.get_next_fire_time(run_time, run_time + ONE_MICROSECOND)
+    return list(times), left_out, run_time
+
+
+class CatchUp(object):
+    """Launches the fires schedules missed while no scheduler was running them,
+    at a controlled rate.
+
+    plan is given the jobs that are overdue when a scheduler starts or takes
+    over as leader, before it runs any of them. Each job's missed fires
+    within the lookback are found and, by the job's policy, skipped, reduced
+    to the latest one or all kept (at most max_fires_per_schedule, the latest
+    ones). plan returns the fires to launch and each job's next run time
+    after now, which the caller writes to the job store so the scheduler
+    doesn't run the missed fires itself.
+
+    release launches the fires oldest first, starting at most max_per_second
+    on a pool of max_workers threads, so the backlog of an outage doesn't
+    reach the API all at once. Progress is logged every progress_interval
+    seconds until the backlog is drained.
+
+    """
+
+    def __init__(
+        self,
+        launch,
+        enabled=None,
+        on_fires=None,
+        default_policy=None,
+        lookback=3600.0,
+        max_fires_per_schedule=100,
+        max_per_second=10.0,
+        max_workers=4,
+        progress_interval=10.0,
+    ):
+        """
+        :param callable launch: Called with a fire's scheduled time and the
+            job's id and kwargs to launch it
+        :param callable enabled: Returns False when the fires still waiting
+            should be dropped, e.g. once no longer the scheduler leader
+        :param callable on_fires: Called with an outcome ("released",
+            "skipped" or "dropped") and a number of fires
+        :param str default_policy: Policy of jobs without a catchUpPolicy -
+            when None, "once" for jobs that coalesce and "all" for the others
+        :param float lookback: Seconds before now missed fires are looked for
+        :param int max_fires_per_schedule: Most fires of one job launched
+            with the "all" policy
+        :param float max_per_second: Most fires launched per second
+        :param int max_workers: Threads launching fires
+        :param float progress_interval: Seconds between progress logs
+
+        """
+        if default_policy is not None and default_policy not in POLICIES:
+            raise ValueError("Unknown catch up policy {}".format(default_policy))
+        self._launch = launch
+        self._enabled = enabled or (lambda: True)
+        self._on_fires = on_fires
+        self._default_policy = default_policy
+        self._lookback = timedelta(seconds=lookback)
+        self._max_fires = max_fires_per_schedule
+        self._start_interval = 1.0 / max_per_second if max_per_second else 0
+        self._progress_interval = progress_interval
+        self._heap = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._stopping = False
+        self._released = 0
+        self._total = 0
+        self._thread = None
+        self._pool = ThreadPoolExecutor(max_workers, thread_name_prefix="catch-up")
+
+    def policy(self, job):
+        policy = job.kwargs.get("catchUpPolicy") or self._default_policy
+        if policy is None:
+            return "once" if job.coalesce else "all"
+        return policy
+
+    def plan(self, jobs, now):
+        """Work out the catch up of overdue jobs.
+
+        :param list jobs: Jobs with a next run time at or before now
+        :param datetime now: Timezone aware current time
+        :return: The fires to launch as (scheduled time, job id, job kwargs),
+            and the next run time after now of every job - None if its
+            trigger has no more fire times
+        :rtype: (list[tuple], dict)
+
+        """
+        fires = []
+        next_run_times = {}
+        skipped = 0
+        earliest = now - self._lookback
+        for job in jobs:
+            policy = self.policy(job)
+            limit = {"skip": 0, "once": 1}.get(policy, self._max_fires)
+            times, left_out, next_run_times[job.id] = missed_fire_times(
+                job.trigger, job.next_run_time, now, earliest, limit
+            )
+            skipped += left_out
+            fires.extend((run_time, job.id, job.kwargs) for run_time in times)
+        fires.sort(key=lambda fire: fire[0])
+        if skipped and self._on_fires:
+            self._on_fires("skipped", skipped)
+        logger.info(
+            "Catch up of %d overdue jobs: %d missed fires to launch, %d skipped",
+            len(jobs),
+            len(fires),
+            skipped,
+        )
+        return fires, next_run_times
+
+    def release(self, fires):
+        """Launch fires from plan, oldest first, at the configured rate."""
+        if not fires:
+            return
+        with self._condition:
+            if self._stopping:
+                return
+            for fire in fires:
+                heapq.heappush(self._heap, (fire[0], next(self._sequence), fire))
+            self._total += len(fires)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="catch-up", daemon=True
+                )
+                self._thread.start()
+            self._condition.notify()
+
+    def pending(self):
+        """Missed fires waiting to be launched"""
+        with self._condition:
+            return len(self._heap)
+
+    def stop(self):
+        """Drop the fires still waiting and wait for the launches in progress"""
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+            thread = self._thread
+        if thread:
+            thread.join()
+        self._pool.shutdown(wait=True)
+
+    def _run(self):
+        last_start = None
+        last_progress = time.monotonic()
+        while True:
+            with self._condition:
+                while not self._stopping and last_start is not None:
+                    delay = self._start_interval - (time.monotonic() - last_start)
+                    if delay <= 0:
+                        break
+                    self._condition.wait(delay)
+                if self._stopping or not self._heap or not self._enabled():
+                    self._drop()
+                    self._thread = None
+                    return
+                _, _, fire = heapq.heappop(self._heap)
+                self._released += 1
+                released, total = self._released, self._total
+            last_start = time.monotonic()
+            self._pool.submit(self._fire, fire)
+            if self._on_fires:
+                self._on_fires("released", 1)
+            if (
+                released == total
+                or last_start - last_progress >= self._progress_interval
+            ):
+                logger.info("Catch up: launched %d of %d missed fires", released, total)
+                last_progress = last_start
+
+    def _drop(self):
+        # Called with the condition held
+        if self._heap:
+            logger.warning(
+                "Catch up stopped with %d of %d missed fires not launched",
+                len(self._heap),
+                self._total,
+            )
+            if self._on_fires:
+                self._on_fires("dropped", len(self._heap))
+        self._heap = []
+        self._released = 0
+        self._total = 0
+
+    def _fire(self, fire):
+        try:
+            self._launch(*fire)
+        except Exception:
+            logger.exception("Unhandled exception launching missed fire of %s", fire[1])
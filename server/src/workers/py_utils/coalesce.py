@@ -0,0 +1,41 @@
+from py_utils.catch_up import missed_fire_times
+
+
+def coalesced_run_count(job, run_times):
+    """Runs of a job the scheduler folded into the last of run_times by
+    coalescing - to be called when the job is submitted, before its next run
+    time is moved past them.
+
+    :param Job job: The submitted job
+    :param list run_times: The run times the job was submitted with
+    :rtype: int
+
+    """
+    if not job.coalesce or not run_times or job.next_run_time is None:
+        return 0
+    if job.next_run_time >= run_times[-1]:
+        return 0
+    times, _, _ = missed_fire_times(
+        job.trigger, job.next_run_time, run_times[-1], job.next_run_time
+    )
+    return max(len(times) - 1, 0)
+
+
+class CoalesceCounting(object):
+    """Executor mixin that calls on_coalesced with the number of runs folded
+    away by coalescing each time a coalescing job is submitted. Counting
+    where jobs are submitted counts each run once, whichever job store the
+    job came from.
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._on_coalesced = kwargs.pop("on_coalesced", None)
+        super(CoalesceCounting, self).__init__(*args, **kwargs)
+
+    def submit_job(self, job, run_times):
+        super(CoalesceCounting, self).submit_job(job, run_times)
+        if self._on_coalesced:
+            count = coalesced_run_count(job, run_times)
+            if count:
+                self._on_coalesced(count)
@@ -0,0 +1,118 @@
+class DueIndex(object):
+    """Indexed binary min-heap of keys ordered by due time.
+
+    The position of every key in the heap is tracked so a key can be
+    rescheduled or removed in O(log n) without searching for it. Finding the
+    earliest key is O(1) and collecting the keys due by a given time costs
+    O(k log k) for k due keys, independent of how many keys are indexed.
+
+    Not thread safe - callers serialize access.
+
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._positions = {}
+
+    def __len__(self):
+        return len(self._heap)
+
+    def __contains__(self, key):
+        return key in self._positions
+
+    def push(self, key, due):
+        """Index key at due, or move it there if it is already indexed.
+
+        :param key: Unique, orderable key (the job id)
+        :param float due: Due time as a UTC timestamp
+
+        """
+        position = self._positions.get(key)
+        if position is None:
+            self._heap.append((due, key))
+            self._positions[key] = len(self._heap) - 1
+            self._sift_up(len(self._heap) - 1)
+            return
+        previous = self._heap[position]
+        self._heap[position] = (due, key)
+        if (due, key) < previous:
+            self._sift_up(position)
+        else:
+            self._sift_down(position)
+
+    def remove(self, key):
+        """Remove key from the index - a no-op if it is not indexed."""
+        position = self._positions.pop(key, None)
+        if position is None:
+            return
+        last = self._heap.pop()
+        if position == len(self._heap):
+            return
+        removed = self._heap[position]
+        self._heap[position] = last
+        self._positions[last[1]] = position
+        if last < removed:
+            self._sift_up(position)
+        else:
+            self._sift_down(position)
+
+    def clear(self):
+        self._heap = []
+        self._positions = {}
+
+    def peek(self):
+        """The earliest (due, key) pair, or None if the index is empty."""
+        return self._heap[0] if self._heap else None
+
+    def due(self, now):
+        """Every (due, key) pair due at or before now, earliest first.
+
+        :param float now: UTC timestamp
+
+        """
+        found = []
+        stack = [0] if self._heap else []
+        while stack:
+            position = stack.pop()
+            entry = self._heap[position]
+            if entry[0] > now:
+                continue
+            found.append(entry)
+            child = 2 * position + 1
+            if child < len(self._heap):
+                stack.append(child)
+                if child + 1 < len(self._heap):
+                    stack.append(child + 1)
+        found.sort()
+        return found
+
+    def _sift_up(self, position):
+        heap = self._heap
+        entry = heap[position]
+        while position > 0:
+            parent = (position - 1) >> 1
+            if heap[parent] <= entry:
+                break
+            heap[position] = heap[parent]
+            self._positions[heap[position][1]] = position
+            position = parent
+        heap[position] = entry
+        self._positions[entry[1]] = position
+
+    def _sift_down(self, position):
+        heap = self._heap
+        size = len(heap)
+        entry = heap[position]
+        while True:
+            child = 2 * position + 1
+            if child >= size:
+                break
+            if child + 1 < size and heap[child + 1] < heap[child]:
+                child += 1
+            if entry <= heap[child]:
+                break
+            heap[position] = heap[child]
+            self._positions[heap[position][1]] = position
+            position = child
+        heap[position] = entry
+        self._positions[entry[1]] = position
@@ -0,0 +1,297 @@
+import itertools
+import threading
+import time
+
+from collections import deque
+from concurrent.futures import Future
+
+from apscheduler.executors.pool import BasePoolExecutor
+
+# Seconds between sweeps of the keys that no longer have work
+SWEEP_INTERVAL = 60.0
+
+
+class Quota(object):
+    """A key's share of a FairSharePool.
+
+    :param float weight: Share of the workers relative to other keys with
+        queued work
+    :param float rate: Work started per second on average - 0 for no limit
+    :param float burst: Work that may be started at once after an idle
+        period - at least 1
+    :param int max_concurrent: Most workers running the key's work at once -
+        0 for no limit
+
+    """
+
+    __slots__ = ("weight", "rate", "burst", "max_concurrent")
+
+    def __init__(self, weight=1.0, rate=0.0, burst=1.0, max_concurrent=0):
+        if weight <= 0:
+            raise ValueError("weight must be positive")
+        self.weight = float(weight)
+        self.rate = float(rate)
+        self.burst = max(float(burst), 1.0)
+        self.max_concurrent = int(max_concurrent)
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, now):
+        if self.rate:
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate
+            )
+        self.updated = now
+
+    def wait(self, now):
+        """Seconds until a token is available"""
+        if not self.rate:
+            return 0.0
+        self.refill(now)
+        return max(0.0, (1.0 - self.tokens) / self.rate)
+
+    def take(self):
+        if self.rate:
+            self.tokens -= 1.0
+
+    def full(self, now):
+        self.refill(now)
+        return not self.rate or self.tokens >= self.burst
+
+
+class _Key(object):
+    __slots__ = ("quota", "bucket", "queue", "running", "last_finish")
+
+    def __init__(self, quota, now):
+        self.quota = quota
+        self.bucket = TokenBucket(quota.rate, quota.burst, now)
+        self.queue = deque()
+        self.running = 0
+        self.last_finish = 0.0
+
+
+class FairSharePool(object):
+    """A pool of worker threads shared fairly between the keys work is
+    submitted under, with the concurrent.futures submit/shutdown interface
+    APScheduler's pool executors use.
+
+    Work waits in a queue per key. Free workers take work by start-time fair
+    queuing: each piece of work is tagged with a virtual finish time 1/weight
+    after the later of its key's previous finish time and the pool's virtual
+    time, and the work with the earliest tag runs first. A key with a lot of
+    queued work is interleaved with the others instead of holding every
+    worker, and only slows its own work down.
+
+    A key's quota can also cap its rate with a token bucket and the workers
+    it holds at once. Work of a key over its quota stays queued - it's never
+    dropped - and on_throttled is called once for each piece of work held
+    back.
+
+    """
+
+    def __init__(
+        self,
+        max_workers,
+        key,
+        quota=None,
+        default_quota=None,
+        on_throttled=None,
+        on_start=None,
+        name="fair-share",
+    ):
+        """
+        :param int max_workers: Worker threads
+        :param callable key: Called with the arguments of submit - returns
+            the key the work is queued under
+        :param callable quota: Called with a key - returns its Quota, or None
+            for default_quota
+        :param Quota default_quota: Quota of keys without their own
+        :param callable on_throttled: Called with a key and "rate" or
+            "concurrency" when work of the key is held back by its quota
+        :param callable on_start: Called with a key and the seconds its work
+            waited when a worker starts it
+        :param str name: Prefix for the worker thread names
+
+        """
+        self._max_workers = max_workers
+        self._key = key
+        self._quota = quota or (lambda key: None)
+        self._default_quota = default_quota or Quota()
+        self._on_throttled = on_throttled
+        self._on_start = on_start
+        self._keys = {}
+        self._waiting = set()
+        self._last_sweep = time.monotonic()
+        self._queued = 0
+        self._virtual_time = 0.0
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._shutdown = False
+        self._threads = []
+        for i in range(max_workers):
+            thread = threading.Thread(
+                target=self._run, name="{}-{}".format(name, i), daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, fn, *args, **kwargs):
+        key = self._key(*args)
+        future = Future()
+        with self._condition:
+            if self._shutdown:
+                raise RuntimeError("cannot schedule new futures after shutdown")
+            now = time.monotonic()
+            if now - self._last_sweep >= SWEEP_INTERVAL:
+                self._sweep(now)
+            state = self._keys.get(key)
+            if state is None:
+                state = self._keys[key] = _Key(
+                    self._quota(key) or self._default_quota, now
+                )
+            start = max(self._virtual_time, state.last_finish)
+            state.last_finish = start + 1.0 / state.quota.weight
+            state.queue.append(
+                [state.last_finish, next(self._sequence), start, now, False]
+                + [future, fn, args, kwargs]
+            )
+            self._waiting.add(key)
+            self._queued += 1
+            self._condition.notify()
+        return future
+
+    def queued(self):
+        """Work waiting for a worker"""
+        with self._condition:
+            return self._queued
+
+    def keys(self):
+        """Keys with queued or running work, or a token bucket still refilling"""
+        with self._condition:
+            return len(self._keys)
+
+    def shutdown(self, wait=True):
+        """Stop taking work. The work already queued still runs, without the
+        rate limits."""
+        with self._condition:
+            self._shutdown = True
+            self._condition.notify_all()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def _next(self, now):
+        # Called with the condition held - the key and work to run next, or
+        #   None and the seconds until a rate limited key has a token
+        best = None
+        wake = None
+        for key in self._waiting:
+            state = self._keys[key]
+            work = state.queue[0]
+            quota = state.quota
+            if quota.max_concurrent and state.running >= quota.max_concurrent:
+                self._throttled(key, work, "concurrency")
+                continue
+            delay = 0.0 if self._shutdown else state.bucket.wait(now)
+            if delay > 0:
+                self._throttled(key, work, "rate")
+                wake = delay if wake is None else min(wake, delay)
+                continue
+            if best is None or work[:2] < best[1][:2]:
+                best = (key, work)
+        return best, wake
+
+    def _sweep(self, now):
+        # Forget idle keys once their token bucket has refilled - they'd start
+        #   over with a full bucket anyway
+        self._last_sweep = now
+        for key in [
+            key
+            for key, state in self._keys.items()
+            if not state.queue and not state.running and state.bucket.full(now)
+        ]:
+            del self._keys[key]
+
+    def _throttled(self, key, work, reason):
+        if not work[4]:
+            work[4] = True
+            if self._on_throttled:
+                self._on_throttled(key, reason)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    now = time.monotonic()
+                    best, wake = self._next(now)
+                    if best is not None:
+                        break
+                    if self._shutdown and not self._queued:
+                        return
+                    self._condition.wait(wake)
+                key, work = best
+                state = self._keys[key]
+                state.queue.popleft()
+                if not state.queue:
+                    self._waiting.discard(key)
+                state.bucket.take()
+                state.running += 1
+                self._queued -= 1
+                self._virtual_time = max(self._virtual_time, work[2])
+                if self._queued:
+                    # Another worker may be able to take the next piece of work
+                    self._condition.notify()
+            future, fn, args, kwargs = work[5:]
+            if self._on_start:
+                self._on_start(key, now - work[3])
+            if future.set_running_or_notify_cancel():
+                try:
+                    result = fn(*args, **kwargs)
+                except BaseException as ex:
+                    future.set_exception(ex)
+                else:
+                    future.set_result(result)
+            with self._condition:
+                state.running -= 1
+                if not state.queue and not state.running:
+                    if state.bucket.full(time.monotonic()):
+                        del self._keys[key]
+                    if not self._queued:
+                        # Idle - virtual time restarts so tags stay small
+                        self._virtual_time = 0.0
+                        for other in self._keys.values():
+                            other.last_finish = 0.0
+                # A key that was at its concurrency limit may have work to run
+                self._condition.notify()
+
+
+class FairShareExecutor(BasePoolExecutor):
+    """APScheduler executor that runs jobs on a FairSharePool, shared between
+    the values of a job keyword argument (the team id) instead of first come
+    first served.
+
+    """
+
+    def __init__(self, max_workers=10, key_kwarg="_teamId", **pool_kwargs):
+        """
+        :param int max_workers: Worker threads
+        :param str key_kwarg: Job keyword argument the jobs are shared by
+        :param pool_kwargs: FairSharePool keyword arguments
+
+        """
+        pool = FairSharePool(
+            max_workers, lambda job, *args: job.kwargs.get(key_kwarg), **pool_kwargs
+        )
+        super(FairShareExecutor, self).__init__(pool)
+
+    def queued(self):
+        return self._pool.queued()
+
+    def keys(self):
+        return self._pool.keys()
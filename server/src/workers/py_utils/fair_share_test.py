@@ -0,0 +1,142 @@
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("apscheduler")
+
+from py_utils.fair_share import FairSharePool, Quota, TokenBucket
+
+
+def test_token_bucket_refills_at_its_rate_up_to_its_burst():
+    bucket = TokenBucket(rate=2.0, burst=3.0, now=0.0)
+    for _ in range(3):
+        assert bucket.wait(0.0) == 0
+        bucket.take()
+
+    assert bucket.wait(0.0) == pytest.approx(0.5)
+    assert bucket.wait(0.25) == pytest.approx(0.25)
+    assert bucket.wait(1.0) == 0
+    assert bucket.tokens == pytest.approx(2.0)
+    assert not bucket.full(1.0)
+    assert bucket.full(10.0)
+    assert bucket.tokens == 3.0
+
+
+def test_token_bucket_without_a_rate_never_waits():
+    bucket = TokenBucket(rate=0.0, burst=1.0, now=0.0)
+    for _ in range(10):
+        bucket.take()
+
+    assert bucket.wait(0.0) == 0
+    assert bucket.full(0.0)
+
+
+class Recorder(object):
+    """Work for a FairSharePool that records the order it runs in - held back
+    until released"""
+
+    def __init__(self):
+        self.started = []
+        self.release = threading.Event()
+        self._lock = threading.Lock()
+
+    def __call__(self, team, name):
+        with self._lock:
+            self.started.append(team)
+        self.release.wait(5)
+
+
+def wait_for(condition):
+    deadline = time.monotonic() + 5
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def pool_of(max_workers, **kwargs):
+    return FairSharePool(max_workers, lambda team, name: team, **kwargs)
+
+
+def test_busy_team_is_interleaved_with_the_others():
+    work = Recorder()
+    pool = pool_of(1)
+    gate = threading.Event()
+    pool.submit(gate.wait, "gate", "gate")
+    futures = [pool.submit(work, "busy", i) for i in range(6)]
+    futures += [pool.submit(work, "quiet", i) for i in range(2)]
+
+    work.release.set()
+    gate.set()
+    for future in futures:
+        future.result(5)
+    pool.shutdown()
+
+    # The quiet team's work doesn't wait behind everything the busy team queued
+    assert work.started[:4] == ["busy", "quiet", "busy", "quiet"]
+
+
+def test_team_with_a_higher_weight_gets_a_bigger_share():
+    work = Recorder()
+    pool = pool_of(1, quota={"heavy": Quota(weight=2)}.get)
+    gate = threading.Event()
+    pool.submit(gate.wait, "gate", "gate")
+    futures = [pool.submit(work, "light", i) for i in range(4)]
+    futures += [pool.submit(work, "heavy", i) for i in range(4)]
+
+    work.release.set()
+    gate.set()
+    for future in futures:
+        future.result(5)
+    pool.shutdown()
+
+    assert work.started[:6].count("heavy") == 4
+
+
+def test_team_at_its_concurrency_limit_leaves_workers_to_the_others():
+    work = Recorder()
+    throttled = []
+    pool = pool_of(
+        2,
+        quota={"limited": Quota(max_concurrent=1)}.get,
+        on_throttled=lambda team, reason: throttled.append((team, reason)),
+    )
+    first = pool.submit(work, "limited", 0)
+    second = pool.submit(work, "limited", 1)
+    other = pool.submit(work, "other", 0)
+
+    # other starts on the second worker while limited holds the first
+    wait_for(lambda: len(work.started) == 2)
+    assert sorted(work.started) == ["limited", "other"]
+    assert throttled == [("limited", "concurrency")]
+
+    work.release.set()
+    for future in (first, second, other):
+        future.result(5)
+    pool.shutdown()
+
+
+def test_rate_limited_team_is_held_back_without_holding_up_the_others():
+    work = Recorder()
+    work.release.set()
+    throttled = []
+    pool = pool_of(
+        1,
+        quota={"limited": Quota(rate=0.5, burst=1)}.get,
+        on_throttled=lambda team, reason: throttled.append((team, reason)),
+    )
+    gate = threading.Event()
+    pool.submit(gate.wait, "gate", "gate")
+    limited = [pool.submit(work, "limited", i) for i in range(2)]
+    others = [pool.submit(work, "other", i) for i in range(3)]
+
+    gate.set()
+    for future in [limited[0]] + others:
+        future.result(5)
+
+    # The second launch of the limited team waits two seconds for a token
+    assert not limited[1].done()
+    assert work.started == ["limited", "other", "other", "other"]
+    assert throttled == [("limited", "rate")]
+    limited[1].result(5)
+    pool.shutdown()
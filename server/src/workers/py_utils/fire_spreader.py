@@ -0,0 +1,113 @@
+import hashlib
+import heapq
+import itertools
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from py_utils.logger import logger
+
+
+def spread_offset(key, window_seconds):
+    """Deterministic offset in [0, window_seconds) for key, so a schedule
+    always fires at the same point within its window.
+
+    :param str key: The schedule id
+    :param float window_seconds: Width of the window
+
+    """
+    if window_seconds <= 0:
+        return 0.0
+    window_ms = int(window_seconds * 1000)
+    if window_ms <= 0:
+        return 0.0
+    digest = hashlib.md5(str(key).encode("utf-8")).digest()
+    return (int.from_bytes(digest[:8], "big") % window_ms) / 1000.0
+
+
+class FireSpreader(object):
+    """Holds work until a release time and then runs it on a pool of worker
+    threads. Used to spread job launches that are due at the same instant
+    (top of the minute crons) over a window instead of sending them to the
+    API all at once.
+
+    """
+
+    def __init__(self, max_workers=20, name="fire-spreader"):
+        """
+        :param int max_workers: Threads running released work
+        :param str name: Prefix for the thread names
+
+        """
+        self._pool = ThreadPoolExecutor(max_workers, thread_name_prefix=name)
+        self._heap = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def defer(self, release_at, fn, *args):
+        """Run fn(*args) at release_at.
+
+        :param float release_at: Release time as a time.time() timestamp
+        :return: False if release_at has already passed or the spreader is
+            stopping, in which case fn is not queued and the caller should
+            run it straight away
+        :rtype: bool
+
+        """
+        with self._condition:
+            if self._stopping or release_at <= time.time():
+                return False
+            heapq.heappush(self._heap, (release_at, next(self._sequence), fn, args))
+            if self._heap[0][0] == release_at:
+                self._condition.notify()
+        return True
+
+    def pending(self):
+        with self._condition:
+            return len(self._heap)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._stopping:
+                    if self._heap:
+                        delay = self._heap[0][0] - time.time()
+                        if delay <= 0:
+                            break
+                        self._condition.wait(delay)
+                    else:
+                        self._condition.wait()
+                if self._stopping:
+                    return
+                now = time.time()
+                released = []
+                while self._heap and self._heap[0][0] <= now:
+                    released.append(heapq.heappop(self._heap))
+            for _, _, fn, args in released:
+                self._submit(fn, args)
+
+    def _submit(self, fn, args):
+        def run():
+            try:
+                fn(*args)
+            except Exception:
+                logger.exception("Unhandled exception in deferred launch")
+
+        self._pool.submit(run)
+
+    def stop(self):
+        """Release everything still held straight away and wait for it to
+        finish."""
+        with self._condition:
+            self._stopping = True
+            held = self._heap
+            self._heap = []
+            self._condition.notify()
+        self._thread.join()
+        for _, _, fn, args in sorted(held, key=lambda item: item[:2]):
+            self._submit(fn, args)
+        self._pool.shutdown(wait=True)
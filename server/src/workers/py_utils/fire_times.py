@@ -0,0 +1,274 @@
+import bisect
+
+from datetime import datetime, timedelta, timezone as fixed_timezone
+
+from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.cron.expressions import AllExpression, RangeExpression
+from apscheduler.triggers.cron.fields import MAX_VALUES, MIN_VALUES
+from apscheduler.triggers.interval import IntervalTrigger
+from apscheduler.util import datetime_ceil, localize
+from pytz import utc
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+EPOCH = datetime(1970, 1, 1, tzinfo=utc)
+ONE_MICROSECOND = timedelta(microseconds=1)
+ONE_DAY = timedelta(days=1)
+
+# Days of matching dates found per search, and the longest search before a
+#   cron trigger is handed back to APScheduler (e.g. 29 February on a Monday)
+CRON_HORIZON_DAYS = 400
+CRON_MAX_HORIZON_DAYS = 4 * 366 + 1
+
+
+def next_fire_times(triggers, now, count=1):
+    """The next count fire times of every trigger after now, computed as a
+    batch.
+
+    The result for each trigger is what calling get_next_fire_time on it
+    count times would return - get_next_fire_time(None, now) first, then
+    from each fire time in turn - stopping early when the trigger has no
+    more fire times.
+
+    Interval triggers are computed together with NumPy arrays. Cron triggers
+    are grouped by object, so interned triggers are computed once per
+    definition, and the dates matching each one are found with NumPy.
+    Near a daylight saving time change, and for triggers with jitter or cron
+    expressions other than ranges and steps, the trigger computes its own
+    fire times. Without NumPy every trigger does.
+
+    :param list triggers: APScheduler triggers
+    :param datetime now: Timezone aware current time
+    :param int count: Fire times per trigger
+    :rtype: list[list[datetime]]
+
+    """
+    groups = {}
+    for position, trigger in enumerate(triggers):
+        groups.setdefault(id(trigger), (trigger, []))[1].append(position)
+
+    results = [None] * len(triggers)
+    intervals = []
+    for trigger, positions in groups.values():
+        if (
+            numpy is not None
+            and type(trigger) is IntervalTrigger
+            and not trigger.jitter
+        ):
+            intervals.append((trigger, positions))
+            continue
+        if (
+            numpy is not None
+            and isinstance(trigger, CronTrigger)
+            and not trigger.jitter
+        ):
+            times = _cron_fire_times(trigger, now, count)
+        else:
+            times = _trigger_fire_times(trigger, now, count)
+        for position in positions:
+            results[position] = list(times)
+
+    if intervals:
+        for (trigger, positions), times in zip(
+            intervals, _interval_fire_times([t for t, _ in intervals], now, count)
+        ):
+            for position in positions:
+                results[position] = list(times)
+    return results
+
+
+def _trigger_fire_times(trigger, now, count, previous=None):
+    times = []
+    while len(times) < count:
+        previous = trigger.get_next_fire_time(previous, previous or now)
+        if previous is None:
+            break
+        times.append(previous)
+    return times
+
+
+def _micros(dateval):
+    return (dateval - EPOCH) // ONE_MICROSECOND
+
+
+def _interval_fire_times(triggers, now, count):
+    """Same arithmetic as IntervalTrigger.get_next_fire_time, including its
+    float division, over arrays of triggers."""
+    start = numpy.array([_micros(t.start_date) for t in triggers], dtype=numpy.int64)
+    step = numpy.array([t.interval // ONE_MICROSECOND for t in triggers], numpy.int64)
+    length = numpy.array([t.interval_length for t in triggers], dtype=numpy.float64)
+    end = numpy.array(
+        [
+            _micros(t.end_date) if t.end_date else numpy.iinfo(numpy.int64).max
+            for t in triggers
+        ],
+        dtype=numpy.int64,
+    )
+
+    elapsed = _micros(now) - start
+    # timedelta_seconds: whole seconds plus microseconds / 1000000.0
+    elapsed_seconds = (elapsed // 1000000).astype(numpy.float64) + (
+        elapsed % 1000000
+    ) / 1000000.0
+    intervals = numpy.where(
+        elapsed > 0, numpy.ceil(elapsed_seconds / length), 0
+    ).astype(numpy.int64)
+    times = (start + intervals * step)[:, None] + numpy.arange(count) * step[:, None]
+    fires = times <= end[:, None]
+
+    results = []
+    for trigger, row, row_fires in zip(triggers, times.tolist(), fires.tolist()):
+        results.append(
+            [
+                (EPOCH + timedelta(microseconds=micros)).astimezone(trigger.timezone)
+                for micros, fire in zip(row, row_fires)
+                if fire
+            ]
+        )
+    return results
+
+
+def _values_mask(expressions, values, field_name):
+    """Which of values match any of a cron field's expressions, or None if
+    an expression isn't a plain range or step."""
+    minval = MIN_VALUES[field_name]
+    maxval = MAX_VALUES[field_name]
+    mask = numpy.zeros(values.shape, dtype=bool)
+    for expression in expressions:
+        # Subclasses overriding get_next_value (last, 1st mon) depend on the
+        #   month as well as the value
+        get_next_value = type(expression).get_next_value
+        if get_next_value is RangeExpression.get_next_value:
+            low = max(minval, expression.first)
+            high = maxval if expression.last is None else expression.last
+        elif get_next_value is AllExpression.get_next_value:
+            low, high = minval, maxval
+        else:
+            return None
+        matches = (values >= low) & (values <= high)
+        if expression.step:
+            matches &= (values - low) % expression.step == 0
+        mask |= matches
+    return mask
+
+
+class _CronDates(object):
+    """The local dates and times of day a cron trigger fires on."""
+
+    def __init__(self, fields):
+        self._fields = {field.name: field.expressions for field in fields}
+        hours = self._allowed("hour", 24)
+        minutes = self._allowed("minute", 60)
+        seconds = self._allowed("second", 60)
+        self.supported = not (
+            hours is None
+            or minutes is None
+            or seconds is None
+            or any(f.name == "week" and not f.is_default for f in fields)
+        )
+        if self.supported:
+            self.times = (
+                hours[:, None, None] * 3600
+                + minutes[None, :, None] * 60
+                + seconds[None, None, :]
+            ).ravel()
+            self.supported = len(self.times) > 0
+        self._days = numpy.array([], dtype="datetime64[D]")
+
+    def _allowed(self, field_name, size):
+        values = numpy.arange(size)
+        mask = _values_mask(self._fields[field_name], values, field_name)
+        return None if mask is None else values[mask]
+
+    def _find_days(self, first_day, horizon):
+        days = first_day + numpy.arange(horizon)
+        months = days.astype("datetime64[M]")
+        mask = _values_mask(
+            self._fields["year"],
+            months.astype("datetime64[Y]").astype(int) + 1970,
+            "year",
+        )
+        for field_name, values in (
+            ("month", months.astype(int) % 12 + 1),
+            ("day", (days - months).astype(int) + 1),
+            ("day_of_week", (days.astype(int) + 3) % 7),
+        ):
+            field_mask = _values_mask(self._fields[field_name], values, field_name)
+            if mask is None or field_mask is None:
+                self.supported = False
+                return
+            mask &= field_mask
+        self._days = days[mask]
+
+    def next_local(self, local):
+        """The first local fire time at or after local, None if there isn't
+        one within CRON_MAX_HORIZON_DAYS."""
+        day = numpy.datetime64(local.date(), "D")
+        time = local.hour * 3600 + local.minute * 60 + local.second
+        for horizon in (None, CRON_HORIZON_DAYS, CRON_MAX_HORIZON_DAYS):
+            if horizon is not None:
+                self._find_days(day, horizon)
+                if not self.supported:
+                    return None
+            index = numpy.searchsorted(self._days, day)
+            if index < len(self._days) and self._days[index] == day:
+                time_index = numpy.searchsorted(self.times, time)
+                if time_index < len(self.times):
+                    return self._local(day, self.times[time_index])
+                index += 1
+            if index < len(self._days):
+                return self._local(self._days[index], self.times[0])
+        return None
+
+    @staticmethod
+    def _local(day, time):
+        return datetime.combine(day.item(), datetime.min.time()) + timedelta(
+            seconds=int(time)
+        )
+
+
+def _offset_is_fixed(timezone, start, end):
+    """Whether timezone keeps the same UTC offset from a day before start to
+    a day after end."""
+    transitions = getattr(timezone, "_utc_transition_times", None)
+    if transitions is None:
+        return hasattr(timezone, "localize") or isinstance(timezone, fixed_timezone)
+    low = (start - ONE_DAY).astimezone(utc).replace(tzinfo=None)
+    high = (end + ONE_DAY).astimezone(utc).replace(tzinfo=None)
+    index = bisect.bisect_right(transitions, low)
+    return index >= len(transitions) or transitions[index] > high
+
+
+def _cron_fire_times(trigger, now, count):
+    """CronTrigger.get_next_fire_time walks the local calendar one field at
+    a time - this finds the same local times with NumPy and only defers to
+    the trigger when the UTC offset changes nearby."""
+    dates = _CronDates(trigger.fields)
+    if not dates.supported:
+        return _trigger_fire_times(trigger, now, count)
+    times = []
+    previous = None
+    while len(times) < count:
+        if previous:
+            start = previous + ONE_MICROSECOND
+        elif trigger.start_date:
+            start = max(now, trigger.start_date)
+        else:
+            start = now
+        start = datetime_ceil(start).astimezone(trigger.timezone)
+        local = dates.next_local(start.replace(tzinfo=None))
+        fire_time = None if local is None else localize(local, trigger.timezone)
+        if fire_time is None or not _offset_is_fixed(
+            trigger.timezone, start, fire_time
+        ):
+            return times + _trigger_fire_times(
+                trigger, now, count - len(times), previous
+            )
+        if trigger.end_date and fire_time > trigger.end_date:
+            break
+        times.append(fire_time)
+        previous = fire_time
+    return times
@@ -0,0 +1,142 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+pytest.importorskip("numpy")
+hypothesis = pytest.importorskip("hypothesis")
+
+from hypothesis import given, settings, strategies as st
+from pytz import timezone, utc
+
+from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
+
+from py_utils.fire_times import next_fire_times
+
+TIMEZONES = [
+    "UTC",
+    "America/New_York",
+    "Europe/London",
+    "Australia/Lord_Howe",
+    "Asia/Kolkata",
+    "Etc/GMT+5",
+]
+
+dates = st.datetimes(
+    min_value=datetime(2020, 1, 1), max_value=datetime(2030, 12, 31)
+).map(lambda d: utc.localize(d))
+
+
+def field(low, high):
+    value = st.integers(low, high)
+    return st.one_of(
+        st.just("*"),
+        st.integers(1, high - low).map("*/{}".format),
+        value.map(str),
+        st.tuples(value, value).map(lambda r: "{}-{}".format(min(r), max(r))),
+        st.tuples(st.integers(low, high - 1), st.integers(1, 5), st.integers(1, 4)).map(
+            lambda r: "{}-{}/{}".format(
+                r[0], min(high, r[0] + r[1] * r[2]), min(r[1], high - r[0])
+            )
+        ),
+        st.tuples(value, value).map(lambda r: "{},{}".format(*r)),
+    )
+
+
+cron_triggers = st.builds(
+    lambda month, day, day_of_week, hour, minute, second, tz, start, end: CronTrigger(
+        month=month,
+        day=day,
+        day_of_week=day_of_week,
+        hour=hour,
+        minute=minute,
+        second=second,
+        timezone=tz,
+        start_date=start,
+        end_date=end,
+    ),
+    month=st.one_of(st.none(), field(1, 12)),
+    # Days past the 28th are left out - a schedule that can never fire (30
+    #   February) makes CronTrigger search up to the year 9999
+    day=st.one_of(st.none(), field(1, 28), st.sampled_from(["last", "1st mon"])),
+    day_of_week=st.one_of(st.none(), field(0, 6), st.just("mon-fri")),
+    hour=st.one_of(st.none(), field(0, 23)),
+    minute=st.one_of(st.just("0"), field(0, 59)),
+    second=st.one_of(st.just("0"), field(0, 59)),
+    tz=st.sampled_from(TIMEZONES),
+    start=st.one_of(st.none(), dates),
+    end=st.one_of(st.none(), dates),
+)
+
+interval_triggers = st.builds(
+    lambda days, hours, minutes, seconds, tz, start, end: IntervalTrigger(
+        days=days,
+        hours=hours,
+        minutes=minutes,
+        seconds=seconds or 1,
+        timezone=tz,
+        start_date=start,
+        end_date=end,
+    ),
+    days=st.integers(0, 40),
+    hours=st.integers(0, 30),
+    minutes=st.integers(0, 90),
+    seconds=st.integers(0, 90),
+    tz=st.sampled_from(TIMEZONES),
+    start=dates,
+    end=st.one_of(st.none(), dates),
+)
+
+
+def trigger_fire_times(trigger, now, count):
+    times = []
+    previous = None
+    while len(times) < count:
+        previous = trigger.get_next_fire_time(previous, previous or now)
+        if previous is None:
+            break
+        times.append(previous)
+    return times
+
+
+@settings(max_examples=200, deadline=None)
+@given(triggers=st.lists(cron_triggers, min_size=1, max_size=5), now=dates)
+def test_cron_matches_trigger(triggers, now):
+    assert next_fire_times(triggers, now, 5) == [
+        trigger_fire_times(t, now, 5) for t in triggers
+    ]
+
+
+@settings(max_examples=200, deadline=None)
+@given(triggers=st.lists(interval_triggers, min_size=1, max_size=5), now=dates)
+def test_interval_matches_trigger(triggers, now):
+    assert next_fire_times(triggers, now, 5) == [
+        trigger_fire_times(t, now, 5) for t in triggers
+    ]
+
+
+def test_dst_changes():
+    tz = timezone("America/New_York")
+    triggers = [
+        CronTrigger(hour="*", minute="30", timezone=tz),
+        CronTrigger(hour="1-3", minute="*/20", timezone=tz),
+        CronTrigger(hour="2", minute="30", timezone=tz),
+    ]
+    for now in (
+        tz.localize(datetime(2026, 3, 7, 23, 45)),
+        tz.localize(datetime(2026, 10, 31, 23, 45)),
+    ):
+        for minutes in range(0, 6 * 60, 7):
+            at = now + timedelta(minutes=minutes)
+            assert next_fire_times(triggers, at, 8) == [
+                trigger_fire_times(t, at, 8) for t in triggers
+            ]
+
+
+def test_shared_trigger_results_are_not_aliased():
+    trigger = CronTrigger(minute="*/5", timezone=utc)
+    now = utc.localize(datetime(2026, 1, 1))
+    first, second = next_fire_times([trigger, trigger], now, 2)
+    assert first == second
+    first.append(None)
+    assert len(second) == 2
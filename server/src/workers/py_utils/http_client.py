@@ -0,0 +1,297 @@
+import random
+import threading
+import time
+
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from py_utils.logger import logger
+
+try:
+    from requests.packages.urllib3.exceptions import NewConnectionError
+except ImportError:
+    # Older urllib3 versions don't tell a refused connection from a dropped one
+    NewConnectionError = None
+
+
+def connection_not_made(ex):
+    """Whether a request failed before the connection to the server was made,
+    so the server can't have seen it.
+
+    :param requests.exceptions.RequestException ex: The request's exception
+    :rtype: bool
+
+    """
+    if isinstance(ex, requests.exceptions.ConnectTimeout):
+        return True
+    if NewConnectionError is None or not isinstance(
+        ex, requests.exceptions.ConnectionError
+    ):
+        return False
+    # requests wraps urllib3's MaxRetryError, whose reason is the real error
+    reason = ex.args[0] if ex.args else None
+    return isinstance(getattr(reason, "reason", reason), NewConnectionError)
+
+
+class CircuitOpenError(Exception):
+    """Raised when a request is refused because the circuit for the target
+    host is open."""
+
+
+class CircuitBreaker(object):
+    """Tracks consecutive failures for a single host. After
+    failure_threshold consecutive failures the circuit opens and requests
+    are refused until reset_timeout seconds have elapsed. A single trial
+    request is then allowed through (half open) - if it succeeds the circuit
+    closes, otherwise it opens again.
+
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name, failure_threshold, reset_timeout):
+        self.name = name
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._state = CircuitBreaker.CLOSED
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self.times_opened = 0
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state
+
+    def allow_request(self):
+        with self._lock:
+            if self._state == CircuitBreaker.CLOSED:
+                return True
+            if self._state == CircuitBreaker.OPEN:
+                if time.monotonic() - self._opened_at < self._reset_timeout:
+                    return False
+                self._state = CircuitBreaker.HALF_OPEN
+                self._trial_in_flight = False
+            if self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            if self._state != CircuitBreaker.CLOSED:
+                logger.info("Circuit for %s closed", self.name)
+            self._state = CircuitBreaker.CLOSED
+            self._consecutive_failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._consecutive_failures += 1
+            self._trial_in_flight = False
+            if self._state == CircuitBreaker.HALF_OPEN or (
+                self._state == CircuitBreaker.CLOSED
+                and self._consecutive_failures >= self._failure_threshold
+            ):
+                self._state = CircuitBreaker.OPEN
+                self._opened_at = time.monotonic()
+                self.times_opened += 1
+                logger.warning(
+                    "Circuit for %s opened after %d consecutive failures",
+                    self.name,
+                    self._consecutive_failures,
+                )
+
+
+class ApiClient(object):
+    """Shared HTTP client used for all calls to the SaaSGlue API.
+
+    A single requests.Session is shared by every thread so TCP/TLS
+    connections are kept alive and reused. Connections are pooled per host
+    with pool_maxsize connections, which should match the number of threads
+    making concurrent calls (the scheduler executor).
+
+    Failures to make a connection are retried for every method with jittered
+    exponential backoff. Other connection errors (a kept-alive connection
+    dropped after the request was sent), read timeouts and 5xx responses are
+    only retried for the methods in retry_methods since the server may
+    already have acted on the request - retrying a launch POST could launch
+    the job twice.
+
+    """
+
+    def __init__(
+        self,
+        pool_connections=4,
+        pool_maxsize=20,
+        connect_timeout=5,
+        read_timeout=30,
+        max_retries=3,
+        backoff_base=0.25,
+        backoff_max=5,
+        retry_methods=("GET", "PUT", "DELETE"),
+        circuit_failure_threshold=20,
+        circuit_reset_timeout=30,
+        verify=False,
+    ):
+        """Create the client.
+
+        :param int pool_connections: Number of per-host pools to cache
+        :param int pool_maxsize: Max keep-alive connections per host
+        :param float connect_timeout: Seconds to wait for a connection
+        :param float read_timeout: Seconds to wait for a response
+        :param int max_retries: Retries after the first attempt
+        :param float backoff_base: Backoff for the first retry in seconds
+        :param float backoff_max: Upper bound for a single backoff in seconds
+        :param tuple retry_methods: Methods retried on dropped connections,
+            read timeouts and 5xx
+        :param int circuit_failure_threshold: Consecutive failures that open
+            the circuit for a host
+        :param float circuit_reset_timeout: Seconds before an open circuit
+            lets a trial request through
+        :param bool verify: Verify TLS certificates
+
+        """
+        self._timeout = (connect_timeout, read_timeout)
+        self._max_retries = max_retries
+        self._backoff_base = backoff_base
+        self._backoff_max = backoff_max
+        self._retry_methods = set(m.upper() for m in retry_methods)
+        self._circuit_failure_threshold = circuit_failure_threshold
+        self._circuit_reset_timeout = circuit_reset_timeout
+        self._verify = verify
+
+        self._adapter = HTTPAdapter(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            max_retries=0,
+        )
+        self._session = requests.Session()
+        self._session.mount("http://", self._adapter)
+        self._session.mount("https://", self._adapter)
+
+        self._lock = threading.Lock()
+        self._breakers = {}
+        self._stats = {
+            "requests": 0,
+            "attempts": 0,
+            "retries": 0,
+            "connection_errors": 0,
+            "server_errors": 0,
+            "circuit_rejections": 0,
+        }
+
+    def _breaker(self, host):
+        with self._lock:
+            breaker = self._breakers.get(host)
+            if breaker is None:
+                breaker = CircuitBreaker(
+                    host,
+                    self._circuit_failure_threshold,
+                    self._circuit_reset_timeout,
+                )
+                self._breakers[host] = breaker
+            return breaker
+
+    def _count(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def _backoff(self, attempt):
+        ceiling = min(self._backoff_max, self._backoff_base * (2**attempt))
+        time.sleep(random.uniform(0, ceiling))
+
+    def request(self, method, url, headers=None, data=None):
+        """Send a request, retrying transient failures.
+
+        :param str method: HTTP method
+        :param str url: Fully qualified url
+        :param dict headers: Request headers
+        :param str data: Request body
+        :rtype: requests.Response
+        :raises CircuitOpenError: if the circuit for the host is open
+        :raises requests.exceptions.RequestException: if the final attempt
+            failed without a response
+
+        """
+        method = method.upper()
+        breaker = self._breaker(urlsplit(url).netloc)
+        self._count("requests")
+
+        attempt = 0
+        while True:
+            if not breaker.allow_request():
+                self._count("circuit_rejections")
+                raise CircuitOpenError(
+                    "Circuit for {} is {}".format(breaker.name, breaker.state)
+                )
+
+            self._count("attempts")
+            try:
+                res = self._session.request(
+                    method,
+                    url,
+                    headers=headers,
+                    data=data,
+                    timeout=self._timeout,
+                    verify=self._verify,
+                )
+            except requests.exceptions.RequestException as ex:
+                self._count("connection_errors")
+                breaker.record_failure()
+                retryable = connection_not_made(ex) or (
+                    method in self._retry_methods
+                    and isinstance(
+                        ex,
+                        (
+                            requests.exceptions.ConnectionError,
+                            requests.exceptions.Timeout,
+                        ),
+                    )
+                )
+                if not retryable or attempt >= self._max_retries:
+                    raise
+            else:
+                if res.status_code < 500:
+                    breaker.record_success()
+                    return res
+                self._count("server_errors")
+                breaker.record_failure()
+                if method not in self._retry_methods or attempt >= self._max_retries:
+                    return res
+
+            self._count("retries")
+            self._backoff(attempt)
+            attempt += 1
+
+    def stats(self):
+        """Return request, retry, circuit and connection pool counters."""
+        with self._lock:
+            stats = dict(self._stats)
+            breakers = list(self._breakers.values())
+
+        stats["circuits"] = {
+            b.name: {"state": b.state, "times_opened": b.times_opened} for b in breakers
+        }
+
+        pools = {}
+        pool_manager = self._adapter.poolmanager
+        for key in pool_manager.pools.keys():
+            pool = pool_manager.pools.get(key)
+            if pool is None:
+                continue
+            pools["{}:{}".format(pool.host, pool.port)] = {
+                "connections_opened": getattr(pool, "num_connections", 0),
+                "requests": getattr(pool, "num_requests", 0),
+            }
+        stats["pools"] = pools
+        return stats
+
+    def close(self):
+        self._session.close()
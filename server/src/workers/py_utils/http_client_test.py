@@ -0,0 +1,86 @@
+import pytest
+import requests
+
+from requests.packages.urllib3.exceptions import MaxRetryError, NewConnectionError
+
+from py_utils.http_client import ApiClient, connection_not_made
+
+URL = "http://api.test/api/v0/job"
+
+
+def refused():
+    # What requests raises when nothing is listening on the port
+    return requests.exceptions.ConnectionError(
+        MaxRetryError(None, URL, NewConnectionError(None, "Connection refused"))
+    )
+
+
+def read_timeout():
+    return requests.exceptions.ReadTimeout("Read timed out")
+
+
+def dropped():
+    # A kept-alive connection closed by the server after the request was sent
+    return requests.exceptions.ConnectionError("Connection reset by peer")
+
+
+class FakeResponse(object):
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+class FakeSession(object):
+    """Fails with each of outcomes in turn, then answers 201"""
+
+    def __init__(self, outcomes):
+        self._outcomes = list(outcomes)
+        self.attempts = 0
+
+    def request(self, method, url, **kwargs):
+        self.attempts += 1
+        outcome = self._outcomes.pop(0) if self._outcomes else 201
+        if isinstance(outcome, Exception):
+            raise outcome
+        return FakeResponse(outcome)
+
+
+def client_with(outcomes):
+    client = ApiClient(backoff_base=0)
+    client._session = FakeSession(outcomes)
+    return client
+
+
+@pytest.mark.parametrize(
+    "error", [requests.exceptions.ConnectTimeout("Connect timed out"), refused()]
+)
+def test_post_that_never_reached_the_api_is_retried(error):
+    client = client_with([error])
+
+    assert client.request("POST", URL).status_code == 201
+    assert client._session.attempts == 2
+    assert connection_not_made(error)
+
+
+@pytest.mark.parametrize("error", [read_timeout(), dropped()])
+def test_post_the_api_may_have_seen_is_not_retried(error):
+    client = client_with([error])
+
+    with pytest.raises(type(error)):
+        client.request("POST", URL)
+    assert client._session.attempts == 1
+    assert not connection_not_made(error)
+
+
+def test_post_answered_with_a_server_error_is_not_retried():
+    client = client_with([503])
+
+    assert client.request("POST", URL).status_code == 503
+    assert client._session.attempts == 1
+
+
+@pytest.mark.parametrize("outcome", [read_timeout(), dropped(), 503])
+def test_put_is_retried_whatever_the_failure(outcome):
+    client = client_with([outcome])
+
+    assert client.request("PUT", URL).status_code == 201
+    assert client._session.attempts == 2
@@ -0,0 +1,176 @@
+from datetime import datetime, timezone as dt_timezone
+
+from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.date import DateTrigger
+from apscheduler.triggers.interval import IntervalTrigger
+from apscheduler.util import astimezone
+
+SCHEMA_VERSION = 1
+
+_INT64_MIN = -(2**63)
+_INT64_MAX = 2**63 - 1
+
+
+def _encode_datetime(value):
+    return value.isoformat() if value is not None else None
+
+
+def _decode_datetime(value, timezone):
+    if value is None:
+        return None
+    return datetime.fromisoformat(value).astimezone(timezone)
+
+
+def _bson_safe(value):
+    """Whether value is stored in a BSON document as is and comes back equal -
+    dict keys must be strings MongoDB accepts in a field name."""
+    if value is None or isinstance(value, (bool, float, str)):
+        return True
+    if isinstance(value, int):
+        return _INT64_MIN <= value <= _INT64_MAX
+    if isinstance(value, list):
+        return all(_bson_safe(v) for v in value)
+    if isinstance(value, dict):
+        return all(
+            isinstance(k, str)
+            and k
+            and "." not in k
+            and not k.startswith("$")
+            and "\0" not in k
+            and _bson_safe(v)
+            for k, v in value.items()
+        )
+    return False
+
+
+def _zone(timezone):
+    # Only named time zones can be rebuilt from their name - pytz ones have a
+    #   zone, zoneinfo ones (APScheduler 3.11 and later) a key, and APScheduler
+    #   3.11 turns "UTC" into datetime.timezone.utc
+    if timezone is dt_timezone.utc:
+        return "UTC"
+    return getattr(timezone, "zone", None) or getattr(timezone, "key", None)
+
+
+def encode_trigger(trigger):
+    """A cron, interval or date trigger as a dict of plain fields, or None for
+    any other trigger."""
+    if isinstance(trigger, DateTrigger):
+        zone = _zone(trigger.run_date.tzinfo)
+        if zone is None:
+            return None
+        return {
+            "type": "date",
+            "run_date": _encode_datetime(trigger.run_date),
+            "timezone": zone,
+        }
+    zone = _zone(getattr(trigger, "timezone", None))
+    if zone is None:
+        return None
+    if isinstance(trigger, CronTrigger):
+        return {
+            "type": "cron",
+            "fields": {
+                field.name: str(field)
+                for field in trigger.fields
+                if not field.is_default
+            },
+            "timezone": zone,
+            "start_date": _encode_datetime(trigger.start_date),
+            "end_date": _encode_datetime(trigger.end_date),
+            "jitter": trigger.jitter,
+        }
+    if isinstance(trigger, IntervalTrigger):
+        return {
+            "type": "interval",
+            "days": trigger.interval.days,
+            "seconds": trigger.interval.seconds,
+            "microseconds": trigger.interval.microseconds,
+            "timezone": zone,
+            "start_date": _encode_datetime(trigger.start_date),
+            "end_date": _encode_datetime(trigger.end_date),
+            "jitter": trigger.jitter,
+        }
+    return None
+
+
+def decode_trigger(encoded):
+    timezone = astimezone(encoded["timezone"])
+    if encoded["type"] == "cron":
+        return CronTrigger(
+            start_date=_decode_datetime(encoded["start_date"], timezone),
+            end_date=_decode_datetime(encoded["end_date"], timezone),
+            timezone=timezone,
+            jitter=encoded["jitter"],
+            **encoded["fields"]
+        )
+    if encoded["type"] == "interval":
+        return IntervalTrigger(
+            days=encoded["days"],
+            seconds=encoded["seconds"] + encoded["microseconds"] / 1000000.0,
+            start_date=_decode_datetime(encoded["start_date"], timezone),
+            end_date=_decode_datetime(encoded["end_date"], timezone),
+            timezone=timezone,
+            jitter=encoded["jitter"],
+        )
+    if encoded["type"] == "date":
+        return DateTrigger(run_date=_decode_datetime(encoded["run_date"], timezone))
+    raise ValueError("Unknown trigger type {}".format(encoded["type"]))
+
+
+def encode_job(job):
+    """The fields of a job as a BSON friendly dict - or None if the job has a
+    trigger, time zone or arguments that can't be stored this way and must
+    stay pickled.
+
+    :param Job job: The job
+    :rtype: dict
+
+    """
+    trigger = encode_trigger(job.trigger)
+    args = list(job.args)
+    if trigger is None or not _bson_safe(args) or not _bson_safe(job.kwargs):
+        return None
+    if job.next_run_time and _zone(job.next_run_time.tzinfo) is None:
+        return None
+    if not job.func_ref:
+        return None
+    return {
+        "func": job.func_ref,
+        "trigger": trigger,
+        "executor": job.executor,
+        "args": args,
+        "kwargs": job.kwargs,
+        "name": job.name,
+        "misfire_grace_time": job.misfire_grace_time,
+        "coalesce": job.coalesce,
+        "max_instances": job.max_instances,
+        "next_run_time": _encode_datetime(job.next_run_time),
+        "next_run_time_zone": (
+            _zone(job.next_run_time.tzinfo) if job.next_run_time else None
+        ),
+    }
+
+
+def decode_job_state(job_id, encoded):
+    """The Job.__setstate__ state of a job encoded by encode_job."""
+    trigger = decode_trigger(encoded["trigger"])
+    next_run_time = encoded["next_run_time"]
+    if next_run_time is not None:
+        next_run_time = _decode_datetime(
+            next_run_time, astimezone(encoded["next_run_time_zone"])
+        )
+    return {
+        "version": 1,
+        "id": job_id,
+        "func": encoded["func"],
+        "trigger": trigger,
+        "executor": encoded["executor"],
+        "args": tuple(encoded["args"]),
+        "kwargs": encoded["kwargs"],
+        "name": encoded["name"],
+        "misfire_grace_time": encoded["misfire_grace_time"],
+        "coalesce": encoded["coalesce"],
+        "max_instances": encoded["max_instances"],
+        "next_run_time": next_run_time,
+    }
@@ -0,0 +1,105 @@
+from datetime import datetime
+
+import pytest
+
+from apscheduler.job import Job
+from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.date import DateTrigger
+from apscheduler.triggers.interval import IntervalTrigger
+from apscheduler.util import astimezone, localize
+
+from py_utils.job_codec import decode_job_state, encode_job
+
+# The time zone classes of the APScheduler version installed - pytz before 3.11,
+#   zoneinfo from 3.11
+NEW_YORK = astimezone("America/New_York")
+UTC = astimezone("UTC")
+
+
+def make_job(trigger, next_run_time, kwargs=None):
+    job = Job.__new__(Job)
+    job.__setstate__(
+        {
+            "version": 1,
+            "id": "job",
+            "func": "py_utils.job_codec:encode_job",
+            "trigger": trigger,
+            "executor": "default",
+            "args": (),
+            "kwargs": (
+                kwargs
+                if kwargs is not None
+                else {"_teamId": "team", "runtimeVars": {"a": [1, {"b": None}]}}
+            ),
+            "name": "Job",
+            "misfire_grace_time": 30,
+            "coalesce": True,
+            "max_instances": 1,
+            "next_run_time": next_run_time,
+        }
+    )
+    return job
+
+
+def zone_name(tz):
+    return getattr(tz, "zone", None) or getattr(tz, "key", None)
+
+
+def round_trip(job):
+    return decode_job_state(job.id, encode_job(job))
+
+
+@pytest.mark.parametrize(
+    "trigger, next_run_time",
+    [
+        (
+            CronTrigger(
+                hour="1-3",
+                minute="*/20",
+                day_of_week="mon-fri",
+                timezone=NEW_YORK,
+                start_date=localize(datetime(2026, 3, 1), NEW_YORK),
+                jitter=5,
+            ),
+            localize(datetime(2026, 3, 9, 3, 0), NEW_YORK),
+        ),
+        (
+            CronTrigger(day="last", month="2-11/3", timezone="Australia/Lord_Howe"),
+            None,
+        ),
+        (
+            IntervalTrigger(
+                days=1,
+                seconds=1.5,
+                timezone=NEW_YORK,
+                # The second 1:30 of the day the clocks go back
+                start_date=localize(datetime(2026, 11, 1, 1, 30, fold=1), NEW_YORK),
+            ),
+            localize(datetime(2026, 11, 1, 1, 30, fold=1), NEW_YORK),
+        ),
+        (
+            DateTrigger(run_date=localize(datetime(2027, 3, 14, 3, 0), NEW_YORK)),
+            localize(datetime(2027, 3, 14, 7, 0), UTC),
+        ),
+    ],
+)
+def test_round_trip(trigger, next_run_time):
+    job = make_job(trigger, next_run_time)
+    state = round_trip(job)
+    expected = job.__getstate__()
+    assert type(state["trigger"]) is type(trigger)
+    assert state.pop("trigger").__getstate__() == expected.pop("trigger").__getstate__()
+    assert state == expected
+    if next_run_time is not None:
+        assert zone_name(state["next_run_time"].tzinfo) == zone_name(
+            next_run_time.tzinfo
+        )
+        assert state["next_run_time"].utcoffset() == next_run_time.utcoffset()
+
+
+@pytest.mark.parametrize(
+    "kwargs", [{"dotted.key": 1}, {"$key": 1}, {"tuple": (1, 2)}, {"big": 2**64}]
+)
+def test_unencodable_kwargs(kwargs):
+    job = make_job(CronTrigger(minute="*/5", timezone=UTC), None, kwargs)
+    assert encode_job(job) is None
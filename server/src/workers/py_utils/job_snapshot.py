@@ -0,0 +1,158 @@
+import math
+import mmap
+import os
+import struct
+import time
+import zlib
+
+from bson.objectid import ObjectId
+
+MAGIC = b"SGJS"
+VERSION = 1
+
+# magic, version, flags, job count, created (UTC timestamp), body length, crc32
+#   of the body
+_HEADER = struct.Struct("<4sHHIdQI")
+# next run time (NaN if paused), revision (zeros if none), offset of the job id
+#   and state in the data section, job id length, job state length
+_RECORD = struct.Struct("<d12sQHI")
+_NO_REVISION = bytes(12)
+
+
+class SnapshotError(Exception):
+    """A snapshot file that is missing, truncated, corrupt or from another
+    format version."""
+
+
+def write_snapshot(path, entries, created=None):
+    """Write a job store snapshot - replaced atomically, so a reader never sees
+    a partly written file.
+
+    The file is a fixed size header, a table of fixed size records ordered by
+    next run time (paused jobs last), then the job ids and pickled job states
+    the records point to. A crc32 of everything after the header is kept in
+    the header.
+
+    :param str path: The snapshot file
+    :param list entries: (job_id, revision, next_run_time, job_state) tuples -
+        revision an ObjectId or None, next_run_time a UTC timestamp or None and
+        job_state the pickled job state
+    :param float created: UTC timestamp recorded in the header, defaults to now
+    :return: Size of the file in bytes
+    :rtype: int
+
+    """
+    entries = sorted(
+        entries, key=lambda e: (e[2] is None, e[2] if e[2] is not None else 0, e[0])
+    )
+    records = bytearray()
+    data = bytearray()
+    for job_id, revision, next_run_time, job_state in entries:
+        encoded_id = job_id.encode("utf-8")
+        records += _RECORD.pack(
+            math.nan if next_run_time is None else next_run_time,
+            revision.binary if revision is not None else _NO_REVISION,
+            len(data),
+            len(encoded_id),
+            len(job_state),
+        )
+        data += encoded_id
+        data += job_state
+    crc = zlib.crc32(data, zlib.crc32(records))
+    header = _HEADER.pack(
+        MAGIC,
+        VERSION,
+        0,
+        len(entries),
+        time.time() if created is None else created,
+        len(records) + len(data),
+        crc,
+    )
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temp_path = "{}.{}.tmp".format(path, os.getpid())
+    try:
+        with open(temp_path, "wb") as f:
+            f.write(header)
+            f.write(records)
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return _HEADER.size + len(records) + len(data)
+
+
+class JobSnapshot(object):
+    """A snapshot written by write_snapshot, memory mapped and checked against
+    its checksum when opened. Job states are only copied out of the mapping
+    when asked for, so jobs can be restored as they are needed."""
+
+    def __init__(self, path):
+        """
+        :param str path: The snapshot file
+        :raises SnapshotError: If the file can't be used
+
+        """
+        try:
+            with open(path, "rb") as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError) as ex:
+            raise SnapshotError("Unable to open {}: {}".format(path, ex))
+        try:
+            self._validate()
+        except Exception:
+            self._mmap.close()
+            raise
+
+    def _validate(self):
+        if len(self._mmap) < _HEADER.size:
+            raise SnapshotError("Truncated snapshot header")
+        (
+            magic,
+            version,
+            _,
+            self.count,
+            self.created,
+            body_length,
+            crc,
+        ) = _HEADER.unpack_from(self._mmap)
+        if magic != MAGIC:
+            raise SnapshotError("Not a job store snapshot")
+        if version != VERSION:
+            raise SnapshotError("Unsupported snapshot version {}".format(version))
+        if len(self._mmap) != _HEADER.size + body_length:
+            raise SnapshotError("Truncated snapshot")
+        # Views of the mapping are released straight away - close fails while
+        #   one is still held
+        with memoryview(self._mmap) as view, view[_HEADER.size :] as body:
+            if zlib.crc32(body) != crc:
+                raise SnapshotError("Snapshot checksum mismatch")
+        self._data_start = _HEADER.size + self.count * _RECORD.size
+
+    def __iter__(self):
+        """(job_id, revision, next_run_time, state_offset, state_length) for
+        every job, earliest next run time first - read job states with
+        job_state."""
+        with memoryview(self._mmap) as view:
+            with view[_HEADER.size : self._data_start] as records:
+                records = list(_RECORD.iter_unpack(records))
+        for next_run_time, revision, offset, id_length, state_length in records:
+            start = self._data_start + offset
+            yield (
+                self._mmap[start : start + id_length].decode("utf-8"),
+                ObjectId(revision) if revision != _NO_REVISION else None,
+                None if math.isnan(next_run_time) else next_run_time,
+                start + id_length,
+                state_length,
+            )
+
+    def job_state(self, offset, length):
+        return self._mmap[offset : offset + length]
+
+    def close(self):
+        self._mmap.close()
@@ -0,0 +1,140 @@
+import queue
+import threading
+import time
+import zlib
+
+from py_utils.logger import logger
+
+_STOP = object()
+
+# Seconds between checks of pause_while while work is held back
+PAUSE_POLL_INTERVAL = 0.05
+
+
+class _Barrier(object):
+    """Work submitted for several lanes - queued on each of them and run by the
+    last lane to reach it, while the others wait for it to finish"""
+
+    def __init__(self, parties, fn, args):
+        self._parties = parties
+        self._fn = fn
+        self._args = args
+        self._arrived = 0
+        self._done = False
+        self._cond = threading.Condition()
+
+    def arrive(self):
+        """Returns the work to run if this was the last lane to arrive, otherwise
+        waits until the work has run and returns None"""
+        with self._cond:
+            self._arrived += 1
+            if self._arrived == self._parties:
+                return self._fn, self._args
+            while not self._done:
+                self._cond.wait()
+            return None
+
+    def finish(self):
+        with self._cond:
+            self._done = True
+            self._cond.notify_all()
+
+
+class KeyedLanes(object):
+    """Runs work on a fixed set of worker threads ("lanes"). Work submitted
+    with the same key always lands on the same lane so it runs in submission
+    order, while work for different keys runs concurrently.
+
+    Work submitted with a list of keys runs after the work submitted before it
+    for any of the keys, and the work submitted after it for any of the keys
+    waits for it - the lanes of all its keys are held while it runs.
+
+    """
+
+    def __init__(self, num_lanes, name="lane", pause_while=None, max_pause=0):
+        """Start the lane threads.
+
+        :param int num_lanes: Number of worker threads
+        :param str name: Prefix for the worker thread names
+        :param callable pause_while: Work isn't started while this returns
+            True, e.g. while more urgent work elsewhere is backed up
+        :param float max_pause: Most seconds a piece of work is held back by
+            pause_while
+
+        """
+        self._name = name
+        self._pause_while = pause_while
+        self._max_pause = max_pause
+        self._queues = [queue.Queue() for _ in range(num_lanes)]
+        # Work for several lanes is queued on all of them under the lock, so any
+        #   two such pieces of work are queued in the same order on every lane
+        #   they share and can't wait for each other
+        self._submit_lock = threading.Lock()
+        self._threads = []
+        for i, q in enumerate(self._queues):
+            t = threading.Thread(
+                target=self._run, args=(q,), name="{}-{}".format(name, i), daemon=True
+            )
+            t.start()
+            self._threads.append(t)
+
+    def lane_for(self, key):
+        return zlib.crc32(str(key).encode("utf-8")) % len(self._queues)
+
+    def submit(self, key, fn, *args):
+        """Queue fn(*args) on the lane that owns key.
+
+        :param key: Ordering key - work for equal keys runs sequentially. A
+            list of keys orders the work with the work for each of them
+        :param callable fn: The work to run
+
+        """
+        if not isinstance(key, list):
+            self._queues[self.lane_for(key)].put((fn, args))
+            return
+        lanes = sorted(set(self.lane_for(k) for k in key)) or [self.lane_for(None)]
+        if len(lanes) == 1:
+            self._queues[lanes[0]].put((fn, args))
+            return
+        barrier = _Barrier(len(lanes), fn, args)
+        with self._submit_lock:
+            for lane in lanes:
+                self._queues[lane].put(barrier)
+
+    def pending(self):
+        """Number of work items queued but not yet started."""
+        return sum(q.qsize() for q in self._queues)
+
+    def _run(self, q):
+        while True:
+            item = q.get()
+            if item is _STOP:
+                return
+            barrier = None
+            if isinstance(item, _Barrier):
+                barrier, item = item, item.arrive()
+                if item is None:
+                    continue
+            fn, args = item
+            if self._pause_while:
+                deadline = time.monotonic() + self._max_pause
+                while self._pause_while() and time.monotonic() < deadline:
+                    time.sleep(PAUSE_POLL_INTERVAL)
+            try:
+                fn(*args)
+            except Exception:
+                logger.exception("Unhandled exception in %s worker", self._name)
+            finally:
+                if barrier:
+                    barrier.finish()
+
+    def stop(self, timeout=None):
+        """Let queued work finish, then stop the lane threads.
+
+        :param float timeout: Seconds to wait for each lane to drain
+
+        """
+        for q in self._queues:
+            q.put(_STOP)
+        for t in self._threads:
+            t.join(timeout)
@@ -0,0 +1,81 @@
+import threading
+import time
+
+from py_utils.lanes import KeyedLanes
+
+
+def keys_on_different_lanes(lanes, count):
+    keys = []
+    seen = set()
+    for i in range(1000):
+        key = "schedule-{}".format(i)
+        if lanes.lane_for(key) not in seen:
+            seen.add(lanes.lane_for(key))
+            keys.append(key)
+        if len(keys) == count:
+            return keys
+    raise AssertionError("not enough lanes")
+
+
+def test_multi_key_work_runs_between_the_work_for_each_key():
+    lanes = KeyedLanes(4)
+    a, b = keys_on_different_lanes(lanes, 2)
+    events = []
+    lock = threading.Lock()
+
+    def record(name, seconds=0):
+        time.sleep(seconds)
+        with lock:
+            events.append(name)
+
+    lanes.submit(a, record, "a-before", 0.2)
+    lanes.submit(b, record, "b-before")
+    lanes.submit([a, b], record, "batch", 0.1)
+    lanes.submit(a, record, "a-after")
+    lanes.submit(b, record, "b-after")
+    lanes.stop(timeout=5)
+
+    assert events.index("batch") > events.index("a-before")
+    assert events.index("batch") > events.index("b-before")
+    assert events.index("batch") < events.index("a-after")
+    assert events.index("batch") < events.index("b-after")
+
+
+def test_overlapping_multi_key_work_does_not_deadlock():
+    lanes = KeyedLanes(4)
+    a, b, c = keys_on_different_lanes(lanes, 3)
+    done = []
+
+    for keys in ([a, b], [b, c], [c, a], [a, b, c]) * 10:
+        lanes.submit(keys, done.append, keys)
+    lanes.stop(timeout=5)
+
+    assert len(done) == 40
+    assert not any(t.is_alive() for t in lanes._threads)
+
+
+def test_work_for_each_key_runs_in_order_one_at_a_time():
+    lanes = KeyedLanes(4)
+    keys = ["schedule-{}".format(i) for i in range(8)]
+    runs = {key: [] for key in keys}
+    running = set()
+    overlaps = []
+    lock = threading.Lock()
+
+    def record(key, i):
+        with lock:
+            if key in running:
+                overlaps.append(key)
+            running.add(key)
+        time.sleep(0.001 * (i % 3))
+        with lock:
+            running.discard(key)
+            runs[key].append(i)
+
+    for i in range(20):
+        for key in keys:
+            lanes.submit(key, record, key, i)
+    lanes.stop(timeout=5)
+
+    assert overlaps == []
+    assert all(runs[key] == list(range(20)) for key in keys)
@@ -0,0 +1,245 @@
+import random
+import threading
+import time
+
+from datetime import datetime, timedelta
+
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, ReturnDocument
+from pytz import utc
+
+from py_utils.logger import logger
+
+# What a retry of a launch came to - "retry" leaves the entry for another
+#   attempt, the others remove it
+OUTCOMES = ("launched", "retry", "dropped", "expired")
+
+
+def _aware(value):
+    # pymongo returns naive UTC datetimes unless the client is tz_aware
+    return value if value.tzinfo else utc.localize(value)
+
+
+class LaunchOutbox(object):
+    """Durable record of job launches that failed before reaching the API (it
+    was unreachable, its circuit was open or it was rate limiting), kept in a
+    MongoDB collection and retried in the background until they go through or
+    their deadline passes. Launches the API may have acted on aren't recorded -
+    the API doesn't deduplicate launches, so retrying them could launch a job
+    twice.
+
+    An entry is keyed by the schedule id and nominal scheduled time, so a
+    launch is only recorded once however many times it fails. Retries of an
+    entry back off exponentially from backoff_base up to backoff_max seconds,
+    with jitter so entries recorded together during an API outage don't all
+    retry at once. At most concurrency retries run at a time, and at most
+    max_per_second are started, so a backlog built up during an outage
+    drains at a controlled rate once the API recovers.
+
+    Each retry claims its entry by pushing the entry's next attempt
+    claim_seconds into the future under a new claim id, so several drainers
+    sharing the collection never retry the same entry at once, and an entry
+    claimed by a drainer that died is retried once the claim runs out.
+
+    """
+
+    def __init__(
+        self,
+        collection,
+        launch,
+        enabled=None,
+        on_outcome=None,
+        concurrency=4,
+        max_per_second=20.0,
+        backoff_base=2.0,
+        backoff_max=300.0,
+        claim_seconds=120.0,
+        poll_interval=1.0,
+    ):
+        """
+        :param pymongo.collection.Collection collection: The outbox table
+        :param callable launch: Called with an entry - a dict with the
+            schedule_id, scheduled_time, attempts and the launch args that
+            were recorded - returns "launched", "retry" or "dropped"
+        :param callable enabled: Returns False while entries should be left
+            alone, e.g. on a standby scheduler
+        :param callable on_outcome: Called with one of OUTCOMES after each
+            retry or expired entry
+        :param int concurrency: Most retries running at once
+        :param float max_per_second: Most retries started per second
+        :param float backoff_base: Seconds before the first retry
+        :param float backoff_max: Most seconds between retries
+        :param float claim_seconds: How long a claimed entry is left to the
+            drainer that claimed it
+        :param float poll_interval: Seconds between checks for due entries
+            while there are none
+
+        """
+        self._collection = collection
+        self._launch = launch
+        self._enabled = enabled or (lambda: True)
+        self._on_outcome = on_outcome
+        self._concurrency = concurrency
+        self._start_interval = 1.0 / max_per_second if max_per_second else 0
+        self._backoff_base = backoff_base
+        self._backoff_max = backoff_max
+        self._claim_seconds = claim_seconds
+        self._poll_interval = poll_interval
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._workers = []
+
+    def start(self):
+        self._collection.create_index([("next_attempt", ASCENDING)])
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="launch-outbox", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """Stop claiming entries and wait for the retries in progress"""
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        for worker in list(self._workers):
+            worker.join()
+
+    def pending(self):
+        """Entries waiting to be retried"""
+        return self._collection.estimated_document_count()
+
+    def backoff(self, attempts):
+        """Seconds to wait before the next attempt after attempts failed"""
+        delay = min(self._backoff_max, self._backoff_base * 2 ** (attempts - 1))
+        return delay * random.uniform(0.5, 1.0)
+
+    def add(self, schedule_id, scheduled_time, deadline, args, error=None):
+        """Record a failed launch to be retried.
+
+        :param str schedule_id: The schedule the launch is for
+        :param datetime scheduled_time: The launch's nominal scheduled time
+        :param datetime deadline: Time after which the launch is given up on
+        :param dict args: What launch needs to send the launch again
+        :param str error: Why the launch failed
+        :return: False if the deadline has already passed
+        :rtype: bool
+
+        """
+        now = datetime.now(utc)
+        next_attempt = now + timedelta(seconds=self.backoff(1))
+        if next_attempt > deadline:
+            return False
+        self._collection.update_one(
+            {"_id": "{}:{}".format(schedule_id, scheduled_time.timestamp())},
+            {
+                "$setOnInsert": {
+                    "schedule_id": schedule_id,
+                    "scheduled_time": scheduled_time,
+                    "deadline": deadline,
+                    "args": args,
+                    "attempts": 1,
+                    "next_attempt": next_attempt,
+                    "last_error": error,
+                    "created": now,
+                }
+            },
+            upsert=True,
+        )
+        return True
+
+    def _run(self):
+        last_start = None
+        while not self._stop.is_set():
+            if not self._enabled():
+                self._stop.wait(self._poll_interval)
+                continue
+            if last_start is not None:
+                self._stop.wait(self._start_interval - (time.monotonic() - last_start))
+            self._slots.acquire()
+            if self._stop.is_set():
+                self._slots.release()
+                break
+            try:
+                entry = self._claim()
+            except Exception:
+                logger.exception("Unable to read the launch outbox")
+                entry = None
+            if entry is None:
+                self._slots.release()
+                self._wakeup.wait(self._poll_interval)
+                self._wakeup.clear()
+                continue
+            last_start = time.monotonic()
+            worker = threading.Thread(
+                target=self._retry, args=(entry,), name="launch-outbox-retry"
+            )
+            self._workers.append(worker)
+            worker.start()
+
+    def _claim(self):
+        now = datetime.now(utc)
+        return self._collection.find_one_and_update(
+            {"next_attempt": {"$lte": now}},
+            {
+                "$set": {
+                    "next_attempt": now + timedelta(seconds=self._claim_seconds),
+                    "claim": ObjectId(),
+                }
+            },
+            sort=[("next_attempt", ASCENDING)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    def _retry(self, entry):
+        try:
+            entry["scheduled_time"] = _aware(entry["scheduled_time"])
+            entry["deadline"] = _aware(entry["deadline"])
+            if datetime.now(utc) > entry["deadline"]:
+                outcome = "expired"
+            else:
+                try:
+                    outcome = self._launch(entry)
+                except Exception:
+                    logger.exception(
+                        "Unhandled exception retrying the launch of %s",
+                        entry["schedule_id"],
+                    )
+                    outcome = "retry"
+            self._settle(entry, outcome)
+        except Exception:
+            logger.exception("Unable to update launch outbox entry %s", entry["_id"])
+        finally:
+            self._workers.remove(threading.current_thread())
+            self._slots.release()
+            # A slot is free - claim the next due entry straight away
+            self._wakeup.set()
+
+    def _settle(self, entry, outcome):
+        claimed = {"_id": entry["_id"], "claim": entry["claim"]}
+        if outcome == "retry":
+            attempts = entry["attempts"] + 1
+            next_attempt = datetime.now(utc) + timedelta(seconds=self.backoff(attempts))
+            if next_attempt <= entry["deadline"]:
+                self._collection.update_one(
+                    claimed,
+                    {"$set": {"attempts": attempts, "next_attempt": next_attempt}},
+                )
+                if self._on_outcome:
+                    self._on_outcome(outcome)
+                return
+            outcome = "expired"
+        if outcome == "expired":
+            logger.warning(
+                "Gave up launching %s scheduled at %s after %d attempts",
+                entry["schedule_id"],
+                entry["scheduled_time"],
+                entry["attempts"],
+            )
+        self._collection.delete_one(claimed)
+        if self._on_outcome:
+            self._on_outcome(outcome)
@@ -0,0 +1,62 @@
+import threading
+
+from datetime import datetime, timedelta
+
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+
+from pytz import utc
+
+from py_utils.launch_outbox import LaunchOutbox
+
+
+@pytest.fixture
+def collection():
+    return mongomock.MongoClient().db.launch_outbox
+
+
+def test_launch_past_its_deadline_is_not_recorded(collection):
+    outbox = LaunchOutbox(collection, lambda entry: "launched")
+    now = datetime.now(utc)
+
+    recorded = outbox.add("schedule", now - timedelta(minutes=5), now, {})
+
+    assert recorded is False
+    assert collection.count_documents({}) == 0
+
+
+def test_entry_past_its_deadline_expires_without_a_launch(collection):
+    launched = []
+    outcomes = []
+    settled = threading.Event()
+
+    def on_outcome(outcome):
+        outcomes.append(outcome)
+        settled.set()
+
+    outbox = LaunchOutbox(
+        collection, launched.append, on_outcome=on_outcome, poll_interval=0.05
+    )
+    now = datetime.now(utc)
+    collection.insert_one(
+        {
+            "_id": "schedule:1",
+            "schedule_id": "schedule",
+            "scheduled_time": now - timedelta(minutes=5),
+            "deadline": now - timedelta(seconds=1),
+            "args": {},
+            "attempts": 1,
+            "next_attempt": now - timedelta(seconds=1),
+        }
+    )
+
+    outbox.start()
+    try:
+        assert settled.wait(5)
+    finally:
+        outbox.stop()
+
+    assert outcomes == ["expired"]
+    assert launched == []
+    assert collection.count_documents({}) == 0
@@ -0,0 +1,214 @@
+import threading
+import time
+
+from datetime import datetime, timedelta
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from py_utils.logger import logger
+
+
+class LeaderLease(object):
+    """Elects a single leader among scheduler instances through a lease
+    document in MongoDB.
+
+    The leader renews the lease every renew_interval seconds. Any other
+    instance takes the lease over once it has expired, which increments the
+    lease's fencing token. The token is handed to whatever the leader does on
+    behalf of the lease (launching jobs) so the receiving side can refuse
+    work from a leader that has since been replaced.
+
+    The leader stops considering itself the leader safety_margin seconds
+    before its lease expires by its own clock, so clocks must be kept in sync
+    to well within safety_margin.
+
+    on_elected and on_demoted are called on a thread of their own, so a slow
+    promotion doesn't hold up the renewals that keep the lease. Changes of
+    leadership that come while one is being handled are coalesced: the
+    handler thread moves straight to the latest state, and an election and
+    demotion that both happen in the meantime cancel out.
+
+    """
+
+    def __init__(
+        self,
+        collection,
+        member_id,
+        name="job_scheduler",
+        lease_seconds=10,
+        renew_interval=2,
+        safety_margin=2,
+        on_elected=None,
+        on_demoted=None,
+    ):
+        """
+        :param pymongo.collection.Collection collection: The lease table
+        :param str member_id: Unique, stable id of this instance
+        :param str name: Id of the lease document
+        :param float lease_seconds: How long a lease lasts without renewal
+        :param float renew_interval: Seconds between renewal or takeover
+            attempts
+        :param float safety_margin: Seconds before expiry at which the leader
+            stops acting as leader
+        :param callable on_elected: Called with the fencing token when this
+            instance becomes the leader
+        :param callable on_demoted: Called when this instance loses the lease
+
+        """
+        self.member_id = member_id
+        self._collection = collection
+        self._name = name
+        self._lease_seconds = lease_seconds
+        self._renew_interval = renew_interval
+        self._safety_margin = safety_margin
+        self._on_elected = on_elected
+        self._on_demoted = on_demoted
+        self._lock = threading.Lock()
+        self._token = None
+        self._valid_until = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+        self._changed = threading.Condition(self._lock)
+        self._handled_token = None
+        self._handler_thread = None
+
+    def is_leader(self):
+        return self.fencing_token() is not None
+
+    def fencing_token(self):
+        """The fencing token of the lease while this instance holds it,
+        otherwise None."""
+        with self._lock:
+            if self._token is not None and time.monotonic() < self._valid_until:
+                return self._token
+            return None
+
+    def start(self):
+        """Try for the lease and start renewing it. The first attempt runs
+        synchronously so a free lease is taken before start returns."""
+        self._handler_thread = threading.Thread(
+            target=self._handle_changes, name="leader-lease-changes", daemon=True
+        )
+        self._handler_thread.start()
+        self.renew()
+        self._thread = threading.Thread(
+            target=self._run, name="leader-lease", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self._renew_interval):
+            self.renew()
+
+    def renew(self):
+        """Renew the lease if held, otherwise take it over if it has expired,
+        and call on_elected / on_demoted when that changes leadership."""
+        attempted_at = time.monotonic()
+        try:
+            token = self._acquire()
+        except Exception:
+            logger.exception("Failed to renew the scheduler leader lease")
+            # Keep leading until the lease runs out - the lease may still be
+            #   renewed if the database comes back in time
+            token = self.fencing_token()
+        else:
+            if token is not None:
+                with self._lock:
+                    self._valid_until = (
+                        attempted_at + self._lease_seconds - self._safety_margin
+                    )
+
+        with self._lock:
+            previous = self._token
+            self._token = token
+            if token != previous:
+                self._changed.notify()
+        if token == previous:
+            return
+        if previous is not None:
+            logger.warning("Lost the scheduler leader lease (token %s)", previous)
+        if token is not None:
+            logger.info("Acquired the scheduler leader lease (token %s)", token)
+
+    def _handle_changes(self):
+        while True:
+            with self._lock:
+                while not self._stop.is_set() and self._token == self._handled_token:
+                    self._changed.wait()
+                if self._stop.is_set():
+                    return
+                previous = self._handled_token
+                token = self._handled_token = self._token
+            try:
+                if previous is not None and self._on_demoted:
+                    self._on_demoted()
+                if token is not None and self._on_elected:
+                    self._on_elected(token)
+            except Exception:
+                logger.exception("Failed to handle a scheduler leadership change")
+
+    def _acquire(self):
+        now = datetime.utcnow()
+        expires_at = now + timedelta(seconds=self._lease_seconds)
+
+        if self._token is not None:
+            lease = self._collection.find_one_and_update(
+                {"_id": self._name, "holder": self.member_id, "token": self._token},
+                {"$set": {"expires_at": expires_at}},
+                return_document=ReturnDocument.AFTER,
+            )
+            if lease:
+                return lease["token"]
+
+        # Take over an expired lease, or one held by an earlier run of this
+        #   instance, with a new token
+        lease = self._collection.find_one_and_update(
+            {
+                "_id": self._name,
+                "$or": [{"expires_at": {"$lte": now}}, {"holder": self.member_id}],
+            },
+            {
+                "$set": {"holder": self.member_id, "expires_at": expires_at},
+                "$inc": {"token": 1},
+            },
+            return_document=ReturnDocument.AFTER,
+        )
+        if lease:
+            return lease["token"]
+
+        try:
+            self._collection.insert_one(
+                {
+                    "_id": self._name,
+                    "holder": self.member_id,
+                    "token": 1,
+                    "expires_at": expires_at,
+                }
+            )
+            return 1
+        except DuplicateKeyError:
+            return None
+
+    def stop(self):
+        """Stop renewing and release the lease so a standby takes over
+        straight away."""
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        with self._lock:
+            token = self._token
+            self._token = None
+            self._changed.notify()
+        if self._handler_thread:
+            # Waits for a promotion or demotion in progress
+            self._handler_thread.join()
+        if token is None:
+            return
+        try:
+            self._collection.update_one(
+                {"_id": self._name, "holder": self.member_id, "token": token},
+                {"$set": {"expires_at": datetime.utcnow()}},
+            )
+        except Exception:
+            logger.exception("Failed to release the scheduler leader lease")
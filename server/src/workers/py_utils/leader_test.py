@@ -0,0 +1,76 @@
+import time
+
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+
+from py_utils.leader import LeaderLease
+
+
+@pytest.fixture
+def collection():
+    return mongomock.MongoClient().db.scheduler_leader
+
+
+def lease(collection, member_id):
+    return LeaderLease(collection, member_id, lease_seconds=1, safety_margin=0.4)
+
+
+def test_only_one_instance_holds_the_lease(collection):
+    a = lease(collection, "a")
+    b = lease(collection, "b")
+
+    a.renew()
+    b.renew()
+
+    assert a.fencing_token() == 1
+    assert b.fencing_token() is None
+
+
+def test_expired_lease_is_taken_over_with_a_higher_fencing_token(collection):
+    a = lease(collection, "a")
+    b = lease(collection, "b")
+    a.renew()
+
+    # a stops leading safety_margin before the lease expires, before b can take it
+    time.sleep(0.7)
+    assert a.fencing_token() is None
+    b.renew()
+    assert b.fencing_token() is None
+
+    time.sleep(0.5)
+    b.renew()
+    assert b.fencing_token() == 2
+
+    # a can't renew a lease that has been taken over
+    a.renew()
+    assert a.fencing_token() is None
+    assert b.fencing_token() == 2
+
+
+def test_fencing_token_increases_with_every_new_leader(collection):
+    members = [lease(collection, member_id) for member_id in ("a", "b", "c")]
+    tokens = []
+
+    for _ in range(2):
+        for member in members:
+            member.renew()
+            tokens.append(member.fencing_token())
+            # Releases the lease so the next member takes it over straight away
+            member.stop()
+
+    assert tokens == sorted(tokens)
+    assert len(set(tokens)) == len(tokens)
+
+
+def test_renewed_lease_keeps_its_fencing_token(collection):
+    a = lease(collection, "a")
+    b = lease(collection, "b")
+
+    for _ in range(4):
+        a.renew()
+        b.renew()
+        time.sleep(0.15)
+
+    assert a.fencing_token() == 1
+    assert b.fencing_token() is None
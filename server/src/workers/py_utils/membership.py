@@ -0,0 +1,236 @@
+import bisect
+import hashlib
+import threading
+import time
+
+from datetime import datetime, timedelta
+
+from py_utils.logger import logger
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.md5(value.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing(object):
+    """Consistent hash ring mapping keys to members. Each member is placed on
+    the ring vnodes times so keys are spread evenly and adding or removing a
+    member only moves the keys adjacent to its points.
+
+    """
+
+    def __init__(self, members, vnodes=64):
+        self.members = frozenset(members)
+        self._points = []
+        self._owners = []
+        for hash_value, member in sorted(
+            (_hash("{}#{}".format(member, i)), member)
+            for member in self.members
+            for i in range(vnodes)
+        ):
+            self._points.append(hash_value)
+            self._owners.append(member)
+
+    def owner(self, key):
+        if not self._points:
+            return None
+        index = bisect.bisect(self._points, _hash(str(key))) % len(self._points)
+        return self._owners[index]
+
+
+class ClusterMembership(object):
+    """Tracks the live scheduler instances through a lease table in MongoDB.
+
+    Every member upserts a lease document with an expiry each heartbeat and
+    treats members whose lease has not expired as live. When the live set
+    changes the hash ring is rebuilt and on_change is called with it, so the
+    caller can pick up or drop the schedules it owns.
+
+    Members see a change at their own next heartbeat, so for up to a
+    heartbeat_interval two members can both consider themselves the owner of
+    a key. Launches are fenced against that: each member publishes the
+    members of the ring it uses in its lease document before it starts using
+    it, and fenced(key) holds a key back while any other live member last
+    published a ring under which that member owns the key. A key that moves
+    is therefore not launched by its new owner until the old owner has
+    published a ring without it - at most one heartbeat_interval later.
+    fenced(key) also holds back every key once this member's own lease is
+    within safety_margin of expiring, as the other members may already have
+    taken its keys over.
+
+    Lease expiry is compared against each member's local clock, so clocks
+    must be kept in sync to well within safety_margin.
+
+    """
+
+    def __init__(
+        self,
+        collection,
+        member_id,
+        lease_seconds=15,
+        heartbeat_interval=5,
+        vnodes=64,
+        safety_margin=2,
+        on_change=None,
+    ):
+        """
+        :param pymongo.collection.Collection collection: The lease table
+        :param str member_id: Unique, stable id of this instance
+        :param float lease_seconds: How long a lease lasts without renewal
+        :param float heartbeat_interval: Seconds between lease renewals
+        :param int vnodes: Ring points per member
+        :param float safety_margin: Seconds before this member's lease
+            expires at which it stops launching
+        :param callable on_change: Called with the new HashRing
+
+        """
+        self.member_id = member_id
+        self._collection = collection
+        self._lease_seconds = lease_seconds
+        self._heartbeat_interval = heartbeat_interval
+        self._vnodes = vnodes
+        self._safety_margin = safety_margin
+        self._on_change = on_change
+        self._ring = HashRing([member_id], vnodes)
+        self._next_ring = None
+        self._joined = False
+        # (member id, ring) of the live members last seen publishing a ring
+        #   other than this member's
+        self._other_rings = []
+        self._valid_until = 0.0
+        self._condition = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def ring(self):
+        return self._ring
+
+    def owns(self, key):
+        return self._ring.owner(key) == self.member_id
+
+    def fenced(self, key):
+        """Why this member must not launch key now, or None if it may.
+
+        :return: "lease" if this member's lease may have expired, "owner" if
+            it doesn't own key or "handoff" if another member may still
+            consider itself the owner
+        :rtype: str
+
+        """
+        with self._condition:
+            return self._fenced(key)
+
+    def wait_unfenced(self, key, timeout):
+        """Wait up to timeout seconds for a key held back by a handoff or an
+        unrenewed lease to be released - the heartbeats in the meantime may
+        settle it.
+
+        :return: The reason the key is still fenced, or None
+        :rtype: str
+
+        """
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while True:
+                reason = self._fenced(key)
+                remaining = deadline - time.monotonic()
+                if reason in (None, "owner") or remaining <= 0:
+                    return reason
+                self._condition.wait(remaining)
+
+    def _fenced(self, key):
+        # Called with the condition held
+        if time.monotonic() >= self._valid_until:
+            return "lease"
+        for ring in (self._ring, self._next_ring):
+            if ring is not None and ring.owner(key) != self.member_id:
+                return "owner"
+        for member_id, ring in self._other_rings:
+            if ring.owner(key) == member_id:
+                return "handoff"
+        return None
+
+    def start(self):
+        """Register this member and start heartbeating. The first heartbeat
+        runs synchronously so ownership is known when start returns."""
+        self.heartbeat()
+        self._thread = threading.Thread(
+            target=self._run, name="cluster-membership", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self._heartbeat_interval):
+            try:
+                self.heartbeat()
+            except Exception:
+                logger.exception("Cluster membership heartbeat failed")
+
+    def heartbeat(self):
+        started = time.monotonic()
+        now = datetime.utcnow()
+        update = {
+            "$set": {
+                "expires_at": now + timedelta(seconds=self._lease_seconds),
+                "heartbeat_at": now,
+            }
+        }
+        if self._joined:
+            update["$set"]["ring"] = sorted(self._ring.members)
+        else:
+            # The ring this member starts with is just itself - nothing is
+            #   published until it has seen the other members
+            update["$unset"] = {"ring": ""}
+        self._collection.update_one({"_id": self.member_id}, update, upsert=True)
+        docs = list(
+            self._collection.find({"expires_at": {"$gt": now}}, ["_id", "ring"])
+        )
+        members = [doc["_id"] for doc in docs]
+        if self.member_id not in members:
+            members.append(self.member_id)
+        changed = frozenset(members) != self._ring.members
+        if changed or not self._joined:
+            ring = HashRing(members, self._vnodes)
+            with self._condition:
+                # Keys that move are fenced under both rings until the new one
+                #   is published
+                self._next_ring = ring
+            self._collection.update_one(
+                {"_id": self.member_id}, {"$set": {"ring": sorted(members)}}
+            )
+            with self._condition:
+                self._ring = ring
+                self._next_ring = None
+            self._joined = True
+        if changed:
+            logger.info(
+                "Scheduler cluster members changed to %s", ", ".join(sorted(members))
+            )
+            if self._on_change:
+                self._on_change(self._ring)
+        rings = {}
+        other_rings = []
+        for doc in docs:
+            published = frozenset(doc.get("ring") or ())
+            if not published or doc["_id"] == self.member_id:
+                continue
+            if published != self._ring.members:
+                if published not in rings:
+                    rings[published] = HashRing(published, self._vnodes)
+                other_rings.append((doc["_id"], rings[published]))
+        with self._condition:
+            self._other_rings = other_rings
+            self._valid_until = started + self._lease_seconds - self._safety_margin
+            self._condition.notify_all()
+
+    def stop(self):
+        """Stop heartbeating and give up the lease so the remaining members
+        rebalance straight away."""
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        try:
+            self._collection.delete_one({"_id": self.member_id})
+        except Exception:
+            logger.exception("Failed to remove cluster membership lease")
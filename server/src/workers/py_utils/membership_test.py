@@ -0,0 +1,119 @@
+import threading
+import time
+
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+
+from py_utils.membership import ClusterMembership, HashRing
+
+
+@pytest.fixture
+def collection():
+    return mongomock.MongoClient().db.scheduler_members
+
+
+def key_owned_by(member_id, members):
+    ring = HashRing(members)
+    return next(
+        key
+        for key in ("schedule-{}".format(i) for i in range(1000))
+        if ring.owner(key) == member_id
+    )
+
+
+def launchers(members, key):
+    return [member.member_id for member in members if member.fenced(key) is None]
+
+
+def test_moved_key_is_never_launchable_by_two_members(collection):
+    a = ClusterMembership(collection, "a")
+    b = ClusterMembership(collection, "b")
+    key = key_owned_by("b", ["a", "b"])
+
+    a.heartbeat()
+    assert launchers([a, b], key) == ["a"]
+
+    # b joins - a hasn't seen it yet and still launches the key
+    b.heartbeat()
+    assert b.owns(key)
+    assert b.fenced(key) == "handoff"
+    assert launchers([a, b], key) == ["a"]
+
+    # a lets go of the key, but b hasn't seen it let go yet
+    a.heartbeat()
+    assert a.fenced(key) == "owner"
+    assert launchers([a, b], key) == []
+
+    b.heartbeat()
+    assert launchers([a, b], key) == ["b"]
+
+
+def test_wait_unfenced_returns_once_previous_owner_lets_go(collection):
+    a = ClusterMembership(collection, "a")
+    b = ClusterMembership(collection, "b")
+    key = key_owned_by("b", ["a", "b"])
+    a.heartbeat()
+    b.heartbeat()
+
+    def heartbeats():
+        time.sleep(0.1)
+        a.heartbeat()
+        b.heartbeat()
+
+    thread = threading.Thread(target=heartbeats)
+    thread.start()
+    assert b.wait_unfenced(key, 5) is None
+    thread.join()
+    assert a.wait_unfenced(key, 5) == "owner"
+
+
+def test_departed_member_keys_are_taken_over(collection):
+    a = ClusterMembership(collection, "a")
+    b = ClusterMembership(collection, "b")
+    key = key_owned_by("b", ["a", "b"])
+    a.heartbeat()
+    b.heartbeat()
+    a.heartbeat()
+    b.heartbeat()
+    assert launchers([a, b], key) == ["b"]
+
+    b.stop()
+    a.heartbeat()
+    assert a.fenced(key) is None
+
+
+def test_unrenewed_lease_fences_every_key(collection):
+    a = ClusterMembership(collection, "a", lease_seconds=0.5, safety_margin=0.3)
+    assert a.fenced("schedule") == "lease"
+    a.heartbeat()
+    assert a.fenced("schedule") is None
+    time.sleep(0.3)
+    assert a.fenced("schedule") == "lease"
+
+
+def test_wait_unfenced_gives_up_at_its_timeout(collection):
+    a = ClusterMembership(collection, "a")
+    b = ClusterMembership(collection, "b")
+    key = key_owned_by("b", ["a", "b"])
+    a.heartbeat()
+    b.heartbeat()
+
+    # a never lets go of the key
+    started = time.monotonic()
+    assert b.wait_unfenced(key, 0.2) == "handoff"
+    assert 0.2 <= time.monotonic() - started < 2
+    assert b.wait_unfenced(key, 0) == "handoff"
+
+
+def test_wait_unfenced_does_not_wait_for_a_key_owned_elsewhere(collection):
+    a = ClusterMembership(collection, "a")
+    b = ClusterMembership(collection, "b")
+    key = key_owned_by("b", ["a", "b"])
+    a.heartbeat()
+    b.heartbeat()
+    a.heartbeat()
+
+    started = time.monotonic()
+    assert a.wait_unfenced(key, 5) == "owner"
+    assert time.monotonic() - started < 1
@@ -0,0 +1,282 @@
+import hashlib
+import json
+import threading
+import time
+import zlib
+
+from contextlib import contextmanager
+
+from py_utils.logger import logger
+
+# Schedule fields the scheduler's job is built from - a change to anything else
+#   (name, run dates, lastUpdatedBy...) doesn't change the job
+FINGERPRINT_FIELDS = (
+    "TriggerType",
+    "cron",
+    "interval",
+    "RunDate",
+    "isActive",
+    "misfire_grace_time",
+    "coalesce",
+    "max_instances",
+    "fireSpreadSeconds",
+    "catchUpPolicy",
+    "FunctionKwargs",
+)
+
+OUTCOMES = ("added", "changed", "unchanged", "skipped", "error")
+
+# Schedules are locked for updates by stripe, so updates to different schedules
+#   rarely wait for each other
+LOCK_STRIPES = 64
+
+
+def schedule_fingerprint(schedule):
+    """Digest of the fields of an API schedule its job is built from.
+
+    :param dict schedule: A schedule as returned by the API
+    :rtype: str
+
+    """
+    content = json.dumps(
+        {field: schedule.get(field) for field in FINGERPRINT_FIELDS},
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.blake2b(content.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class ScheduleReconciler(object):
+    """Repairs drift between the API's schedules and the scheduler's job store -
+    left behind when a schedule update message is lost.
+
+    A pass streams every schedule from the API a page at a time in id order.
+    Each page's schedules go to reconcile, which compares them with their jobs
+    and applies whatever differs. Jobs whose schedules weren't listed are
+    removed at the end of a complete pass - only jobs that existed when the
+    pass started, so a job added by a message during the pass is never taken
+    for a deleted schedule. A pass that fails part way removes nothing.
+
+    The fingerprint of every schedule reconcile found or made current is kept,
+    so later passes only compare the schedules that changed in the API since.
+    Pages are requested at most max_pages_per_second to keep the load on the
+    API and job store down.
+
+    Schedule update messages are applied inside updating, which records that
+    the schedules were updated. reconcile applies each schedule inside the
+    context returned by its current argument, which is False for a schedule
+    updated since its page was fetched - the page may hold an older version of
+    it, which mustn't overwrite the update. The schedule is skipped, and
+    compared again by the next pass. Both hold the schedule's lock, so an
+    update can't be applied between the check and the reconcile.
+
+    """
+
+    def __init__(
+        self,
+        fetch_page,
+        reconcile,
+        job_ids,
+        remove_jobs,
+        owns=None,
+        enabled=None,
+        on_pass=None,
+        page_size=500,
+        max_pages_per_second=2.0,
+        interval=3600,
+    ):
+        """
+        :param callable fetch_page: Called with (after_id, limit), returns the
+            next limit schedules with ids greater than after_id (None for the
+            first page) in id order
+        :param callable reconcile: Called with a list of schedules and a
+            current function, returns a dict of schedule id to one of OUTCOMES.
+            current(schedule_id) is a context manager, whose value is False if
+            the schedule was updated since it was fetched, holding the
+            schedule's lock while its job is compared and updated
+        :param callable job_ids: Returns the ids of the jobs in the job store
+        :param callable remove_jobs: Called with a list of job ids to remove
+        :param callable owns: Called with a schedule id, False if another
+            scheduler instance is responsible for it
+        :param callable enabled: Returns False while passes should be skipped,
+            e.g. on a standby scheduler
+        :param callable on_pass: Called with (counts, seconds) after every
+            complete pass
+        :param int page_size: Schedules requested per page
+        :param float max_pages_per_second: Most pages requested per second
+        :param float interval: Seconds between the end of a pass and the start
+            of the next
+
+        """
+        self._fetch_page = fetch_page
+        self._reconcile = reconcile
+        self._job_ids = job_ids
+        self._remove_jobs = remove_jobs
+        self._owns = owns or (lambda schedule_id: True)
+        self._enabled = enabled or (lambda: True)
+        self._on_pass = on_pass
+        self._page_size = page_size
+        self._page_interval = 1.0 / max_pages_per_second if max_pages_per_second else 0
+        self._interval = interval
+        self._fingerprints = {}
+        self._stripes = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        # Sequence number of the last update of each schedule updated since the
+        #   current pass started
+        self._updated = {}
+        self._sequence = 0
+        self._sequence_lock = threading.Lock()
+        self._pass_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Run a pass straight away, then every interval seconds"""
+        self._thread = threading.Thread(
+            target=self._run, name="schedule-reconciler", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def _stripe(self, schedule_id):
+        return zlib.crc32(str(schedule_id).encode("utf-8")) % LOCK_STRIPES
+
+    def _next_sequence(self):
+        with self._sequence_lock:
+            self._sequence += 1
+            return self._sequence
+
+    @contextmanager
+    def updating(self, schedule_ids):
+        """Context to apply a schedule update message in, for the schedules
+        it's for. A page fetched before the update isn't applied to them, and
+        their fingerprints are dropped so the next pass compares them with their
+        jobs.
+
+        :param list schedule_ids: Ids of the schedules being updated
+
+        """
+        stripes = sorted(set(self._stripe(schedule_id) for schedule_id in schedule_ids))
+        for stripe in stripes:
+            self._stripes[stripe].acquire()
+        try:
+            sequence = self._next_sequence()
+            for schedule_id in schedule_ids:
+                self._updated[schedule_id] = sequence
+                self._fingerprints.pop(schedule_id, None)
+            yield
+        finally:
+            for stripe in reversed(stripes):
+                self._stripes[stripe].release()
+
+    def _current(self, fetched):
+        """current function for a page fetched after sequence number fetched"""
+
+        @contextmanager
+        def current(schedule_id):
+            with self._stripes[self._stripe(schedule_id)]:
+                yield self._updated.get(schedule_id, 0) <= fetched
+
+        return current
+
+    def _run(self):
+        while not self._stop.is_set():
+            if self._enabled():
+                try:
+                    self.run_pass()
+                except Exception:
+                    logger.exception("Schedule reconciliation pass failed")
+            self._stop.wait(self._interval)
+
+    def run_pass(self):
+        """Reconcile every schedule once.
+
+        :return: Schedules listed and the count of each outcome, plus removed
+        :rtype: dict
+        :raises Exception: Whatever fetch_page raised - nothing is removed
+
+        """
+        with self._pass_lock:
+            started = time.monotonic()
+            counts = dict.fromkeys(OUTCOMES + ("removed",), 0)
+            counts["schedules"] = 0
+            # Updates made before the pass started were applied before any of its
+            #   pages were fetched
+            pass_sequence = self._next_sequence()
+            self._forget_updates(pass_sequence)
+            existing = set(self._job_ids())
+            listed = set()
+            after_id = None
+            last_request = None
+            while True:
+                if last_request is not None:
+                    self._stop.wait(
+                        self._page_interval - (time.monotonic() - last_request)
+                    )
+                if self._stop.is_set():
+                    return counts
+                last_request = time.monotonic()
+                fetched = self._next_sequence()
+                page = self._fetch_page(after_id, self._page_size)
+                if not page:
+                    break
+                after_id = page[-1]["id"]
+                counts["schedules"] += len(page)
+                self._reconcile_page(page, listed, counts, fetched)
+                if len(page) < self._page_size:
+                    break
+
+            removed = [job_id for job_id in existing - listed if self._owns(job_id)]
+            for job_id in existing - listed:
+                self._fingerprints.pop(job_id, None)
+            if removed:
+                self._remove_jobs(removed)
+            counts["removed"] = len(removed)
+
+            seconds = time.monotonic() - started
+            if self._on_pass:
+                self._on_pass(counts, seconds)
+            return counts
+
+    def _forget_updates(self, before):
+        for stripe in self._stripes:
+            stripe.acquire()
+        try:
+            self._updated = {
+                schedule_id: sequence
+                for schedule_id, sequence in self._updated.items()
+                if sequence >= before
+            }
+        finally:
+            for stripe in self._stripes:
+                stripe.release()
+
+    def _reconcile_page(self, page, listed, counts, fetched):
+        changed = []
+        for schedule in page:
+            schedule_id = schedule["id"]
+            listed.add(schedule_id)
+            if not self._owns(schedule_id):
+                continue
+            fingerprint = schedule_fingerprint(schedule)
+            if self._fingerprints.get(schedule_id) == fingerprint:
+                counts["unchanged"] += 1
+            else:
+                changed.append((schedule, fingerprint))
+        if not changed:
+            return
+
+        outcomes = self._reconcile(
+            [schedule for schedule, _ in changed], self._current(fetched)
+        )
+        for schedule, fingerprint in changed:
+            outcome = outcomes.get(schedule["id"], "error")
+            counts[outcome] += 1
+            if outcome == "skipped":
+                continue
+            # A schedule that couldn't be applied has been reported and paused -
+            #   it's retried once it changes in the API
+            self._fingerprints[schedule["id"]] = fingerprint
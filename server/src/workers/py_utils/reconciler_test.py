@@ -0,0 +1,102 @@
+import threading
+
+from py_utils.reconciler import ScheduleReconciler
+
+
+class FakeJobs(object):
+    """Jobs kept as the version of the schedule they were built from"""
+
+    def __init__(self):
+        self.versions = {}
+
+    def reconcile(self, schedules, current):
+        outcomes = {}
+        for schedule in schedules:
+            with current(schedule["id"]) as is_current:
+                if not is_current:
+                    outcomes[schedule["id"]] = "skipped"
+                    continue
+                if self.versions.get(schedule["id"]) == schedule["version"]:
+                    outcomes[schedule["id"]] = "unchanged"
+                else:
+                    self.versions[schedule["id"]] = schedule["version"]
+                    outcomes[schedule["id"]] = "changed"
+        return outcomes
+
+
+def schedule(version):
+    return {"id": "schedule", "TriggerType": "cron", "version": version}
+
+
+def make_reconciler(jobs, fetch_page):
+    return ScheduleReconciler(
+        fetch_page,
+        jobs.reconcile,
+        lambda: list(jobs.versions),
+        lambda job_ids: None,
+        max_pages_per_second=0,
+    )
+
+
+def test_page_fetched_before_an_update_does_not_overwrite_it():
+    jobs = FakeJobs()
+    api = {"version": 1}
+
+    def fetch_page(after_id, limit):
+        if after_id is not None:
+            return []
+        page = [schedule(api["version"])]
+        if api["version"] == 1:
+            # The schedule is updated and its message applied while the page is
+            #   on its way
+            api["version"] = 2
+            with reconciler.updating(["schedule"]):
+                jobs.versions["schedule"] = 2
+        return page
+
+    reconciler = make_reconciler(jobs, fetch_page)
+
+    counts = reconciler.run_pass()
+    assert counts["skipped"] == 1
+    assert jobs.versions["schedule"] == 2
+
+    counts = reconciler.run_pass()
+    assert counts["unchanged"] == 1
+    assert jobs.versions["schedule"] == 2
+
+
+def test_update_waits_for_the_schedule_being_reconciled():
+    jobs = FakeJobs()
+    reconciling = threading.Event()
+    release = threading.Event()
+
+    def reconcile(schedules, current):
+        with current("schedule"):
+            reconciling.set()
+            release.wait(5)
+        return {"schedule": "unchanged"}
+
+    reconciler = ScheduleReconciler(
+        lambda after_id, limit: [] if after_id else [schedule(1)],
+        reconcile,
+        lambda: [],
+        lambda job_ids: None,
+        max_pages_per_second=0,
+    )
+    thread = threading.Thread(target=reconciler.run_pass)
+    thread.start()
+    reconciling.wait(5)
+
+    updated = threading.Event()
+
+    def update():
+        with reconciler.updating(["schedule"]):
+            updated.set()
+
+    updater = threading.Thread(target=update)
+    updater.start()
+    assert not updated.wait(0.2)
+    release.set()
+    assert updated.wait(5)
+    thread.join()
+    updater.join()
@@ -3,11 +3,95 @@
 
 import functools
 import pika
+import threading
+import time
+from concurrent.futures import Future
 from pika.exchange_type import ExchangeType
 
+from py_utils.lanes import KeyedLanes
 from py_utils.logger import logger
 
 
+class ConsumerMetrics(object):
+    """Consumer metrics labelled by queue name. Created once and shared by
+    every AsyncConsumer instance so counts carry over when a consumer is
+    replaced after a reconnect.
+
+    """
+
+    def __init__(self, registry, prefix="sg_rmq"):
+        """
+        :param MetricsRegistry registry: Registry the metrics are added to
+        :param str prefix: Metric name prefix
+
+        """
+        labels = ["queue"]
+        self.messages = registry.counter(
+            prefix + "_messages_total", "Messages delivered to the consumer", labels
+        )
+        self.redeliveries = registry.counter(
+            prefix + "_redelivered_messages_total",
+            "Messages delivered with the redelivered flag set",
+            labels,
+        )
+        self.handler_duration = registry.histogram(
+            prefix + "_handler_duration_seconds",
+            "Time spent in the on_message handler",
+            labels,
+        )
+        self.unacked = registry.gauge(
+            prefix + "_unacked_messages",
+            "Delivered messages not yet acknowledged or rejected",
+            labels,
+        )
+        self.prefetch = registry.gauge(
+            prefix + "_prefetch_count", "Consumer prefetch count", labels
+        )
+        self.connected = registry.gauge(
+            prefix + "_connected", "1 while the consumer is consuming", labels
+        )
+        self.reconnects = registry.counter(
+            prefix + "_reconnects_total",
+            "Times consuming resumed after the connection was lost",
+            labels,
+        )
+        self.disconnected_seconds = registry.counter(
+            prefix + "_disconnected_seconds_total",
+            "Time spent reconnecting after the connection was lost",
+            labels,
+        )
+        self._lock = threading.Lock()
+        self._disconnected_since = {}
+
+    def consuming(self, queue, prefetch_count):
+        self.prefetch.set(prefetch_count, queue=queue)
+        self.unacked.set(0, queue=queue)
+        self.connected.set(1, queue=queue)
+        with self._lock:
+            disconnected_since = self._disconnected_since.pop(queue, None)
+        if disconnected_since is not None:
+            self.reconnects.inc(queue=queue)
+            self.disconnected_seconds.inc(
+                time.monotonic() - disconnected_since, queue=queue
+            )
+
+    def disconnected(self, queue, expected):
+        """Record that the connection is gone - unacknowledged messages will
+        be redelivered so they no longer count as in flight.
+
+        :param bool expected: The consumer was stopped, rather than losing
+            the connection, so no reconnect is coming
+
+        """
+        self.connected.set(0, queue=queue)
+        self.unacked.set(0, queue=queue)
+        with self._lock:
+            if expected:
+                self._disconnected_since.pop(queue, None)
+            else:
+                self._disconnected_since.setdefault(queue, time.monotonic())
+
+
 class AsyncConsumer(object):
     """This is an example consumer that will handle unexpected interactions
     with RabbitMQ such as channel and connection closures.
@@ -20,6 +104,19 @@ class AsyncConsumer(object):
     If the channel is closed, it will indicate a problem with one of the
     commands that were issued and that should surface in the output as well.
 
+    If the "dispatch_workers" param is greater than zero the on_message
+    handler is run on a pool of worker threads instead of the IOLoop thread.
+    Messages are routed to workers by the key returned from the
+    "dispatch_key" param (called with the message body) so messages with
+    the same key are handled in delivery order. A message keyed by a list of
+    keys is handled in order with the messages for each of them. Acks and
+    rejects issued from worker threads are marshalled back onto the IOLoop
+    thread.
+
+    If a ConsumerMetrics is passed in the "metrics" param, message counts,
+    handler durations, unacknowledged messages and reconnects are recorded
+    on it.
+
     """
 
     def __init__(self, amqp_url, params):
@@ -40,6 +137,12 @@ class AsyncConsumer(object):
 
         self._consuming = False
         self._prefetch_count = 1
+        self._ioloop_thread_id = None
+        self._ioloop_running = False
+        self._lanes = None
+        self._queue_arguments = None
+        self._fn_dispatch_key = lambda body: None
+        self._metrics = None
         self.logger = logger
 
         if "exch" in params:
@@ -50,6 +153,8 @@ class AsyncConsumer(object):
             self._durable = params["durable"]
         if "queue_name" in params:
             self._queue_name = params["queue_name"]
+        if "queue_arguments" in params:
+            self._queue_arguments = params["queue_arguments"]
         if "exclusive" in params:
             self._exclusive = params["exclusive"]
         if "auto_delete" in params:
@@ -62,6 +167,12 @@ class AsyncConsumer(object):
             self._auto_ack = params["auto_ack"]
         if "on_message" in params:
             self._fn_on_message = params["on_message"]
+        if "dispatch_key" in params:
+            self._fn_dispatch_key = params["dispatch_key"]
+        if "metrics" in params:
+            self._metrics = params["metrics"]
+        if params.get("dispatch_workers", 0) > 0:
+            self._lanes = KeyedLanes(params["dispatch_workers"], "on_message")
 
     def connect(self):
         """This method connects to RabbitMQ, returning the connection handle.
@@ -96,6 +207,10 @@ class AsyncConsumer(object):
 
         """
         self.logger.info("Connection opened")
+        if self._closing:
+            # stop_threadsafe was called while connecting
+            self.close_connection()
+            return
         self.open_channel()
 
     def on_connection_open_error(self, _unused_connection, err):
@@ -107,6 +222,8 @@ class AsyncConsumer(object):
 
         """
         self.logger.error("Connection open failed: %s", err)
+        if self._metrics:
+            self._metrics.disconnected(self._queue_name, expected=False)
         self.reconnect()
 
     def on_connection_closed(self, _unused_connection, reason):
@@ -120,6 +237,8 @@ class AsyncConsumer(object):
 
         """
         self._channel = None
+        if self._metrics:
+            self._metrics.disconnected(self._queue_name, expected=self._closing)
         if self._closing:
             self._connection.ioloop.stop()
         else:
@@ -225,6 +344,7 @@ class AsyncConsumer(object):
             durable=self._durable,
             exclusive=self._exclusive,
             auto_delete=self._auto_delete,
+            arguments=self._queue_arguments,
             callback=cb,
         )
 
@@ -304,6 +424,8 @@ class AsyncConsumer(object):
         )
         self.was_consuming = True
         self._consuming = True
+        if self._metrics:
+            self._metrics.consuming(self._queue_name, self._prefetch_count)
 
     def add_on_cancel_callback(self):
         """Add a callback that will be invoked if RabbitMQ cancels the consumer
@@ -347,27 +469,87 @@ class AsyncConsumer(object):
             properties.app_id,
             body,
         )
-        self._fn_on_message(basic_deliver.delivery_tag, body, self)
+        if self._metrics:
+            self._metrics.messages.inc(queue=self._queue_name)
+            if basic_deliver.redelivered:
+                self._metrics.redeliveries.inc(queue=self._queue_name)
+            if not self._auto_ack:
+                self._metrics.unacked.inc(queue=self._queue_name)
+        if self._lanes:
+            self._lanes.submit(
+                self._fn_dispatch_key(body),
+                self._handle_message,
+                basic_deliver.delivery_tag,
+                body,
+            )
+        else:
+            self._handle_message(basic_deliver.delivery_tag, body)
         # self.acknowledge_message(basic_deliver.delivery_tag)
 
+    def _handle_message(self, delivery_tag, body):
+        if not self._metrics:
+            self._fn_on_message(delivery_tag, body, self)
+            return
+        started = time.monotonic()
+        try:
+            self._fn_on_message(delivery_tag, body, self)
+        finally:
+            self._metrics.handler_duration.observe(
+                time.monotonic() - started, queue=self._queue_name
+            )
+
+    def _run_on_ioloop(self, fn):
+        """Run fn on the IOLoop thread - pika channels are not thread safe so
+        anything touching the channel from a worker thread goes through here.
+
+        """
+        if threading.get_ident() == self._ioloop_thread_id:
+            fn()
+        else:
+            self._connection.ioloop.add_callback_threadsafe(fn)
+
     def acknowledge_message(self, delivery_tag):
         """Acknowledge the message delivery from RabbitMQ by sending a
-        Basic.Ack RPC method for the delivery tag.
+        Basic.Ack RPC method for the delivery tag. Safe to call from any
+        thread.
 
         :param int delivery_tag: The delivery tag from the Basic.Deliver frame
 
         """
+        self._run_on_ioloop(functools.partial(self._basic_ack, delivery_tag))
+
+    def _basic_ack(self, delivery_tag):
+        if not self._channel or not self._channel.is_open:
+            self.logger.warning(
+                "Channel closed before message %s was acknowledged", delivery_tag
+            )
+            return
         self.logger.info("Acknowledging message %s", delivery_tag)
         self._channel.basic_ack(delivery_tag)
+        if self._metrics:
+            self._metrics.unacked.dec(queue=self._queue_name)
 
     def reject_message(self, delivery_tag, requeue):
-        """Reject the message delivery from RabbitMQ.
+        """Reject the message delivery from RabbitMQ. Safe to call from any
+        thread.
 
         :param int delivery_tag: The delivery tag from the Basic.Deliver frame
 
         """
+        self._run_on_ioloop(
+            functools.partial(self._basic_reject, delivery_tag, requeue)
+        )
+
+    def _basic_reject(self, delivery_tag, requeue):
+        if not self._channel or not self._channel.is_open:
+            self.logger.warning(
+                "Channel closed before message %s was rejected", delivery_tag
+            )
+            return
         self.logger.info("Rejecting message %s, requeue = %s", delivery_tag, requeue)
         self._channel.basic_reject(delivery_tag, requeue=requeue)
+        if self._metrics:
+            self._metrics.unacked.dec(queue=self._queue_name)
 
     def stop_consuming(self):
         """Tell RabbitMQ that you would like to stop consuming by sending the
@@ -408,8 +590,17 @@ class AsyncConsumer(object):
         starting the IOLoop to block and allow the SelectConnection to operate.
 
         """
+        self._ioloop_thread_id = threading.get_ident()
         self._connection = self.connect()
-        self._connection.ioloop.start()
+        self._ioloop_running = True
+        try:
+            self._connection.ioloop.start()
+        finally:
+            self._ioloop_running = False
+        # stop() leaves the lanes running when called on the IOLoop, e.g. by
+        #   reconnect - the messages being handled are finished before a new
+        #   consumer takes their redeliveries
+        self._stop_lanes()
 
     def stop(self):
         """Cleanly shutdown the connection to RabbitMQ by stopping the consumer
@@ -425,9 +616,266 @@ class AsyncConsumer(object):
         if not self._closing:
             self._closing = True
             self.logger.info("Stopping")
+            if not self._ioloop_running:
+                # Acks from messages still being handled are queued on the
+                # IOLoop ahead of the Basic.Cancel. Waiting for them on the
+                # IOLoop would block it, so then run() waits once it returns
+                self._stop_lanes()
             if self._consuming:
                 self.stop_consuming()
                 self._connection.ioloop.start()
             else:
                 self._connection.ioloop.stop()
             self.logger.info("Stopped")
+
+    def stop_threadsafe(self):
+        """Shut the consumer down from a thread other than the one running
+        run(). Messages already handed to the dispatch workers are finished
+        and acknowledged first, then the shutdown runs on the IOLoop and
+        run() returns once the connection is closed.
+
+        """
+        self._stop_lanes()
+        if self._connection is None:
+            self._closing = True
+            return
+        self._connection.ioloop.add_callback_threadsafe(self._stop_on_ioloop)
+
+    def _stop_lanes(self):
+        lanes, self._lanes = self._lanes, None
+        if lanes:
+            lanes.stop(timeout=30)
+
+    def _stop_on_ioloop(self):
+        if not self._closing:
+            self._closing = True
+            self.logger.info("Stopping")
+            if self._consuming:
+                self.stop_consuming()
+            else:
+                self._connection.ioloop.stop()
+
+
+class PublishError(Exception):
+    """A message that wasn't confirmed by RabbitMQ. sent is False when the
+    broker definitely didn't take the message - it wasn't published or was
+    nacked - and None when the connection was lost before its confirm
+    arrived, so it may or may not have been routed."""
+
+    def __init__(self, message, sent):
+        super(PublishError, self).__init__(message)
+        self.sent = sent
+
+
+class AsyncPublisher(object):
+    """Publishes persistent messages to a durable exchange with publisher
+    confirms, from any thread.
+
+    The connection is run by a thread of its own and reopened, after a
+    delay, whenever it's lost. publish hands the message to that thread and
+    returns a Future that is resolved when RabbitMQ confirms the message or
+    failed with a PublishError, so callers can wait for the confirm without
+    holding up other publishes. The queue messages are routed to is declared
+    and bound when the channel opens, so nothing published is dropped
+    before a consumer has declared it.
+
+    """
+
+    def __init__(self, amqp_url, params):
+        """
+        :param str amqp_url: The AMQP url to connect with
+        :param dict params: exch, exch_type, queue_name and routing_key - the
+            queue is declared durable and bound to the exchange with the
+            routing key
+
+        """
+        self._url = amqp_url
+        self._exchange = params["exch"]
+        self._exchange_type = params.get("exch_type", ExchangeType.topic)
+        self._queue_name = params["queue_name"]
+        self._routing_key = params.get("routing_key", self._queue_name)
+        self._reconnect_delay = params.get("reconnect_delay", 5)
+
+        self._connection = None
+        self._channel = None
+        self._ready = False
+        self._stopping = False
+        self._stopped = threading.Event()
+        self._thread = None
+        # Delivery tag of the last message published on the channel, and the
+        #   futures of the published messages waiting for their confirm
+        self._delivery_tag = 0
+        self._unconfirmed = {}
+        self.logger = logger
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name="amqp-publisher", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """Close the connection - messages still waiting for a confirm fail"""
+        self._stopping = True
+        connection = self._connection
+        if connection is not None:
+            connection.ioloop.add_callback_threadsafe(self._close)
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+
+    def unconfirmed(self):
+        """Messages published and not yet confirmed"""
+        return len(self._unconfirmed)
+
+    def publish(self, body, content_type="application/json"):
+        """Publish body as a persistent message. Safe to call from any thread.
+
+        :param bytes|str body: The message body
+        :param str content_type: The body's content type
+        :return: Resolved with True once RabbitMQ confirms the message
+        :rtype: concurrent.futures.Future
+
+        """
+        future = Future()
+        connection = self._connection
+        if connection is None or not self._ready:
+            future.set_exception(PublishError("Not connected to RabbitMQ", sent=False))
+            return future
+        properties = pika.BasicProperties(
+            content_type=content_type,
+            delivery_mode=pika.spec.PERSISTENT_DELIVERY_MODE,
+        )
+        try:
+            connection.ioloop.add_callback_threadsafe(
+                functools.partial(self._publish, body, properties, future)
+            )
+        except Exception as ex:
+            future.set_exception(PublishError(str(ex), sent=False))
+        return future
+
+    def _run(self):
+        while not self._stopping:
+            self._connection = pika.SelectConnection(
+                parameters=pika.URLParameters(self._url),
+                on_open_callback=self._on_connection_open,
+                on_open_error_callback=self._on_connection_closed,
+                on_close_callback=self._on_connection_closed,
+            )
+            self._connection.ioloop.start()
+            if not self._stopping:
+                self._stopped.wait(self._reconnect_delay)
+        self._connection = None
+
+    def _on_connection_open(self, connection):
+        self.logger.info("Publisher connection opened")
+        if self._stopping:
+            connection.close()
+            return
+        connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_connection_closed(self, connection, reason):
+        self._ready = False
+        self._channel = None
+        self._fail_unconfirmed("Connection to RabbitMQ lost: {}".format(reason))
+        if not self._stopping:
+            self.logger.warning(
+                "Publisher connection closed, reconnecting in %s seconds: %s",
+                self._reconnect_delay,
+                reason,
+            )
+        connection.ioloop.stop()
+
+    def _on_channel_open(self, channel):
+        self._channel = channel
+        self._delivery_tag = 0
+        channel.add_on_close_callback(self._on_channel_closed)
+        channel.exchange_declare(
+            exchange=self._exchange,
+            exchange_type=self._exchange_type,
+            durable=True,
+            callback=lambda _frame: channel.queue_declare(
+                queue=self._queue_name,
+                durable=True,
+                exclusive=False,
+                auto_delete=False,
+                callback=lambda _frame: channel.queue_bind(
+                    self._queue_name,
+                    self._exchange,
+                    routing_key=self._routing_key,
+                    callback=lambda _frame: channel.confirm_delivery(
+                        self._on_delivery_confirmation,
+                        callback=lambda _frame: self._on_ready(),
+                    ),
+                ),
+            ),
+        )
+
+    def _on_ready(self):
+        self.logger.info(
+            "Publishing to %s with routing key %s", self._exchange, self._routing_key
+        )
+        self._ready = True
+
+    def _on_channel_closed(self, channel, reason):
+        self.logger.warning("Publisher channel %i was closed: %s", channel, reason)
+        self._ready = False
+        self._channel = None
+        self._fail_unconfirmed("Channel closed: {}".format(reason))
+        if self._connection and not (
+            self._connection.is_closing or self._connection.is_closed
+        ):
+            self._connection.close()
+
+    def _publish(self, body, properties, future):
+        if not self._ready or not self._channel or not self._channel.is_open:
+            future.set_exception(PublishError("Not connected to RabbitMQ", sent=False))
+            return
+        try:
+            self._channel.basic_publish(
+                self._exchange, self._routing_key, body, properties
+            )
+        except Exception as ex:
+            future.set_exception(PublishError(str(ex), sent=False))
+            return
+        self._delivery_tag += 1
+        self._unconfirmed[self._delivery_tag] = future
+
+    def _on_delivery_confirmation(self, method_frame):
+        method = method_frame.method
+        acked = isinstance(method, pika.spec.Basic.Ack)
+        if method.multiple:
+            delivery_tags = [
+                tag for tag in self._unconfirmed if tag <= method.delivery_tag
+            ]
+        else:
+            delivery_tags = [method.delivery_tag]
+        for delivery_tag in delivery_tags:
+            future = self._unconfirmed.pop(delivery_tag, None)
+            if future is None:
+                continue
+            if acked:
+                future.set_result(True)
+            else:
+                future.set_exception(
+                    PublishError("Message nacked by RabbitMQ", sent=False)
+                )
+
+    def _fail_unconfirmed(self, message):
+        unconfirmed = self._unconfirmed
+        self._unconfirmed = {}
+        for future in unconfirmed.values():
+            future.set_exception(PublishError(message, sent=None))
+
+    def _close(self):
+        connection = self._connection
+        if connection is None:
+            return
+        if connection.is_closing or connection.is_closed:
+            connection.ioloop.stop()
+            return
+        try:
+            connection.close()
+        except Exception:
+            # Not open yet
+            connection.ioloop.stop()
@@ -0,0 +1,139 @@
+import os
+import sys
+import threading
+import time
+
+from collections import Counter
+
+from py_utils.logger import logger, logs_directory
+
+
+class SamplingProfiler(object):
+    """Samples the stacks of every thread in the process at a fixed interval
+    and writes them in the collapsed stack format read by flamegraph.pl and
+    speedscope - one "thread;outer frame;...;inner frame count" line per
+    distinct stack.
+
+    Nothing is installed in the interpreter (no sys.setprofile), so the
+    threads being profiled are not slowed down and a profile can be started
+    and stopped on a running process. Only one profile runs at a time and
+    each one stops by itself after max_duration seconds.
+
+    """
+
+    def __init__(
+        self,
+        output_dir=logs_directory,
+        interval=0.01,
+        max_duration=60,
+        name="jobscheduler",
+    ):
+        """
+        :param str output_dir: Directory the profiles are written to
+        :param float interval: Seconds between samples
+        :param float max_duration: Longest a profile is allowed to run
+        :param str name: Prefix for the profile file names
+
+        """
+        self._output_dir = output_dir
+        self._interval = interval
+        self._max_duration = max_duration
+        self._name = name
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = None
+
+    def is_running(self):
+        with self._lock:
+            return self._thread is not None and self._thread.is_alive()
+
+    def start(self, duration=None):
+        """Start a profile in the background.
+
+        :param float duration: Seconds to sample for, capped at max_duration
+        :return: False if a profile is already running
+        :rtype: bool
+
+        """
+        if duration is None or duration <= 0 or duration > self._max_duration:
+            duration = self._max_duration
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return False
+            self._stop = threading.Event()
+            self._thread = threading.Thread(
+                target=self._run,
+                args=(self._stop, duration),
+                name="sampling-profiler",
+                daemon=True,
+            )
+            self._thread.start()
+        logger.info("Profiling for up to %s seconds", duration)
+        return True
+
+    def stop(self):
+        """Stop the running profile - its file is written by the sampling
+        thread, so this returns straight away."""
+        with self._lock:
+            if self._stop is not None:
+                self._stop.set()
+
+    def toggle(self, duration=None):
+        if self.is_running():
+            self.stop()
+        else:
+            self.start(duration)
+
+    def _run(self, stop, duration):
+        stacks = Counter()
+        samples = 0
+        own_id = threading.get_ident()
+        started = time.time()
+        deadline = time.monotonic() + duration
+        while not stop.is_set() and time.monotonic() < deadline:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stacks[(names.get(thread_id, thread_id),) + _frame_stack(frame)] += 1
+            samples += 1
+            stop.wait(self._interval)
+        try:
+            file_name = self._write(stacks, started)
+            logger.info(
+                "Wrote profile of %d samples over %.1f seconds to %s",
+                samples,
+                time.time() - started,
+                file_name,
+            )
+        except Exception:
+            logger.exception("Failed to write profile")
+
+    def _write(self, stacks, started):
+        file_name = os.path.join(
+            self._output_dir,
+            "{}-profile-{}-{}.collapsed".format(
+                self._name,
+                time.strftime("%Y%m%dT%H%M%S", time.gmtime(started)),
+                os.getpid(),
+            ),
+        )
+        with open(file_name, "w") as f:
+            for stack, count in stacks.most_common():
+                f.write("{} {}\n".format(";".join(str(s) for s in stack), count))
+        return file_name
+
+
+def _frame_stack(frame):
+    """The frames of a stack outermost first, as "function (file:line)"."""
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(
+            "{} ({}:{})".format(
+                code.co_name, os.path.basename(code.co_filename), frame.f_lineno
+            )
+        )
+        frame = frame.f_back
+    stack.reverse()
+    return tuple(stack)
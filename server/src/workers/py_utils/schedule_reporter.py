@@ -0,0 +1,192 @@
+import threading
+
+from collections import OrderedDict
+
+from py_utils.logger import logger
+
+
+class ScheduleStateReporter(object):
+    """Buffers schedule state updates (run dates etc.) on their way back to
+    the API and sends them in batches.
+
+    Updates for the same schedule are merged so only the latest value of
+    each field is sent, and updates identical to what was last reported for
+    the schedule are dropped. Buffered updates are sent every
+    flush_interval seconds, or sooner once max_batch_size schedules are
+    waiting. At most max_queue_size schedules are buffered, which bounds
+    memory when the API is slow or down: once full, updates for schedules
+    already waiting are still merged in but updates for other schedules are
+    dropped, and on_dropped is called. A failed batch goes back in the buffer
+    on the same terms.
+
+    What was last reported is remembered for the max_tracked schedules
+    reported most recently. A schedule forgotten past that gets its next
+    update sent even if nothing changed.
+
+    """
+
+    def __init__(
+        self,
+        send_batch,
+        flush_interval=2.0,
+        max_batch_size=500,
+        max_queue_size=20000,
+        max_tracked=100000,
+        on_dropped=None,
+    ):
+        """
+        :param callable send_batch: Called with (_teamId, updates) where
+            updates is a list of dicts each with the schedule "id" and the
+            fields to set. Returns True if the API accepted the batch.
+        :param float flush_interval: Max seconds an update is buffered
+        :param int max_batch_size: Max schedules sent in one call
+        :param int max_queue_size: Most schedules buffered
+        :param int max_tracked: Most schedules whose last reported state is
+            remembered
+        :param callable on_dropped: Called with a number of schedule updates
+            dropped because the buffer was full
+
+        """
+        self._send_batch = send_batch
+        self._flush_interval = flush_interval
+        self._max_batch_size = max_batch_size
+        self._max_queue_size = max_queue_size
+        self._max_tracked = max_tracked
+        self._on_dropped = on_dropped
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = {}
+        self._last_reported = OrderedDict()
+        self._dropped = 0
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._thread = threading.Thread(
+            target=self._run, name="schedule-reporter", daemon=True
+        )
+        self._thread.start()
+
+    def report(self, schedule_id, _teamId, state):
+        """Queue state changes for a schedule.
+
+        :param str schedule_id: The schedule id
+        :param str _teamId: The team that owns the schedule
+        :param dict state: Schedule fields to set, e.g. nextScheduledRunDate
+
+        """
+        dropped = False
+        with self._lock:
+            last_reported = self._last_reported.get(schedule_id, {})
+            pending = self._pending.get(schedule_id)
+            if pending is None:
+                if all(
+                    k in last_reported and last_reported[k] == v
+                    for k, v in state.items()
+                ):
+                    return
+                dropped = len(self._pending) >= self._max_queue_size
+                if dropped:
+                    self._dropped += 1
+                else:
+                    pending = (_teamId, {})
+                    self._pending[schedule_id] = pending
+            if not dropped:
+                pending[1].update(state)
+            queued = len(self._pending)
+
+        if dropped and self._on_dropped:
+            self._on_dropped(1)
+        if queued >= self._max_batch_size:
+            self._wakeup.set()
+
+    def forget(self, schedule_id):
+        """Drop what was last reported for a schedule so the next update is
+        always sent - used when the schedule was changed outside the
+        scheduler."""
+        with self._lock:
+            self._last_reported.pop(schedule_id, None)
+
+    def pending(self):
+        with self._lock:
+            return len(self._pending)
+
+    def _run(self):
+        while not self._stopping:
+            self._wakeup.wait(self._flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Failed to flush schedule state updates")
+            with self._lock:
+                dropped, self._dropped = self._dropped, 0
+            if dropped:
+                logger.warning(
+                    "Schedule state buffer full - dropped %d updates", dropped
+                )
+
+    def flush(self):
+        """Send everything buffered, grouped by team."""
+        with self._flush_lock:
+            with self._lock:
+                pending = self._pending
+                self._pending = {}
+            if not pending:
+                return
+
+            by_team = {}
+            for schedule_id, (_teamId, state) in pending.items():
+                by_team.setdefault(_teamId, []).append((schedule_id, state))
+
+            for _teamId, schedules in by_team.items():
+                for i in range(0, len(schedules), self._max_batch_size):
+                    batch = schedules[i : i + self._max_batch_size]
+                    updates = [
+                        dict(state, id=schedule_id) for schedule_id, state in batch
+                    ]
+                    sent = False
+                    try:
+                        sent = self._send_batch(_teamId, updates)
+                    except Exception:
+                        logger.exception("Failed to send schedule state updates")
+                    dropped = 0
+                    with self._lock:
+                        for schedule_id, state in batch:
+                            if sent:
+                                self._remember(schedule_id, state)
+                                continue
+                            # Keep the failed update unless a newer one has
+                            # been queued since, if there's room for it
+                            newer = self._pending.get(schedule_id)
+                            merged = dict(state)
+                            if newer is not None:
+                                merged.update(newer[1])
+                            elif len(self._pending) >= self._max_queue_size:
+                                dropped += 1
+                                continue
+                            self._pending[schedule_id] = (_teamId, merged)
+                        self._dropped += dropped
+                    if dropped and self._on_dropped:
+                        self._on_dropped(dropped)
+                    if not sent:
+                        logger.warning(
+                            "Failed to report state for %d schedules - will retry",
+                            len(batch),
+                        )
+
+    def _remember(self, schedule_id, state):
+        # Called with the lock held
+        last_reported = self._last_reported.get(schedule_id)
+        if last_reported is None:
+            last_reported = self._last_reported[schedule_id] = {}
+        else:
+            self._last_reported.move_to_end(schedule_id)
+        last_reported.update(state)
+        while len(self._last_reported) > self._max_tracked:
+            self._last_reported.popitem(last=False)
+
+    def stop(self):
+        """Stop the flush thread and send anything still buffered."""
+        self._stopping = True
+        self._wakeup.set()
+        self._thread.join()
+        self.flush()
@@ -0,0 +1,111 @@
+import pytest
+
+from py_utils.schedule_reporter import ScheduleStateReporter
+
+
+class FakeApi(object):
+    def __init__(self):
+        self.batches = []
+        self.accept = True
+
+    def send_batch(self, _teamId, updates):
+        self.batches.append((_teamId, updates))
+        return self.accept
+
+
+@pytest.fixture
+def api():
+    return FakeApi()
+
+
+@pytest.fixture
+def make_reporter(api):
+    reporters = []
+
+    def make(**kwargs):
+        reporter = ScheduleStateReporter(api.send_batch, flush_interval=3600, **kwargs)
+        reporters.append(reporter)
+        return reporter
+
+    yield make
+    for reporter in reporters:
+        reporter.stop()
+
+
+def test_updates_are_merged_and_sent_per_team(api, make_reporter):
+    reporter = make_reporter()
+    reporter.report("a", "team-1", {"lastScheduledRunDate": 1})
+    reporter.report("a", "team-1", {"nextScheduledRunDate": 2})
+    reporter.report("b", "team-2", {"nextScheduledRunDate": 3})
+
+    reporter.flush()
+
+    assert sorted(api.batches) == [
+        ("team-1", [{"id": "a", "lastScheduledRunDate": 1, "nextScheduledRunDate": 2}]),
+        ("team-2", [{"id": "b", "nextScheduledRunDate": 3}]),
+    ]
+
+
+def test_unchanged_state_is_not_sent_again(api, make_reporter):
+    reporter = make_reporter()
+    reporter.report("a", "team", {"nextScheduledRunDate": 2})
+    reporter.flush()
+
+    reporter.report("a", "team", {"nextScheduledRunDate": 2})
+    assert reporter.pending() == 0
+
+    reporter.forget("a")
+    reporter.report("a", "team", {"nextScheduledRunDate": 2})
+    assert reporter.pending() == 1
+
+
+def test_failed_batch_is_retried_with_newer_updates_merged_in(api, make_reporter):
+    reporter = make_reporter()
+    api.accept = False
+    reporter.report("a", "team", {"lastScheduledRunDate": 1, "nextScheduledRunDate": 2})
+    reporter.flush()
+    reporter.report("a", "team", {"nextScheduledRunDate": 3})
+
+    api.accept = True
+    reporter.flush()
+
+    assert api.batches[-1] == (
+        "team",
+        [{"id": "a", "lastScheduledRunDate": 1, "nextScheduledRunDate": 3}],
+    )
+    assert reporter.pending() == 0
+
+
+def test_full_buffer_drops_updates_for_new_schedules_only(api, make_reporter):
+    dropped = []
+    reporter = make_reporter(max_queue_size=2, on_dropped=dropped.append)
+    reporter.report("a", "team", {"nextScheduledRunDate": 1})
+    reporter.report("b", "team", {"nextScheduledRunDate": 1})
+    reporter.report("c", "team", {"nextScheduledRunDate": 1})
+    reporter.report("a", "team", {"nextScheduledRunDate": 2})
+
+    reporter.flush()
+
+    assert dropped == [1]
+    assert api.batches == [
+        (
+            "team",
+            [
+                {"id": "a", "nextScheduledRunDate": 2},
+                {"id": "b", "nextScheduledRunDate": 1},
+            ],
+        )
+    ]
+
+
+def test_large_backlog_is_sent_in_batches(api, make_reporter):
+    reporter = make_reporter(max_batch_size=2)
+    for schedule_id in "abcde":
+        reporter.report(schedule_id, "team", {"nextScheduledRunDate": 1})
+
+    reporter.flush()
+
+    # A full batch also wakes the flush thread, so where the batches split varies
+    sizes = [len(updates) for _teamId, updates in api.batches]
+    assert sum(sizes) == 5
+    assert max(sizes) == 2
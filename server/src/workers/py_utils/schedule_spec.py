@@ -0,0 +1,286 @@
+import json
+
+from pytz import utc
+
+from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.date import DateTrigger
+from apscheduler.triggers.interval import IntervalTrigger
+
+from py_utils.catch_up import POLICIES as CATCH_UP_POLICIES
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+CRON_FIELDS = (
+    ("Year", "year"),
+    ("Month", "month"),
+    ("Day", "day"),
+    ("Week", "week"),
+    ("Day_Of_Week", "day_of_week"),
+    ("Hour", "hour"),
+    ("Minute", "minute"),
+    ("Second", "second"),
+)
+
+INTERVAL_FIELDS = (
+    ("Weeks", "weeks"),
+    ("Days", "days"),
+    ("Hours", "hours"),
+    ("Minutes", "minutes"),
+    ("Seconds", "seconds"),
+)
+
+DEFAULT_MAX_INSTANCES = 10
+
+
+class ScheduleSpecError(ValueError):
+    """A schedule message that can't be turned into a job. errors holds a
+    {"field", "msg"} dict for every problem found, not just the first."""
+
+    def __init__(self, errors):
+        self.errors = errors
+        super(ScheduleSpecError, self).__init__(
+            "; ".join("{}: {}".format(e["field"], e["msg"]) for e in errors)
+        )
+
+
+def decode_message(body):
+    """Parse a schedule updates message body - with orjson when it's installed.
+
+    :param bytes body: The message body
+    :rtype: dict
+
+    """
+    try:
+        msg = orjson.loads(body) if orjson else json.loads(body)
+    except ValueError as ex:
+        raise ScheduleSpecError([{"field": "body", "msg": str(ex)}])
+    if not isinstance(msg, dict) or "Action" not in msg:
+        raise ScheduleSpecError([{"field": "Action", "msg": "missing"}])
+    return msg
+
+
+def _is_set(value):
+    return value is not None and value != ""
+
+
+def _is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+class ScheduleSpec(object):
+    """An UpdateJob schedule decoded and validated in one pass - everything
+    needed to add, reschedule or modify its job.
+
+    trigger_args are the keyword arguments of the trigger class named by
+    trigger_type, so triggers are only ever built by build_trigger.
+
+    """
+
+    __slots__ = (
+        "id",
+        "name",
+        "trigger_type",
+        "trigger_args",
+        "is_active",
+        "misfire_grace_time",
+        "coalesce",
+        "max_instances",
+        "use_next_run_time",
+        "next_run_time",
+        "fire_spread_seconds",
+        "catch_up_policy",
+        "function_kwargs",
+    )
+
+    trigger_classes = {
+        "cron": CronTrigger,
+        "interval": IntervalTrigger,
+        "date": DateTrigger,
+    }
+
+    @classmethod
+    def from_message(cls, msg):
+        """
+        :param dict msg: An UpdateJob message or one schedule of an UpdateJobs
+            message
+        :raises ScheduleSpecError: If any field is missing or of the wrong type
+
+        """
+        errors = []
+
+        def error(field, text):
+            errors.append({"field": field, "msg": text})
+
+        spec = cls()
+        spec.id = msg.get("id")
+        if not isinstance(spec.id, str) or not spec.id:
+            error("id", "must be a non-empty string")
+        spec.name = msg.get("name")
+
+        spec.misfire_grace_time = msg.get("misfire_grace_time")
+        if spec.misfire_grace_time == "":
+            spec.misfire_grace_time = None
+        if spec.misfire_grace_time is not None and (
+            not _is_int(spec.misfire_grace_time) or spec.misfire_grace_time <= 0
+        ):
+            error("misfire_grace_time", "must be a positive integer")
+
+        spec.coalesce = msg.get("coalesce")
+        if spec.coalesce == "":
+            spec.coalesce = None
+
+        spec.max_instances = msg.get("max_instances")
+        if not _is_set(spec.max_instances):
+            spec.max_instances = DEFAULT_MAX_INSTANCES
+        elif not _is_int(spec.max_instances) or spec.max_instances <= 0:
+            error("max_instances", "must be a positive integer")
+
+        spec.use_next_run_time = False
+        spec.next_run_time = None
+        if _is_set(msg.get("next_run_time")):
+            spec.use_next_run_time = True
+            if msg["next_run_time"] != "None":
+                spec.next_run_time = msg["next_run_time"]
+
+        spec.is_active = msg.get("isActive", True)
+        if not spec.is_active:
+            spec.use_next_run_time = True
+            spec.next_run_time = None
+
+        spec.fire_spread_seconds = msg.get("fireSpreadSeconds")
+        if _is_set(spec.fire_spread_seconds):
+            if not isinstance(spec.fire_spread_seconds, (int, float)):
+                error("fireSpreadSeconds", "must be a number")
+        else:
+            spec.fire_spread_seconds = None
+
+        spec.catch_up_policy = msg.get("catchUpPolicy")
+        if not _is_set(spec.catch_up_policy):
+            spec.catch_up_policy = None
+        elif spec.catch_up_policy not in CATCH_UP_POLICIES:
+            error("catchUpPolicy", "must be one of skip, once or all")
+
+        spec.function_kwargs = msg.get("FunctionKwargs")
+        if not isinstance(spec.function_kwargs, dict):
+            error("FunctionKwargs", "must be an object")
+        elif not _is_set(spec.function_kwargs.get("runtimeVars")):
+            spec.function_kwargs["runtimeVars"] = {}
+
+        spec.trigger_type = msg.get("TriggerType")
+        spec.trigger_args = {}
+        if spec.trigger_type == "cron":
+            spec._decode_cron(msg.get("cron"), error)
+        elif spec.trigger_type == "interval":
+            spec._decode_interval(msg.get("interval"), error)
+        elif spec.trigger_type == "date":
+            spec.trigger_args = {"run_date": msg.get("RunDate"), "timezone": utc}
+        else:
+            error("TriggerType", "must be one of cron, interval or date")
+
+        if errors:
+            raise ScheduleSpecError(errors)
+        return spec
+
+    def _decode_cron(self, cron, error):
+        if not isinstance(cron, dict):
+            error("cron", "must be an object")
+            return
+        args = self.trigger_args
+        for field, arg in CRON_FIELDS:
+            value = cron.get(field)
+            args[arg] = value if _is_set(value) else None
+        args["start_date"] = cron.get("Start_Date") or None
+        args["end_date"] = cron.get("End_Date") or None
+        args["jitter"] = self._decode_int(cron, "Jitter", "cron.Jitter", None, error)
+        timezone = cron.get("Timezone")
+        args["timezone"] = timezone if _is_set(timezone) else utc
+
+    def _decode_interval(self, interval, error):
+        if not isinstance(interval, dict):
+            error("interval", "must be an object")
+            return
+        args = self.trigger_args
+        for field, arg in INTERVAL_FIELDS:
+            args[arg] = self._decode_int(interval, field, "interval." + field, 0, error)
+        args["start_date"] = interval.get("Start_Date") or None
+        args["end_date"] = interval.get("End_Date") or None
+        args["jitter"] = self._decode_int(
+            interval, "Jitter", "interval.Jitter", None, error
+        )
+        args["timezone"] = utc
+
+    @staticmethod
+    def _decode_int(values, field, path, default, error):
+        value = values.get(field)
+        if not _is_set(value):
+            return default
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            error(path, "must be an integer")
+            return default
+
+    def build_trigger(self, trigger_cache=None):
+        """The trigger for the schedule.
+
+        :param TriggerCache trigger_cache: Share the trigger with schedules
+            that have the same definition instead of building a new one
+        :raises ScheduleSpecError: If the trigger rejects its arguments - an
+            invalid cron expression, time zone or date
+
+        """
+        trigger_class = self.trigger_classes[self.trigger_type]
+        try:
+            if trigger_cache is not None:
+                return trigger_cache.build(
+                    self.trigger_type, self.trigger_args, trigger_class
+                )
+            return trigger_class(**self.trigger_args)
+        except Exception as ex:
+            raise ScheduleSpecError([{"field": self.trigger_type, "msg": str(ex)}])
+
+    def trigger_changed(self, trigger, new_trigger):
+        """Whether trigger fires differently than the schedule's trigger.
+
+        :param BaseTrigger trigger: The trigger of the existing job
+        :param BaseTrigger new_trigger: The trigger from build_trigger
+
+        """
+        if trigger is new_trigger:
+            return False
+        if not isinstance(trigger, self.trigger_classes[self.trigger_type]):
+            return True
+        if self.trigger_type == "date":
+            return trigger.run_date != new_trigger.run_date
+        if (
+            str(trigger.timezone) != str(new_trigger.timezone)
+            or trigger.end_date != new_trigger.end_date
+            or trigger.jitter != new_trigger.jitter
+        ):
+            return True
+        if self.trigger_type == "interval":
+            # Without a start date an interval trigger starts one interval after
+            #   it's created, so a rebuilt trigger never has the same one
+            return trigger.interval != new_trigger.interval or (
+                self.trigger_args["start_date"] is not None
+                and trigger.start_date != new_trigger.start_date
+            )
+        return trigger.start_date != new_trigger.start_date or [
+            str(f) for f in trigger.fields
+        ] != [str(f) for f in new_trigger.fields]
+
+    def job_kwargs(self):
+        """Keyword arguments for add_job/modify_job other than the trigger."""
+        kwargs = {
+            "misfire_grace_time": self.misfire_grace_time,
+            "coalesce": self.coalesce,
+            "max_instances": self.max_instances,
+            "kwargs": self.function_kwargs,
+        }
+        if self.use_next_run_time:
+            kwargs["next_run_time"] = self.next_run_time
+        return kwargs
@@ -0,0 +1,172 @@
+import copyreg
+import threading
+
+from collections import OrderedDict
+from datetime import timedelta
+
+from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
+from apscheduler.util import datetime_ceil
+
+
+class MemoCronTrigger(CronTrigger):
+    """CronTrigger that remembers its last few next fire times.
+
+    A cron trigger's next fire time only depends on the second the search
+    starts from, so jobs sharing an interned trigger that fire together
+    compute their next fire time once between them. Triggers with jitter
+    are never memoized.
+
+    Pickles as a plain CronTrigger, so stored jobs don't depend on this
+    class.
+
+    """
+
+    __slots__ = ("_memo", "_memo_lock")
+
+    memo_size = 8
+
+    def __init__(self, *args, **kwargs):
+        super(MemoCronTrigger, self).__init__(*args, **kwargs)
+        self._init_memo()
+
+    def _init_memo(self):
+        self._memo = OrderedDict()
+        self._memo_lock = threading.Lock()
+
+    def __setstate__(self, state):
+        super(MemoCronTrigger, self).__setstate__(state)
+        self._init_memo()
+
+    def __reduce_ex__(self, protocol):
+        return copyreg._reconstructor, (CronTrigger, object, None), self.__getstate__()
+
+    def get_next_fire_time(self, previous_fire_time, now):
+        if self.jitter:
+            return super(MemoCronTrigger, self).get_next_fire_time(
+                previous_fire_time, now
+            )
+        # Same start point as CronTrigger.get_next_fire_time
+        if previous_fire_time:
+            start_date = min(now, previous_fire_time + timedelta(microseconds=1))
+            if start_date == previous_fire_time:
+                start_date += timedelta(microseconds=1)
+        else:
+            start_date = max(now, self.start_date) if self.start_date else now
+        key = datetime_ceil(start_date)
+        with self._memo_lock:
+            if key in self._memo:
+                self._memo.move_to_end(key)
+                return self._memo[key]
+        next_fire_time = super(MemoCronTrigger, self).get_next_fire_time(
+            previous_fire_time, now
+        )
+        with self._memo_lock:
+            self._memo[key] = next_fire_time
+            if len(self._memo) > self.memo_size:
+                self._memo.popitem(last=False)
+        return next_fire_time
+
+
+def _trigger_key(trigger):
+    """Canonical definition of a trigger, or None if it can't be shared."""
+    if isinstance(trigger, CronTrigger):
+        return (
+            "cron",
+            str(trigger.timezone),
+            trigger.start_date,
+            trigger.end_date,
+            tuple(str(field) for field in trigger.fields),
+            trigger.jitter,
+        )
+    if isinstance(trigger, IntervalTrigger):
+        return (
+            "interval",
+            str(trigger.timezone),
+            trigger.start_date,
+            trigger.end_date,
+            trigger.interval,
+            trigger.jitter,
+        )
+    return None
+
+
+class TriggerCache(object):
+    """Interns cron and interval triggers so schedules with the same
+    definition share one trigger object, bounded by an LRU of max_size
+    definitions.
+
+    Triggers are looked up either by the arguments they are built from or,
+    for triggers restored from the job store, by their state. Interval
+    triggers without a start date start one interval after they are built,
+    so they are never shared. Date triggers are never shared either.
+
+    """
+
+    def __init__(self, max_size=10000):
+        """
+        :param int max_size: Most trigger definitions kept
+
+        """
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._triggers = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._triggers)
+
+    def _get(self, key):
+        with self._lock:
+            trigger = self._triggers.get(key)
+            if trigger is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._triggers.move_to_end(key)
+            return trigger
+
+    def _put(self, key, trigger):
+        with self._lock:
+            trigger = self._triggers.setdefault(key, trigger)
+            self._triggers.move_to_end(key)
+            while len(self._triggers) > self._max_size:
+                self._triggers.popitem(last=False)
+            return trigger
+
+    def build(self, trigger_type, trigger_args, trigger_class):
+        """The shared trigger for trigger_class(**trigger_args).
+
+        :param str trigger_type: cron, interval or date
+        :param dict trigger_args: Trigger constructor arguments
+        :param type trigger_class: Class to build when trigger_type can't be
+            shared
+
+        """
+        if trigger_type == "cron":
+            trigger_class = MemoCronTrigger
+        elif trigger_type != "interval" or trigger_args.get("start_date") is None:
+            return trigger_class(**trigger_args)
+        args_key = (trigger_type,) + tuple(
+            (name, str(value)) for name, value in sorted(trigger_args.items())
+        )
+        trigger = self._get(args_key)
+        if trigger is None:
+            trigger = self.intern(trigger_class(**trigger_args))
+            trigger = self._put(args_key, trigger)
+        return trigger
+
+    def intern(self, trigger):
+        """The shared trigger with the same definition as trigger."""
+        key = _trigger_key(trigger)
+        if key is None:
+            return trigger
+        shared = self._get(key)
+        if shared is not None:
+            return shared
+        if type(trigger) is CronTrigger:
+            shared = MemoCronTrigger.__new__(MemoCronTrigger)
+            shared.__setstate__(trigger.__getstate__())
+            trigger = shared
+        return self._put(key, trigger)